@@ -28,6 +28,8 @@ _C.DATASET.LANDMARKS = []
 _C.DATASET.TRAINSET_SIZE = -1  # -1 for full trainset size or int <= len(training_set)
 _C.DATASET.TO_PYTORCH_TENSOR = True  # True if using pytorch, False if using tensorflow
 _C.DATASET.STANDARDIZE_LANDMARKS = False
+_C.DATASET.IMAGE_LOADER = "pil"  # ["pil", "array"]. "array" is within ~1 grey level of "pil" on integer images (~1.6e-3 normalized for 12-bit, std 600), 1e-5 on float images.
+_C.DATASET.STREAM_SHARDS_DIR = None  # Directory of sample shards (utils/data/shards.py) to stream the testing split from.
 
 _C.SAMPLER = CN()
 _C.SAMPLER.SAMPLE_MODE = "full"  # ['full', "patch_bias", 'patch_centred']
@@ -38,7 +40,7 @@ _C.SAMPLER.INPUT_SIZE = [512, 512]
 _C.SAMPLER.EVALUATION_SAMPLE_MODE = "full"
 
 _C.SAMPLER.DATA_AUG = "AffineComplex"  # None
-_C.SAMPLER.DATA_AUG_PACKAGE = "imgaug"  # ['imgaug', 'albumentations']
+_C.SAMPLER.DATA_AUG_PACKAGE = "imgaug"  # ['imgaug', 'fused', 'torch']
 _C.SAMPLER.DATA_AUG_GUARANTEE_LMS_IN_IMAGE = False  # ['imgaug', 'albumentations']
 
 _C.SAMPLER.NUM_WORKERS = 0
@@ -52,6 +54,8 @@ _C.SAMPLER.PATCH.SAMPLE_PATCH_SIZE = [128, 128]
 _C.SAMPLER.PATCH.INFERENCE_MODE = "fully_convolutional"
 
 _C.SAMPLER.PATCH.SAMPLER_BIAS = 0.66
+# Number of patches sampled from each loaded training image, each with its own augmentation and labels.
+_C.SAMPLER.PATCH.PATCHES_PER_LOAD = 1
 
 _C.SAMPLER.PATCH.CENTRED_PATCH_COORDINATE_PATH = None
 _C.SAMPLER.PATCH.CENTRED_PATCH_COORDINATE_PATH_SHEET = None
@@ -84,6 +88,7 @@ _C.SOLVER.DEEP_SUPERVISION = True
 _C.SOLVER.LOSS_FUNCTION = "mse"  # # ["mse", "awl"]
 _C.SOLVER.REGRESS_SIGMA = False
 _C.SOLVER.REGRESS_SIGMA_LOSS_WEIGHT = 0.005
+_C.SOLVER.GENERATE_HEATMAPS_ON_DEVICE = False  # U-Net heatmaps built per batch on the training device
 
 
 # model trainer
@@ -95,6 +100,13 @@ _C.TRAINER.SAVE_EVERY = 10
 _C.TRAINER.VALIDATE_EVERY = 10
 
 _C.TRAINER.CACHE_DATA = True
+_C.TRAINER.CACHE_LOADING_WORKERS = 0  # 0 to load the cache serially
+_C.TRAINER.CACHE_LOADING_POOL = "process"  # ["process", "thread"]
+_C.TRAINER.CACHE_SHARED_MEMORY = False  # pack the cache into one shared memory block for the dataloader workers
+_C.TRAINER.CACHE_COMPACT = False  # cache uint16/float16 pixels, normalized to float32 when sampled
+_C.TRAINER.SHARE_CACHE_ACROSS_DATASETS = False  # one cached copy of each image per process, shared by all splits
+_C.TRAINER.LRU_CACHE_BUDGET_MB = 0  # if CACHE_DATA is False, size of a lazily filled LRU image cache. 0 to disable.
+_C.TRAINER.IMAGE_STORE_DIR = None  # directory of memory-mapped resized images, used when CACHE_DATA is False
 _C.TRAINER.FOLD = 0
 _C.TRAINER.INFERENCE_ONLY = True
 _C.TRAINER.VALIDATION_LOG_HEATMAPS = False
@@ -151,6 +163,7 @@ _C.INFERENCE.SPLIT = "testing"  # Split/s of the data to perform inference. Can
 
 _C.INFERENCE.EVALUATION_MODE = "scale_heatmap_first"  # ["scale_heatmap_first", "scale_pred_coords", "use_input_size"]
 _C.INFERENCE.FIT_GAUSS = False  # If false, uses max, if true, first fits gaussian to output heatmap.
+_C.INFERENCE.FIT_GAUSS_WINDOW = 32  # Half size of the window around the heatmap max the gaussian is fitted in.
 _C.INFERENCE.LOG_HEATMAPS = False
 _C.INFERENCE.LOG_HEATMAP_PLOT_TARG = False
 
@@ -504,8 +504,10 @@ from transforms.transformations import (
 from tqdm import tqdm
 from transforms.dataloader_transforms import get_aug_package_loader
 
-from utils.data.load_data import get_datatype_load, load_aspire_datalist, load_and_resize_image, maybe_get_coordinates_from_xlsx, resize_coordinates
+from utils.data.load_data import compact_image, expand_compact_image, get_datatype_load, load_aspire_datalist, load_and_resize_image, load_and_resize_images, maybe_get_coordinates_from_xlsx, resize_coordinates
+from utils.data.image_cache import PROCESS_IMAGE_STORE, LRUImageCache, MemmapImageStore, SharedCompactImageCache, SharedImageCache
 from utils.im_utils.visualisation import visualize_patch
+from datasets.sample_table import SampleTable
 
 
 import logging
@@ -591,6 +593,7 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
         self.sample_patch_size = patch_sampler_args["generic"]["sample_patch_size"]
         self.sample_patch_bias = patch_sampler_args["biased"]["sampling_bias"]
         self.sample_patch_from_resolution = patch_sampler_args["generic"]["sample_patch_from_resolution"]
+        self.patches_per_load = patch_sampler_args["generic"]["patches_per_load"]
         self.center_patch_on_coords_path = patch_sampler_args["centred"]["xlsx_path"]
         self.center_patch_sheet = patch_sampler_args["centred"]["xlsx_sheet"]
         self.center_patch_jitter = patch_sampler_args["centred"]["center_patch_jitter"]
@@ -602,6 +605,7 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
         self.image_modality = dataset_args["image_modality"]
         self.landmarks = dataset_args["landmarks"]
         self.standardize_landmarks = dataset_args["standardize_landmarks"]
+        self.image_loader = dataset_args["image_loader"]
         if self.standardize_landmarks:
             if self.sample_mode != "patch_centred":
                 raise ValueError(
@@ -635,19 +639,16 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
         self.sigmas = sigmas
 
         self.cache_data = cache_data
+        self.cache_loading_workers = dataset_args["cache_loading_workers"]
+        self.cache_loading_pool = dataset_args["cache_loading_pool"]
+        self.cache_shared_memory = dataset_args["cache_shared_memory"]
+        self.cache_compact = cache_data and dataset_args["cache_compact"]
         self.debug = debug
 
         self.num_res_supervisions = num_res_supervisions
 
-        # Lists to save the image paths (or images if caching), target coordinates (scaled to input size), and full resolution coords.
-        self.images = []
-        self.target_coordinates = []
-        self.full_res_coordinates = []  # full_res will be same as target if input and original image same size
-        self.image_paths = []
-        self.uids = []
-        self.annotation_available = []
-        self.original_image_sizes = []
-        self.image_resizing_factors = []
+        # (index, loaded sample) of the last image loaded, reused for its next patches if patches_per_load > 1.
+        self.last_loaded = None
 
         if self.sample_mode == "patch_bias" or self.sample_mode == "patch_centred":
             # Get the patches origin information. Use this for stitching together in valid/testing
@@ -656,7 +657,8 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
 
             # if we're sampling patches w/o aug we still need to center crop so change the aug strategy to at least do this.
             if self.data_augmentation_strategy == None:
-                self.data_augmentation_package = "imgaug"
+                if self.data_augmentation_package != "fused":
+                    self.data_augmentation_package = "imgaug"
                 self.data_augmentation_strategy = "CenterCropOnly"
 
         elif self.sample_mode == "full":
@@ -688,6 +690,27 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
 
         self.heatmaps_to_tensor = transforms.Compose([HeatmapsToTensor()])
 
+        # Load the datalist of this split and index its samples.
+        self.index_samples(dataset_args)
+
+    def index_samples(self, dataset_args):
+        """Load the datalist of this split and build the sample table, loading (caching) the images if self.cache_data.
+
+        Args:
+            dataset_args (Dict): A dict of arguments for the generic dataset arguments.
+        """
+
+        # Save the images if caching. The per-sample attributes (image paths, target coordinates (scaled to input size),
+        # full resolution coords etc.) are collected in lists while loading, then packed into a columnar SampleTable.
+        self.images = []
+        target_coordinates = []
+        full_res_coordinates = []  # full_res will be same as target if input and original image same size
+        image_paths = []
+        uids = []
+        annotation_available = []
+        original_image_sizes = []
+        image_resizing_factors = []
+
         # We are using cross-validation, following our convention of naming each json train with the append "foldX" where (X= self.cv)
         if self.cv >= 0:
             label_std = os.path.join("fold" + str(self.cv) + ".json")
@@ -717,69 +740,135 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
             self.logger.info("datalist truncated to length: %s, giving: %s", self.dataset_split_size, datalist)
 
         # based on first image extenstion, get the load function.
-        self.datatype_load = get_datatype_load(datalist[0]["image"])
+        self.datatype_load = get_datatype_load(datalist[0]["image"], self.image_loader)
 
         self.load_function = lambda img: img
 
+        # Compact cached images are stored as uint16/float16 with their mean and std, normalized when sampled.
+        if self.cache_compact:
+            self.load_function = expand_compact_image
+
+        # If not caching, images are loaded in __getitem__ by this function.
+        self.load_and_resize_function = load_and_resize_image
+
+        # Optionally read resized images from (and add them to) a persistent on-disk store.
+        if not self.cache_data and dataset_args["image_store_dir"] is not None:
+            self.image_store = MemmapImageStore(dataset_args["image_store_dir"], image_loader=self.image_loader)
+            self.load_and_resize_function = self.image_store.load_and_resize_image
+            self.logger.info("Reading %s images through the image store at %s", self.split, dataset_args["image_store_dir"])
+        else:
+            self.image_store = None
+
+        # Optionally keep the most recently used images in a cache bounded by a byte budget.
+        if not self.cache_data and dataset_args["lru_cache_budget_mb"] > 0:
+            self.lru_cache = LRUImageCache(
+                dataset_args["lru_cache_budget_mb"] * 1e6, load_function=self.load_and_resize_function)
+            self.load_and_resize_function = self.lru_cache.load_and_resize_image
+            self.logger.info("Using an LRU image cache of %s MB per process for %s split.",
+                             dataset_args["lru_cache_budget_mb"], self.split)
+        else:
+            self.lru_cache = None
+
+        # If caching, optionally pack all images into one shared-memory block that DataLoader workers attach to.
+        if self.cache_compact and self.cache_shared_memory:
+            self.images = SharedCompactImageCache(len(datalist), (1, self.load_im_size[1], self.load_im_size[0]))
+        elif self.cache_data and self.cache_shared_memory:
+            self.images = SharedImageCache(
+                len(datalist),
+                (1, self.load_im_size[1], self.load_im_size[0]),
+                dtype=torch.float32 if self.image_loader == "array" else torch.float64,
+            )
+
+        # If caching, optionally share the loaded images with all other datasets built in this process.
+        if self.cache_data and dataset_args["share_cache_across_datasets"]:
+            self.process_image_store = PROCESS_IMAGE_STORE
+        else:
+            self.process_image_store = None
+
+        # If caching, optionally fan out the image loading to a pool of workers. Results come back in datalist order.
+        if self.cache_data and self.cache_loading_workers > 0:
+            self.logger.info("Loading %s images with a %s pool of %s workers.",
+                             self.split, self.cache_loading_pool, self.cache_loading_workers)
+            preloaded_images = load_and_resize_images(
+                self.get_image_paths_to_load(datalist),
+                self.load_im_size,
+                self.cache_loading_workers,
+                pool=self.cache_loading_pool,
+                round=not (self.sample_mode == "patch_centred"),
+                image_loader=self.image_loader,
+                compact=self.cache_compact,
+            )
+        else:
+            preloaded_images = None
+
         # bar_logger
 
         with alive_bar(len(datalist), force_tty=True) as loading_bar:
             loading_bar.text('Loading Data...')
             for idx, data in enumerate(datalist):
                 # Add coordinate labels as sample attribute, if annotations available
-                if (not isinstance(data["coordinates"], list)) or (
-                    "has_annotation" in data.keys() and data["has_annotation"] == False
-                ):
-                    # Case when data has no annotation, i.e. inference only, just set target coords to 0,0 and annotation_available to False
-                    interested_landmarks = np.array([[0, 0]] * len(self.landmarks))
-                    self.annotation_available.append(False)
-                    self.full_res_coordinates.append(interested_landmarks)
-
-                    if self.split == "training" or self.split == "validation":
-                        raise ValueError(
-                            "Training/Validation data must have annotations. Check your data. Sample that failed: ",
-                            data,
-                        )
-                else:
-                    # Case when we have annotations.
-                    interested_landmarks = np.array(data["coordinates"])[self.landmarks, :2]
-                    self.full_res_coordinates.append(np.array(data["coordinates"])[self.landmarks, :2])
-                    self.annotation_available.append(True)
+                interested_landmarks, full_res_coords, is_annotation_available = self.get_datalist_coordinates(data)
+                full_res_coordinates.append(full_res_coords)
+                annotation_available.append(is_annotation_available)
 
                 if self.cache_data:
                     # Determine original size and log whether we needed to resize it
-                    (
-                        resized_factor,
-                        original_size,
-                        image,
-                        interested_landmarks,
-                    ) = load_and_resize_image(data["image"], interested_landmarks, self.load_im_size, self.datatype_load, round=not (self.sample_mode == "patch_centred"))
+                    resized_factor, original_size, image = self.load_image_to_cache(data["image"], preloaded_images)
+                    interested_landmarks = resize_coordinates(
+                        interested_landmarks, resized_factor[0], round=not (self.sample_mode == "patch_centred"))
 
                     self.images.append(image)
-                    self.image_resizing_factors.append(resized_factor)
-                    self.original_image_sizes.append(original_size)
-
-                else:
-                    # if self.standardize_landmarks:
-                    #     raise ValueError(
-                    #         "cannot standardize landmarks if not caching data right now. future work to implement.")
-                    # Not caching, so just append image path.
-                    self.images.append(data["image"])
-
-                self.target_coordinates.append(interested_landmarks)
-                self.image_paths.append(data["image"])
-                self.uids.append(data["id"])
+                    if self.process_image_store is not None and self.cache_shared_memory:
+                        # Point the store at the image in the shared block, so the image is not held a second time.
+                        self.process_image_store.add(
+                            data["image"], self.load_im_size, (resized_factor, original_size, self.images[len(self.images) - 1]),
+                            self.standardize_landmarks, self.cache_compact, self.image_loader)
+                    image_resizing_factors.append(resized_factor)
+                    original_image_sizes.append(original_size)
+
+                target_coordinates.append(interested_landmarks)
+                image_paths.append(data["image"])
+                uids.append(data["id"])
 
                 # Extended dataset class can add more attributes to each sample here
                 self.add_additional_sample_attributes(data)
 
                 loading_bar()  # pylint: disable=not-callable
 
+        self.sample_table = SampleTable(
+            uids,
+            image_paths,
+            annotation_available,
+            target_coordinates,
+            full_res_coordinates,
+            image_resizing_factors=image_resizing_factors,
+            original_image_sizes=original_image_sizes,
+        )
+
+        # Not caching, so the images are loaded on the fly from their paths.
+        if not self.cache_data:
+            self.images = self.sample_table.image_paths
+
         # Maybe get external coordinates from xlsx for patch_centred sampling.
         self.patch_centring_coords = maybe_get_coordinates_from_xlsx(
-            self.center_patch_on_coords_path, self.uids, self.landmarks, sheet_name=self.center_patch_sheet)  # may return none
+            self.center_patch_on_coords_path, uids, self.landmarks, sheet_name=self.center_patch_sheet)  # may return none
 
-        if self.cache_data:
+        if self.lru_cache is not None:
+            self.logger.info(
+                "Caching %s data lazily in a %s MB LRU cache. Length of %s",
+                self.split, dataset_args["lru_cache_budget_mb"], len(self.images)
+            )
+        elif self.cache_data and self.cache_shared_memory:
+            self.logger.info(
+                "Cached all %s data in a shared memory block of %.1f MB. Length of %s",
+                self.split, self.images.nbytes() / 1e6, len(self.images)
+            )
+        elif self.cache_compact:
+            self.logger.info(
+                "Cached all %s data in memory as compact %s images. Length of %s",
+                self.split, self.images[0].data.dtype if len(self.images) else None, len(self.images)
+            )
+        elif self.cache_data:
             self.logger.info(
                 "Cached all %s data in memory. Length of %s", self.split,  len(self.images)
             )
@@ -791,18 +880,97 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
         self.check_uids_unique()
 
     def __len__(self):
-        return len(self.images)
+        return len(self.sample_table)
+
+    def get_datalist_coordinates(self, data):
+        """Get the coordinates of the landmarks of interest from a datalist entry.
+
+        Args:
+            data (dict): datalist entry of a sample.
+
+        Returns:
+            (np.array, np.array, bool): target coords, full resolution coords (both at the original image resolution)
+             and whether the sample has annotations. Unannotated samples get coords of 0,0.
+        """
+        if (not isinstance(data["coordinates"], list)) or (
+            "has_annotation" in data.keys() and data["has_annotation"] == False
+        ):
+            # Case when data has no annotation, i.e. inference only, just set target coords to 0,0 and annotation_available to False
+            interested_landmarks = np.array([[0, 0]] * len(self.landmarks))
+
+            if self.split == "training" or self.split == "validation":
+                raise ValueError(
+                    "Training/Validation data must have annotations. Check your data. Sample that failed: ",
+                    data,
+                )
+            return interested_landmarks, interested_landmarks, False
+
+        # Case when we have annotations.
+        interested_landmarks = np.array(data["coordinates"])[self.landmarks, :2]
+        return interested_landmarks, np.array(data["coordinates"])[self.landmarks, :2], True
+
+    def get_image_paths_to_load(self, datalist):
+        """Image paths that load_image_to_cache will take from the parallel loader, in the order it will ask for them.
+        These are all images in the datalist, minus the ones already in the process image store (if used).
+
+        Args:
+            datalist ([dict]): the datalist of samples.
+
+        Returns:
+            [str]: image paths to load.
+        """
+        if self.process_image_store is None:
+            return [data["image"] for data in datalist]
+
+        paths_to_load = []
+        seen_keys = set()
+        for data in datalist:
+            key = self.process_image_store.entry_key(
+                data["image"], self.load_im_size, self.standardize_landmarks, self.cache_compact, self.image_loader)
+            if key not in self.process_image_store and key not in seen_keys:
+                paths_to_load.append(data["image"])
+                seen_keys.add(key)
+        return paths_to_load
+
+    def load_image_to_cache(self, image_path, preloaded_images=None):
+        """Load and resize an image to cache. Reuses the image from the process image store if another dataset in this
+        process already loaded it, otherwise takes the next image from the parallel loader or loads it here.
+
+        Args:
+            image_path (str): path to the image.
+            preloaded_images (generator, optional): generator from load_and_resize_images over
+             get_image_paths_to_load(datalist). Defaults to None.
+
+        Returns:
+            (resized_factor, original_size, image): resizing factor, original image size and resized, normalized image
+             (a CompactImage if self.cache_compact).
+        """
+        if self.process_image_store is not None:
+            entry = self.process_image_store.get(
+                image_path, self.load_im_size, self.standardize_landmarks, self.cache_compact, self.image_loader)
+            if entry is not None:
+                return entry
+
+        if preloaded_images is not None:
+            entry = next(preloaded_images)
+        else:
+            resized_factor, original_size, image, _ = load_and_resize_image(
+                image_path, np.zeros((0, 2)), self.load_im_size, self.datatype_load, normalize=not self.cache_compact)
+            if self.cache_compact:
+                image = compact_image(image)
+            entry = (resized_factor, original_size, image)
+
+        if self.process_image_store is not None:
+            self.process_image_store.add(
+                image_path, self.load_im_size, entry, self.standardize_landmarks, self.cache_compact, self.image_loader)
+        return entry
 
     def check_uids_unique(self):
         """Make sure all uids are unique
         """
-        non_unique = [
-            [x, self.image_paths[x_idx]]
-            for x_idx, x in enumerate(self.uids)
-            if self.uids.count(x) > 1
-        ]
+        non_unique = self.sample_table.duplicate_uids()
         assert len(non_unique) == 0, (
-            f"Not all uids are unique! Check your data. {len(non_unique)} non-unqiue uids from {len(self.uids)} samples , they are: {non_unique}"
+            f"Not all uids are unique! Check your data. {len(non_unique)} non-unqiue uids from {len(self.sample_table)} samples , they are: {non_unique}"
         )
 
     def add_additional_sample_attributes(self, extra_data):
@@ -841,25 +1009,61 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
 
         """
 
+        full_res_coods = self.sample_table.full_res_coordinates[index]
+        im_path = self.sample_table.image_paths[index]
+        this_uid = self.sample_table.get_uid(index)
+        is_annotation_available = bool(self.sample_table.annotation_available[index])
+
+        # Consecutive patches of the same sample reuse its loaded image (see datasets.samplers.RepeatedIndexSampler).
+        if self.last_loaded is not None and self.last_loaded[0] == index:
+            resized_factor, original_size, image, coords = self.last_loaded[1]
+        else:
+            coords = self.sample_table.target_coordinates[index]
+            image = self.load_function(self.images[index])
+
+            # If we cached the data, we don't need to get original image size. If not, we need to load it here.
+            if self.cache_data:
+                resized_factor = self.sample_table.image_resizing_factors[index]
+                original_size = self.sample_table.original_image_sizes[index]
+
+            else:
+                resized_factor, original_size, image, coords = self.load_and_resize_function(
+                    image, coords, self.load_im_size, self.datatype_load, round=not (self.sample_mode == "patch_centred"), standardized=self.standardize_landmarks
+                )
+
+            if self.patches_per_load > 1:
+                self.last_loaded = (index, (resized_factor, original_size, image, coords))
+
+        # add additional sample attributes from child class.
+        additional_attributes = {
+            key_: self.additional_sample_attributes[key_][index] for key_ in list(self.additional_sample_attributes.keys())
+        }
+
+        return self.build_sample(image, coords, full_res_coods, im_path, this_uid, is_annotation_available,
+                                 resized_factor, original_size, additional_attributes)
+
+    def build_sample(self, image, coords, full_res_coods, im_path, this_uid, is_annotation_available, resized_factor,
+                     original_size, additional_attributes):
+        """Build a sample from a loaded, resized image: sample a patch, augment, and generate labels.
+        Shared by __getitem__ and datasets that get their images elsewhere (e.g. DatasetStream).
+
+        Args:
+            image (np.array, shape (1, H, W)): image, resized to self.load_im_size and normalized.
+            coords (np.array, shape (num_landmarks, 2)): target coords, same scale as image.
+            full_res_coods (np.array, shape (num_landmarks, 2)): coords at the original image resolution.
+            im_path (str): path to image, from the JSON file.
+            this_uid (str): sample's unique id, from the JSON file.
+            is_annotation_available (bool): Whether the JSON file provided annotations for this sample.
+            resized_factor (np.array, shape (1,2)): resizing factor of the image.
+            original_size (np.array, shape (2,1)): resolution of the original image.
+            additional_attributes (dict): additional sample attributes of the child class.
+
+        Returns:
+            dict: the sample, see __getitem__.
+        """
         hm_sigmas = self.sigmas
-        coords = self.target_coordinates[index]
-        full_res_coods = self.full_res_coordinates[index]
-        im_path = self.image_paths[index]
         run_time_debug = False
-        this_uid = self.uids[index]
-        is_annotation_available = self.annotation_available[index]
         x_y_corner = [0, 0]
-        image = self.load_function(self.images[index])
-
-        # If we cached the data, we don't need to get original image size. If not, we need to load it here.
-        if self.cache_data:
-            resized_factor = self.image_resizing_factors[index]
-            original_size = self.original_image_sizes[index]
-
-        else:
-            resized_factor, original_size, image, coords = load_and_resize_image(
-                image, coords, self.load_im_size, self.datatype_load, round=not (self.sample_mode == "patch_centred"), standardized=self.standardize_landmarks
-            )
 
         untransformed_coords = coords
         untransformed_im = image
@@ -888,13 +1092,15 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
                 ) = sample_patch_centred(untransformed_im, coords_to_centre_around, self.load_im_size, self.sample_patch_size, self.center_patch_jitter, self.debug, groundtruth_lms=untransformed_coords,
                                          deterministic=self.center_patch_deterministic, garuntee_gt_in=self.guarantee_landmarks_in_image, safe_padding=self.center_safe_padding)
 
-            kps = KeypointsOnImage(
-                [Keypoint(x=coo[0], y=coo[1]) for coo in untransformed_coords],
-                shape=untransformed_im[0].shape,
-            )
-
             # list where [0] is image and [1] are coords.
-            transformed_sample = self.transform(image=untransformed_im[0], keypoints=kps)
+            if self.data_augmentation_package == "fused":
+                transformed_sample = self.transform(untransformed_im[0], untransformed_coords)
+            else:
+                kps = KeypointsOnImage(
+                    [Keypoint(x=coo[0], y=coo[1]) for coo in untransformed_coords],
+                    shape=untransformed_im[0].shape,
+                )
+                transformed_sample = self.transform(image=untransformed_im[0], keypoints=kps)
 
             # image = (1,512,512)
             # heatmap for 1st landmark = (19, 1, 512 , 512)
@@ -916,7 +1122,10 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
             # label = self.transform(image=heatmap)
 
             input_image = normalize_cmr(transformed_sample[0], to_tensor=self.to_pytorch)
-            input_coords = np.array([[coo.x, coo.y] for coo in transformed_sample[1]])
+            if self.data_augmentation_package == "fused":
+                input_coords = transformed_sample[1]
+            else:
+                input_coords = np.array([[coo.x, coo.y] for coo in transformed_sample[1]])
 
             # Recalculate indicators incase transform pushed out/in coords.
             landmarks_in_indicator = [
@@ -973,8 +1182,7 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
         }
 
         # add additional sample attributes from child class.
-        for key_ in list(self.additional_sample_attributes.keys()):
-            sample[key_] = self.additional_sample_attributes[key_][index]
+        sample.update(additional_attributes)
 
         if self.debug or run_time_debug:
             self.logger.info("sample: %s", sample)
@@ -983,13 +1191,13 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
             )
         return sample
 
-    def generate_labels(self, landmarks, sigmas):
+    def generate_labels(self, landmarks, sigmas, x_y_corner=[0, 0]):
         """Generate heatmap labels using same method as in _get_item__.
-        Note, this does not work with patch-based yet (note the x_y_corner is hard coded as [0,0]. This is raised in argument checkers.)
 
         Args:
             landmarks (_type_): _description_
             sigmas (_type_): _description_
+            x_y_corner ([int, int], optional): top left of the sample's patch in the image. Defaults to [0, 0].
 
         Returns:
 
@@ -1006,8 +1214,6 @@ class DatasetBase(ABC, metaclass=DatasetMeta):
             for xy in landmarks
         ]
 
-        x_y_corner = [0, 0]
-
         return self.LabelGenerator.generate_labels(
             landmarks,
             x_y_corner,
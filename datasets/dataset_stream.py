@@ -0,0 +1,125 @@
+import io
+import os
+
+from torch.utils import data
+
+from datasets.dataset_base import DatasetBase
+from utils.data.load_data import get_datatype_load, get_datatype_name, load_and_resize_image, load_xlsx_coordinates
+from utils.data.shards import load_shard_index, read_shard
+
+
+class DatasetStream(DatasetBase, data.IterableDataset):
+    """
+    An iterable dataset that streams samples from sharded sample archives (see utils/data/shards.py) with sequential
+    reads, rather than indexing the datalist and opening every image file. Made for large, unannotated inference sets.
+
+    The shards of a split are read from dataset_args["stream_shards_dir"]/<split>. Each DataLoader worker reads its own
+    subset of the shards, and every sample is the same dictionary as DatasetBase.__getitem__ returns, in shard order.
+    Images are loaded on the fly, so cache_data, the image store and the LRU cache are not used.
+
+    Args:
+        Same as DatasetBase.
+    """
+
+    def __init__(self, **kwargs):
+
+        super(DatasetStream, self).__init__(**kwargs)
+
+    def index_samples(self, dataset_args):
+        """Read the shard index of this split instead of loading and indexing the datalist.
+
+        Args:
+            dataset_args (Dict): A dict of arguments for the generic dataset arguments.
+        """
+
+        split_dir = os.path.join(dataset_args["stream_shards_dir"], self.split)
+        shard_index = load_shard_index(split_dir)
+
+        # List of (shard path, number of samples to read from it), truncated to dataset_split_size samples.
+        self.shards = []
+        samples_left = shard_index["num_samples"] if self.dataset_split_size == -1 else self.dataset_split_size
+        for shard in shard_index["shards"]:
+            if samples_left <= 0:
+                break
+            self.shards.append((shard["path"], min(shard["num_samples"], samples_left)))
+            samples_left -= shard["num_samples"]
+        self.num_samples = sum([num_samples for _, num_samples in self.shards])
+
+        if self.cache_data:
+            self.logger.warning("Streaming %s data from shards, images will not be cached.", self.split)
+            self.cache_data = False
+            self.cache_compact = False
+
+        # Load functions by image type, the type is only known when a sample is read.
+        self.datatype_loads = {}
+        self.load_function = lambda img: img
+
+        # Maybe get external coordinates from xlsx for patch_centred sampling, for every uid in the workbook.
+        if self.center_patch_on_coords_path is not None:
+            all_uids, all_coordinates = load_xlsx_coordinates(
+                self.center_patch_on_coords_path,
+                sheet_name=self.center_patch_sheet if self.center_patch_sheet is not None else 0,
+            )
+            self.patch_centring_coords = dict(zip(all_uids.tolist(), all_coordinates[:, self.landmarks]))
+        else:
+            self.patch_centring_coords = None
+
+        self.logger.info(
+            "Streaming %s data from %s shards in %s. Length of %s", self.split, len(self.shards), split_dir, self.num_samples
+        )
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        # Overrides DatasetBase.__getitem__, which would index the datalist and open the image files.
+        raise TypeError("DatasetStream is iterable-only")
+
+    def __iter__(self):
+        """Stream the samples of this worker's shards. Worker i of n reads shards i, i+n, i+2n, ...
+
+        Yields:
+            dict: sample, see DatasetBase.__getitem__.
+        """
+        shards = self.shards
+        worker_info = data.get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        for shard_path, num_samples in shards:
+            for sample_number, (sample_data, image_bytes) in enumerate(read_shard(shard_path)):
+                if sample_number == num_samples:
+                    break
+                yield self.stream_sample(sample_data, image_bytes)
+
+    def get_stream_datatype_load(self, image_path):
+        datatype_name = get_datatype_name(image_path)
+        if datatype_name not in self.datatype_loads:
+            self.datatype_loads[datatype_name] = get_datatype_load(image_path, self.image_loader)
+        return self.datatype_loads[datatype_name]
+
+    def stream_sample(self, sample_data, image_bytes):
+        """Build a sample from a datalist entry and its image bytes read from a shard.
+
+        Args:
+            sample_data (dict): datalist entry of the sample.
+            image_bytes (bytes): raw bytes of the sample's image file.
+
+        Returns:
+            dict: sample, see DatasetBase.__getitem__.
+        """
+        interested_landmarks, full_res_coords, is_annotation_available = self.get_datalist_coordinates(sample_data)
+
+        resized_factor, original_size, image, coords = load_and_resize_image(
+            io.BytesIO(image_bytes),
+            interested_landmarks,
+            self.load_im_size,
+            self.get_stream_datatype_load(sample_data["image"]),
+            round=not (self.sample_mode == "patch_centred"),
+            standardized=self.standardize_landmarks,
+        )
+
+        additional_attributes = {key_: sample_data[key_] for key_ in self.additional_sample_attribute_keys}
+
+        return self.build_sample(image, coords, full_res_coords, sample_data["image"], sample_data["id"],
+                                 is_annotation_available, resized_factor, original_size, additional_attributes)
@@ -0,0 +1,132 @@
+import numpy as np
+
+
+class StringColumn:
+    """Column of strings stored as one UTF-8 byte buffer plus an offset array.
+
+    Two dense NumPy arrays rather than one Python str object per row, so pickling the column to DataLoader workers
+    is a couple of buffer copies and the memory does not depend on the longest string (unlike a fixed width "U" array).
+    """
+
+    def __init__(self, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.array([len(b) for b in encoded], dtype=np.int64), out=self.offsets[1:])
+        self.data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("String index %s out of range for column of length %s." % (index, len(self)))
+        return self.data[self.offsets[index]: self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def tolist(self):
+        return list(self)
+
+
+def uid_column(uids):
+    """Column of sample uids, keeping their type: an int64 array if they are all ints, else a StringColumn.
+
+    Args:
+        uids ([str] or [int]): sample unique ids, from the JSON file.
+
+    Returns:
+        np.array or StringColumn: the uids.
+    """
+    is_int = [isinstance(uid, (int, np.integer)) and not isinstance(uid, bool) for uid in uids]
+    if uids and all(is_int):
+        return np.array(uids, dtype=np.int64)
+    if any(is_int) or not all(isinstance(uid, str) for uid in uids):
+        # Keeping the uids apart would need a type per row. Mixing them is most likely a mistake anyway, as 1 and "1"
+        # would look like the same sample in the logs.
+        raise ValueError(
+            "Sample uids must be all strings or all integers, got types %s." % sorted({type(uid).__name__ for uid in uids})
+        )
+    return StringColumn(uids)
+
+
+class SampleTable:
+    """Columnar table of the per-sample attributes of a dataset, with a hash index from uid to row.
+
+    Every attribute is a dense NumPy column (StringColumn for the strings), indexed by the sample index:
+        uids (StringColumn or np.array): sample unique ids, an int64 array if they are all ints (see uid_column).
+        image_paths (StringColumn): image paths.
+        annotation_available (np.array, shape (N,)): whether each sample has annotations.
+        target_coordinates (np.array, shape (N, num_landmarks, 2)): coordinates at the loading resolution.
+        full_res_coordinates (np.array, shape (N, num_landmarks, 2)): coordinates at the original resolution.
+        image_resizing_factors (np.array, shape (N, 1, 2)): resizing factors, only if the images were loaded (cached).
+        original_image_sizes (np.array, shape (N, 2, 1)): original image sizes, only if the images were loaded (cached).
+    """
+
+    def __init__(
+        self,
+        uids,
+        image_paths,
+        annotation_available,
+        target_coordinates,
+        full_res_coordinates,
+        image_resizing_factors=None,
+        original_image_sizes=None,
+    ):
+        self.uids = uid_column(uids)
+        self.image_paths = StringColumn(image_paths)
+        self.annotation_available = np.array(annotation_available, dtype=bool)
+        self.target_coordinates = np.array(target_coordinates)
+        self.full_res_coordinates = np.array(full_res_coordinates)
+        self.image_resizing_factors = np.array(image_resizing_factors) if image_resizing_factors else None
+        self.original_image_sizes = np.array(original_image_sizes) if original_image_sizes else None
+
+        # Hash index from uid to row, the first row is kept if a uid is repeated (see duplicate_uids).
+        self.uid_index = {}
+        self._duplicate_rows = []
+        for row, uid in enumerate(self.uids.tolist()):
+            if uid in self.uid_index:
+                self._duplicate_rows.append(row)
+            else:
+                self.uid_index[uid] = row
+
+    def __len__(self):
+        return len(self.uids)
+
+    def get_uid(self, row):
+        """uid of a row, with its type from the JSON file (str or int).
+
+        Args:
+            row (int): sample index.
+
+        Returns:
+            str or int: sample uid.
+        """
+        uid = self.uids[row]
+        return uid.item() if isinstance(uid, np.generic) else uid
+
+    def row_of_uid(self, uid):
+        """Row of the sample with the given uid.
+
+        Args:
+            uid (str or int): sample uid.
+
+        Returns:
+            int: sample index.
+        """
+        return self.uid_index[uid]
+
+    def duplicate_uids(self):
+        """All rows whose uid is not unique, found in linear time from the uid index.
+
+        Returns:
+            [[str or int, str]]: [uid, image path] of every sample sharing its uid with another sample.
+        """
+        if not self._duplicate_rows:
+            return []
+
+        uids = self.uids.tolist()
+        duplicated = {uids[row] for row in self._duplicate_rows}
+        return [[uid, self.image_paths[row]] for row, uid in enumerate(uids) if uid in duplicated]
@@ -0,0 +1,83 @@
+import math
+
+import torch
+from torch.utils import data
+
+
+class RepeatedIndexSampler(data.Sampler):
+    """Samples each index `repeats` times in a row, so one image load can serve several patches.
+
+    Each pass draws ceil(N / repeats) indices (shuffled, without replacement) and repeats each of them, truncated to N
+    indices, so the epoch length is the same as a plain shuffled sampler of the dataset. Every image is still visited
+    over the passes, each pass drawing a new order. Datasets with patches_per_load > 1 keep their last loaded image, so
+    the repeats of an index only load it once (per DataLoader worker, see DatasetBase.__getitem__). Make the batch size
+    a multiple of repeats so the repeats of an index fall in the same batch, and so the same worker.
+
+    Args:
+        data_source (Dataset): dataset to sample from.
+        repeats (int): number of consecutive times each index is sampled.
+        shuffle (bool, optional): whether to shuffle the indices. Defaults to True.
+        generator (torch.Generator, optional): generator for the shuffling. Defaults to None.
+    """
+
+    def __init__(self, data_source, repeats, shuffle=True, generator=None):
+        assert repeats >= 1, "repeats must be at least 1, got %s." % repeats
+        self.data_source = data_source
+        self.repeats = repeats
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __iter__(self):
+        num_samples = len(self.data_source)
+        num_loads = math.ceil(num_samples / self.repeats)
+
+        if self.shuffle:
+            order = torch.randperm(num_samples, generator=self.generator)[:num_loads]
+        else:
+            order = torch.arange(num_loads)
+
+        return iter(order.repeat_interleave(self.repeats)[:num_samples].tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class InfiniteSampler(data.Sampler):
+    """Endless stream of indices, the passes of a finite sampler one after another (e.g. a new shuffle each pass).
+
+    A DataLoader over it never runs out, so one iterator serves the whole training: its workers keep prefetching
+    across passes and epochs, and an epoch is a fixed number of batches taken from the stream, continuing where the
+    previous epoch stopped. Batches may span two passes.
+
+    Args:
+        sampler (Sampler): finite sampler of one pass, e.g. RandomSampler or RepeatedIndexSampler.
+    """
+
+    def __init__(self, sampler):
+        assert len(sampler) > 0, "InfiniteSampler needs a non-empty sampler."
+        self.sampler = sampler
+
+    def __iter__(self):
+        while True:
+            yield from self.sampler
+
+
+def get_training_sampler(data_source, patches_per_load=1, infinite=True):
+    """Sampler of the training DataLoader: a shuffled pass of the dataset, with each index repeated patches_per_load
+    times if > 1, and endless passes if infinite.
+
+    Args:
+        data_source (Dataset): training dataset.
+        patches_per_load (int, optional): consecutive patches sampled from each loaded image. Defaults to 1.
+        infinite (bool, optional): whether to chain passes forever (see InfiniteSampler). Trainers iterating over the
+            DataLoader until it is exhausted (e.g. the GP trainers) need a single pass. Defaults to True.
+
+    Returns:
+        Sampler: the training sampler.
+    """
+    if patches_per_load > 1:
+        sampler = RepeatedIndexSampler(data_source, patches_per_load)
+    else:
+        sampler = data.RandomSampler(data_source)
+
+    return InfiniteSampler(sampler) if infinite else sampler
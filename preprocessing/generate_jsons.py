@@ -1023,6 +1023,8 @@ def ASPIRE_FOLLOWUP_to_JSON_careful(
     manual_omissions_uid,
     landmark_names,
     debug=False,
+    manifest_path=None,
+    num_workers=None,
 ):
     """
     Data source: https://drive.google.com/drive/u/0/folders/1NBLdv7-ohcy23RyqTPpVS1YG65rjPcAh
@@ -1030,6 +1032,10 @@ def ASPIRE_FOLLOWUP_to_JSON_careful(
     For each fold: 80% is training, 20% is validation, 20% is testing.
     We generate a final "deployment json" where 10% of all images are validation, the rest is training.
 
+    The earliest phase of each folder is found from the dicom headers by a pool of num_workers processes, and
+    remembered in the manifest at manifest_path (default output_path/scan_manifest.json) so reruns only scan new or
+    changed folders.
+
     """
 
     # TODO: Get all the patients from the image, not all patients have an annotation in the image.
@@ -1068,28 +1074,21 @@ def ASPIRE_FOLLOWUP_to_JSON_careful(
     # print("len of all dcms,", len(all_dcms))
     # exit()
 
-    for folder in all_folders:
-        print("\n \n Loading: ", folder)
-
-        # Get all dicoms from folder, and get the earliest phase (InstanceNumber)
-        dcm_phases = []  # list of dicom dataset objects (phases)
-        phase_files = glob.glob(folder + "/**/*.dcm", recursive=True)
-        for phase_file in phase_files:
-            dataset = dicom.dcmread(phase_file)
-            setattr(dataset, "file_path", phase_file)
-            dcm_phases.append(dataset)
+    # Get all dicoms from each folder, and get the earliest phase (InstanceNumber). Only new or changed folders are scanned.
+    if manifest_path is None:
+        manifest_path = os.path.join(output_path, "scan_manifest.json")
+    earliest_phases = scan_earliest_phases(all_folders, PreprocessingManifest(manifest_path), num_workers=num_workers)
 
-        # Sort by instance number to get earliest phase
-        dcm_phases.sort(key=lambda x: x.InstanceNumber, reverse=False)
-        ep_dcm = dcm_phases[0]
+    for folder, ep_dcm in zip(all_folders, earliest_phases):
+        print("\n \n Loading: ", folder)
 
-        suid = ep_dcm.SeriesInstanceUID
-        xnat_id = ep_dcm.PatientID
+        suid = ep_dcm["SeriesInstanceUID"]
+        xnat_id = ep_dcm["PatientID"]
 
         inner_dict = {}
         inner_dict["id"] = xnat_id
         inner_dict["suid"] = suid
-        inner_dict["image"] = ep_dcm.file_path
+        inner_dict["image"] = ep_dcm["file_path"]
         inner_dict["modality"] = modality
         inner_dict["landmark_names"] = landmark_names
 
@@ -1148,7 +1147,7 @@ def ASPIRE_FOLLOWUP_to_JSON_careful(
             print("inner dict: ", inner_dict)
             lm_coords = inner_dict["coordinates"]
             fig, ax = plt.subplots(1)
-            ax.imshow(ep_dcm.pixel_array)
+            ax.imshow(dicom.dcmread(ep_dcm["file_path"]).pixel_array)
             for lm in lm_coords:
                 rect1 = patches.Rectangle(
                     (int(lm[0]), int(lm[1])),
@@ -1171,18 +1170,21 @@ def ASPIRE_FOLLOWUP_to_JSON_careful(
 
     os.makedirs(output_path, exist_ok=True)
 
-    with open(output_path + "/fold0.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    atomic_write_json(output_path + "/fold0.json", data)
 
 
 def ASPIRE_LARGE_no_annotations(
-    path_to_images, output_path, modality, manual_omissions_uid, debug=False
+    path_to_images, output_path, modality, manual_omissions_uid, debug=False, manifest_path=None, num_workers=None
 ):
     """
     Data source: https://drive.google.com/drive/folders/1NKM87o8gkHmrPuQMOYVo_3-Dv0kgas69
     Generate json from annotations of followup ASPIRE dataset (~unknown images for SA ~unknown images for 4CH).
     For each fold: 100% is testing.
     We have no annotations.
+
+    The earliest phase of each folder is found from the dicom headers by a pool of num_workers processes, and
+    remembered in the manifest at manifest_path (default output_path/scan_manifest.json) so reruns only scan new or
+    changed folders.
     """
 
     assert modality in ["SA", "4ch", "4C"]
@@ -1209,30 +1211,23 @@ def ASPIRE_LARGE_no_annotations(
     # print("len of all dcms,", len(all_dcms))
     # exit()
 
-    for folder in all_folders:
-        print("\n \n Loading: ", folder)
-
-        # Get all dicoms from folder, and get the earliest phase (InstanceNumber)
-        dcm_phases = []  # list of dicom dataset objects (phases)
-        phase_files = glob.glob(folder + "/**/*.dcm", recursive=True)
-        for phase_file in phase_files:
-            dataset = dicom.dcmread(phase_file)
-            setattr(dataset, "file_path", phase_file)
-            dcm_phases.append(dataset)
+    # Get all dicoms from each folder, and get the earliest phase (InstanceNumber). Only new or changed folders are scanned.
+    if manifest_path is None:
+        manifest_path = os.path.join(output_path, "scan_manifest.json")
+    earliest_phases = scan_earliest_phases(all_folders, PreprocessingManifest(manifest_path), num_workers=num_workers)
 
-        # Sort by instance number to get earliest phase
-        dcm_phases.sort(key=lambda x: x.InstanceNumber, reverse=False)
-        ep_dcm = dcm_phases[0]
+    for folder, ep_dcm in zip(all_folders, earliest_phases):
+        print("\n \n Loading: ", folder)
 
-        suid = ep_dcm.SeriesInstanceUID
-        xnat_id = ep_dcm.PatientID
+        suid = ep_dcm["SeriesInstanceUID"]
+        xnat_id = ep_dcm["PatientID"]
 
         inner_dict = {}
         inner_dict["patient_id"] = xnat_id
         inner_dict["id"] = suid
         inner_dict["suid"] = suid
 
-        inner_dict["image"] = ep_dcm.file_path
+        inner_dict["image"] = ep_dcm["file_path"]
         inner_dict["modality"] = modality
         inner_dict["has_annotation"] = False
         inner_dict["coordinates"] = None
@@ -1240,8 +1235,7 @@ def ASPIRE_LARGE_no_annotations(
 
     os.makedirs(output_path, exist_ok=True)
 
-    with open(output_path + "/fold0.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    atomic_write_json(output_path + "/fold0.json", data)
 
 
 def combine_aspire_followup_to_train(
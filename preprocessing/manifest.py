@@ -0,0 +1,194 @@
+"""Manifest of preprocessed inputs, so that reruns of the preprocessing scripts only process new or changed inputs.
+
+The manifest records the path, size, mtime and content hash (sha1) of every source file of each converted item
+(e.g. a dicom converted to .npz, or the phases of a dicom folder scanned for a JSON datalist), with its outputs and
+an optional result to reuse. An item is reprocessed only if its sources or outputs changed. A source whose mtime
+changed but whose content did not (e.g. after a copy) is not reprocessed. Outputs are written atomically.
+
+Run the preprocessing scripts from the repository root as modules, e.g. python -m preprocessing.generate_jsons.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pydicom as dicom
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(path):
+    """Size, mtime and content hash of a file, as recorded in the manifest."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": file_sha1(path)}
+
+
+def _atomic_write(path, write_function, mode="wb"):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(mode, dir=directory, suffix=".tmp", delete=False) as tmp_f:
+        write_function(tmp_f)
+    os.replace(tmp_f.name, path)
+
+
+def atomic_write_json(path, data):
+    """json.dump data to path atomically, so readers never see a partially written file."""
+    _atomic_write(path, lambda f: json.dump(data, f, ensure_ascii=False, indent=4), mode="w")
+
+
+def atomic_save(path, array):
+    """np.save array to path (a raw .npy file) atomically, so readers never see a partially written file."""
+    _atomic_write(path, lambda f: np.save(f, array))
+
+
+def atomic_savez(path, *arrays):
+    """np.savez arrays to path atomically, so readers never see a partially written file."""
+    _atomic_write(path, lambda f: np.savez(f, *arrays))
+
+
+class PreprocessingManifest:
+    """Manifest of processed items, saved as JSON at manifest_path.
+
+    Each item (e.g. a source dicom or a dicom folder) is recorded under a key, with the fingerprints of its source
+    files, its output paths and an optional JSON-serializable result.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def is_up_to_date(self, key, source_paths, output_paths=()):
+        """Whether an item was processed from exactly these source files, none of them changed since, and all of
+        its outputs exist.
+
+        Args:
+            key (str): key of the item.
+            source_paths ([str]): source files of the item.
+            output_paths ([str], optional): output files of the item. Defaults to ().
+
+        Returns:
+            bool: True if the item does not need to be processed again.
+        """
+        entry = self.entries.get(key)
+        if entry is None or sorted(entry["sources"]) != sorted(source_paths):
+            return False
+
+        if not all(os.path.exists(path) for path in output_paths):
+            return False
+
+        for path in source_paths:
+            recorded = entry["sources"][path]
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return False
+
+            if stat.st_size != recorded["size"]:
+                return False
+            if stat.st_mtime_ns != recorded["mtime_ns"]:
+                # Touched or copied, only reprocess if the content changed.
+                if file_sha1(path) != recorded["sha1"]:
+                    return False
+                recorded["mtime_ns"] = stat.st_mtime_ns
+
+        return True
+
+    def get_result(self, key):
+        return self.entries[key]["result"]
+
+    def record(self, key, source_fingerprints, output_paths=(), result=None):
+        """Record a processed item.
+
+        Args:
+            key (str): key of the item.
+            source_fingerprints (dict): file_fingerprint of each source file, keyed by path.
+            output_paths ([str], optional): output files of the item. Defaults to ().
+            result (optional): JSON-serializable result of processing the item, to reuse. Defaults to None.
+        """
+        self.entries[key] = {"sources": source_fingerprints, "outputs": list(output_paths), "result": result}
+
+    def save(self):
+        atomic_write_json(self.manifest_path, self.entries)
+
+
+def read_earliest_phase(phase_files):
+    """Find the earliest phase (lowest InstanceNumber) of a dicom series, reading only the dicom headers.
+
+    Args:
+        phase_files ([str]): dicom files of the phases.
+
+    Returns:
+        dict: file_path, SeriesInstanceUID and PatientID of the earliest phase.
+    """
+    dcm_phases = []  # list of dicom dataset headers (phases)
+    for phase_file in phase_files:
+        dataset = dicom.dcmread(phase_file, stop_before_pixels=True)
+        dcm_phases.append((dataset.InstanceNumber, phase_file, dataset))
+
+    # Sort by instance number to get earliest phase
+    dcm_phases.sort(key=lambda x: x[0], reverse=False)
+    _, file_path, ep_dcm = dcm_phases[0]
+
+    return {
+        "file_path": file_path,
+        "SeriesInstanceUID": str(ep_dcm.SeriesInstanceUID),
+        "PatientID": str(ep_dcm.PatientID),
+    }
+
+
+def find_earliest_phase(folder):
+    """read_earliest_phase of the dicoms in a folder, searched recursively."""
+    return read_earliest_phase(glob.glob(folder + "/**/*.dcm", recursive=True))
+
+
+def scan_earliest_phase(phase_files):
+    """read_earliest_phase, also fingerprinting every phase file for the manifest.
+
+    Args:
+        phase_files ([str]): dicom files of the phases.
+
+    Returns:
+        (dict, dict): file_path, SeriesInstanceUID and PatientID of the earliest phase, and the file_fingerprint of
+         every phase file.
+    """
+    return read_earliest_phase(phase_files), {phase_file: file_fingerprint(phase_file) for phase_file in phase_files}
+
+
+def scan_earliest_phases(folders, manifest, num_workers=None):
+    """Find the earliest phase of the dicom series in each folder. Only folders that are new or changed since the last
+    scan recorded in the manifest are scanned, in parallel by a pool of num_workers processes.
+
+    Args:
+        folders ([str]): folders of the dicom phases, searched recursively.
+        manifest (PreprocessingManifest): manifest of previous scans, updated and saved.
+        num_workers (int, optional): number of processes. Defaults to None (number of CPUs).
+
+    Returns:
+        [dict]: file_path, SeriesInstanceUID and PatientID of the earliest phase of each folder.
+    """
+    phase_files = {folder: glob.glob(folder + "/**/*.dcm", recursive=True) for folder in folders}
+    to_scan = [folder for folder in folders if not manifest.is_up_to_date(folder, phase_files[folder])]
+    print("scanning %s new or changed folders of %s" % (len(to_scan), len(folders)))
+
+    if to_scan:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            scans = executor.map(scan_earliest_phase, [phase_files[folder] for folder in to_scan])
+            for folder, (earliest_phase, fingerprints) in zip(to_scan, scans):
+                manifest.record(folder, fingerprints, result=earliest_phase)
+    manifest.save()
+
+    return [manifest.get_result(folder) for folder in folders]
@@ -1,6 +1,7 @@
 import copy
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
 from re import U
 import numpy as np
 from os import listdir
@@ -20,6 +21,15 @@ import matplotlib.patches as patches
 import glob
 import json
 
+from preprocessing.manifest import (
+    PreprocessingManifest,
+    atomic_save,
+    atomic_savez,
+    atomic_write_json,
+    file_fingerprint,
+    find_earliest_phase,
+)
+
 
 def ASPIRE_FOLLOWUP_resize(
     path_to_annotations,
@@ -31,12 +41,16 @@ def ASPIRE_FOLLOWUP_resize(
     landmark_names,
     resize=[512, 512],
     debug=False,
+    num_workers=None,
 ):
 
     """
     Data source: https://drive.google.com/drive/u/0/folders/1NBLdv7-ohcy23RyqTPpVS1YG65rjPcAh
     Resizes the images to 512x512 and saves them in the output path. Also resize annotations
 
+    The folders are scanned in parallel by a pool of num_workers processes (default: number of CPUs), reading only the
+    dicom headers to find each folder's earliest phase. Pixel data is only decoded for the earliest phase.
+
     """
 
     # TODO: Get all the patients from the image, not all patients have an annotation in the image.
@@ -72,24 +86,16 @@ def ASPIRE_FOLLOWUP_resize(
     # print("len of all dcms,", len(all_dcms))
     # exit()
 
-    for folder in all_folders:
-        print("\n \n Loading: ", folder)
-
-        # Get all dicoms from folder, and get the earliest phase (InstanceNumber)
-        dcm_phases = []  # list of dicom dataset objects (phases)
-        phase_files = glob.glob(folder + "/**/*.dcm", recursive=True)
-        for phase_file in phase_files:
-            dataset = dicom.dcmread(phase_file)
-            setattr(dataset, "file_path", phase_file)
-            dcm_phases.append(dataset)
+    # Get all dicoms from each folder, and get the earliest phase (InstanceNumber) from their headers
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        earliest_phases = list(executor.map(find_earliest_phase, all_folders))
 
-        # Sort by instance number to get earliest phase
-        dcm_phases.sort(key=lambda x: x.InstanceNumber, reverse=False)
-        ep_dcm = dcm_phases[0]
+    for folder, earliest_phase in zip(all_folders, earliest_phases):
+        print("\n \n Loading: ", folder)
 
         # Basic info
-        suid = ep_dcm.SeriesInstanceUID
-        xnat_id = ep_dcm.PatientID
+        suid = earliest_phase["SeriesInstanceUID"]
+        xnat_id = earliest_phase["PatientID"]
         inner_dict = {}
         inner_dict["id"] = xnat_id
         inner_dict["suid"] = suid
@@ -142,8 +148,8 @@ def ASPIRE_FOLLOWUP_resize(
 
             inner_dict["coordinates"] = all_lms
 
-        # Potential resizings if image does not match desired size
-        ep_dcm_image = ep_dcm.pixel_array
+        # Potential resizings if image does not match desired size. Only decode the pixels of the earliest phase.
+        ep_dcm_image = dicom.dcmread(earliest_phase["file_path"]).pixel_array
         need_resize = False
         if ep_dcm_image.shape[0] != resize[0] or ep_dcm_image.shape[1] != resize[1]:
 
@@ -177,7 +183,7 @@ def ASPIRE_FOLLOWUP_resize(
 
         # Add new image path to json, we are saving ALL as an npz.
 
-        this_im_path = ep_dcm.file_path
+        this_im_path = earliest_phase["file_path"]
         print("the path to the image: ", this_im_path)
         inner_dict["image"] = (
             (this_im_path.split("Follow-up")[-1]).split(".dcm")[0] + ".npz"
@@ -254,6 +260,36 @@ def ASPIRE_FOLLOWUP_resize(
 # (path_to_annotations,root_path, output_path_anno, modality, debug=True)
 
 
+def convert_dicom_file(dicom_path, save_path, resize=None):
+    """Convert a .dcm to .npz (np.savez) or .npy (raw, memory-mappable), depending on the suffix of save_path.
+    Written atomically.
+
+    Args:
+        dicom_path (str): path to the dicom.
+        save_path (str): path to save the image to, ending with .npz or .npy.
+        resize ([int, int], optional): size [W, H] to resize the image to (with PIL, as the dataset loader does), or
+         None to keep the original size. Defaults to None.
+
+    Returns:
+        (dict, [int, int]): file_fingerprint of the source dicom (for the manifest) and the original image shape.
+    """
+    image = dicom.dcmread(dicom_path).pixel_array
+    original_shape = list(image.shape)
+
+    print("image shape ", image.shape)
+
+    if resize is not None and (image.shape[0] != resize[1] or image.shape[1] != resize[0]):
+        print(dicom_path, "wrong size, resizing", image.shape[0])
+        image = np.array(Image.fromarray(image).resize(resize))
+
+    print("save path: ", save_path)
+    if save_path.endswith(".npy"):
+        atomic_save(save_path, image)
+    else:
+        atomic_savez(save_path, image)
+    return file_fingerprint(dicom_path), original_shape
+
+
 def dicom_to_npz(
     path_to_annotations,
     root_path,
@@ -261,15 +297,33 @@ def dicom_to_npz(
     modality,
     resize=[512, 512],
     debug=False,
+    manifest_path=None,
+    num_workers=None,
+    output_format="npz",
+    resize_images=False,
 ):
 
     """
     Data source: https://drive.google.com/drive/u/0/folders/1NBLdv7-ohcy23RyqTPpVS1YG65rjPcAh
-    Changes .dcm to .npz.
+    Changes .dcm to .npz, or to raw .npy if output_format="npy". The .npy files are memory-mapped by the dataset loader
+    (see get_datatype_load), avoiding the zip extraction and copy of .npz on every read.
+
+    If resize_images, the images are resized to resize (e.g. the training resolution), saved with the suffix "_WxH",
+    and their coordinates rescaled, so the dataset loader does not need to resize them.
+
+    Only dicoms that are new or changed since the last run (recorded in the manifest at manifest_path, default
+    output_path_anno/dicom_to_npz_manifest.json) are converted, in parallel by a pool of num_workers processes.
 
     """
 
     assert modality in ["SA", "4ch"]
+    assert output_format in ["npz", "npy"]
+
+    if manifest_path is None:
+        manifest_path = os.path.join(output_path_anno, "dicom_to_npz_manifest.json")
+    manifest = PreprocessingManifest(manifest_path)
+    output_resize = resize if resize_images else None
+    output_suffix = ("_%sx%s." % tuple(resize) if resize_images else ".") + output_format
 
     print("path to ann", path_to_annotations)
     all_anno_files = glob.glob(path_to_annotations + "/*")
@@ -284,36 +338,52 @@ def dicom_to_npz(
             anno = json.loads(j.read())
 
         anno_split_name = anno_path.split("/")[-1]
+        to_convert = OrderedDict()  # save path -> dicom path, of dicoms not converted yet.
+        sample_save_paths = []  # (sample, save path) of all samples.
         for split in ["training", "validation", "testing"]:
 
             for sample in anno[split]:
 
-                image = dicom.dcmread(
-                    os.path.join(root_path, sample["image"])
-                ).pixel_array
-
-                print("image shape ", image.shape)
-
-                if image.shape[0] != resize[0] or image.shape[1] != resize[1]:
-                    print(sample, "wrong size, resizing", image.shape[0])
-
-                    # save the new dicom
-
+                dicom_path = os.path.join(root_path, sample["image"])
                 save_path_this_im = os.path.join(
-                    root_path, sample["image"].split(".dcm")[0] + ".npz"
+                    root_path, sample["image"].split(".dcm")[0] + output_suffix
                 )
-                # make_this_dir = '/'.join(save_path_this_im.split("/")[:-1])
-                print("save path: ", save_path_this_im)
-
-                np.savez(save_path_this_im, image)
-                sample["image"] = sample["image"].split(".dcm")[0] + ".npz"
+                # Keyed by the output, the same dicom may be converted to several formats and sizes.
+                if not manifest.is_up_to_date(save_path_this_im, [dicom_path], [save_path_this_im]):
+                    to_convert[save_path_this_im] = dicom_path
+
+                sample["image"] = sample["image"].split(".dcm")[0] + output_suffix
+                sample_save_paths.append((sample, save_path_this_im))
+
+        print("converting %s new or changed dicoms" % len(to_convert))
+        if to_convert:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                conversions = executor.map(
+                    convert_dicom_file, to_convert.values(), to_convert.keys(), [output_resize] * len(to_convert)
+                )
+                for (save_path_this_im, dicom_path), (fingerprint, original_shape) in zip(to_convert.items(), conversions):
+                    manifest.record(
+                        save_path_this_im, {dicom_path: fingerprint}, [save_path_this_im],
+                        result={"original_shape": original_shape}
+                    )
+        manifest.save()
+
+        # Rescale the coordinates of resized images.
+        if resize_images:
+            for sample, save_path_this_im in sample_save_paths:
+                if isinstance(sample.get("coordinates"), list):
+                    original_shape = manifest.get_result(save_path_this_im)["original_shape"]
+                    downscale_factor = [original_shape[1] / resize[0], original_shape[0] / resize[1]]
+                    sample["coordinates"] = [
+                        [lm[0] / downscale_factor[0], lm[1] / downscale_factor[1]] + list(lm[2:])
+                        for lm in sample["coordinates"]
+                    ]
 
         os.makedirs(output_path_anno, exist_ok=True)
 
         save_anno_to = os.path.join(output_path_anno, anno_split_name)
         print("saving to ", save_anno_to)
-        with open(save_anno_to, "w", encoding="utf-8") as f:
-            json.dump(anno, f, ensure_ascii=False, indent=4)
+        atomic_write_json(save_anno_to, anno)
 
 
 local = True
@@ -0,0 +1,104 @@
+import imgaug
+import imgaug.augmenters as iaa
+import numpy as np
+import pytest
+import torch
+from imgaug.augmentables import Keypoint, KeypointsOnImage
+
+from transforms.dataloader_transforms import FusedAffineTransform, get_batch_transforms, get_fused_transforms
+
+PATCH_SIZE = [64, 64]
+SAFE_PADDING = 32
+
+
+def _padded_patches(batch_size=4):
+    rng = np.random.default_rng(0)
+    size = [x + 2 * SAFE_PADDING for x in PATCH_SIZE]
+    y, x = np.mgrid[: size[1], : size[0]]
+    phases = rng.random((batch_size, 1, 1)) * 2 * np.pi
+    images = (2 + np.sin(x / 7 + phases) * np.cos(y / 5)).astype(np.float32)
+    coords = rng.random((batch_size, 5, 2)) * size
+    return images, coords
+
+
+def test_no_crop_keeps_patch_padding():
+    images, coords = _padded_patches()
+    image, transformed_coords = get_fused_transforms("NoCrop", PATCH_SIZE)(images[0], coords[0])
+    assert image.shape == images[0].shape
+    np.testing.assert_array_equal(image, images[0])
+    np.testing.assert_allclose(transformed_coords, coords[0])
+
+
+def test_batch_warp_of_padded_patches_matches_fused():
+    # The workers keep the safe padding (NoCrop), so the batch warp has the context the imgaug and fused packages warp
+    # before center cropping, instead of zero-filling the corners of rotated patches.
+    images, coords = _padded_patches()
+
+    imgaug.seed(3)
+    fused = get_fused_transforms("AffineComplex", PATCH_SIZE)
+    fused_samples = [fused(image, coord) for image, coord in zip(images, coords)]
+
+    imgaug.seed(3)
+    batch_images, batch_coords = get_batch_transforms("AffineComplex", PATCH_SIZE)(
+        torch.from_numpy(images[:, None]), torch.from_numpy(coords))
+
+    assert batch_images.shape == (len(images), 1, PATCH_SIZE[1], PATCH_SIZE[0])
+    for (image, coord), batch_image, batch_coord in zip(fused_samples, batch_images, batch_coords):
+        np.testing.assert_allclose(batch_coord.numpy(), coord, atol=1e-6)
+        # No zero-filled corners: the padded patches are non-zero everywhere the warp reads from.
+        assert np.count_nonzero(image == 0) == 0
+        normalized = (image - image.mean()) / image.std()
+        assert np.abs(batch_image[0].numpy() - normalized).mean() < 0.02
+
+
+AFFINE_PARAMETERS = [
+    # scale x, scale y, translate x, translate y, rotate, shear, order, flip
+    (1.1, 0.9, 0.05, -0.03, 30, 10, 1, True),
+    (0.85, 1.15, -0.07, 0.07, -40, -16, 1, False),
+    (1.0, 1.0, 0.0, 0.0, 0, 0, 1, True),
+    (1.2, 1.2, 0.02, 0.01, 12, 5, 0, True),
+]
+
+
+@pytest.mark.parametrize("image_size", [(96, 96), (101, 90), (80, 60)])
+@pytest.mark.parametrize("scale_x, scale_y, translate_x, translate_y, rotate, shear, order, flip", AFFINE_PARAMETERS)
+def test_fused_matches_imgaug_pipeline(image_size, scale_x, scale_y, translate_x, translate_y, rotate, shear, order,
+                                       flip):
+    # Fix the sampled parameters of both pipelines, so they compare the geometry, flip order and crop offsets.
+    height, width = image_size
+    y, x = np.mgrid[:height, :width]
+    image = (2 + np.sin(x / 7) * np.cos(y / 5) + 0.3 * np.sin((x + y) / 3)).astype(np.float32)
+    coords = np.random.default_rng(0).uniform(0, [width, height], (6, 2))
+
+    sequence = iaa.Sequential([
+        iaa.Affine(
+            scale={"x": scale_x, "y": scale_y},
+            translate_percent={"x": translate_x, "y": translate_y},
+            rotate=rotate,
+            shear=shear,
+            order=order,
+        ),
+        iaa.flip.Flipud(p=float(flip)),
+        iaa.CenterCropToFixedSize(PATCH_SIZE[0], PATCH_SIZE[1]),
+    ])
+    imgaug_image, imgaug_keypoints = sequence(
+        image=image, keypoints=KeypointsOnImage([Keypoint(*coord) for coord in coords], shape=image.shape))
+
+    fused = FusedAffineTransform(
+        PATCH_SIZE,
+        affine_p=1.0,
+        scale={"x": (scale_x, scale_x), "y": (scale_y, scale_y)},
+        translate_percent={"x": (translate_x, translate_x), "y": (translate_y, translate_y)},
+        rotate=(rotate, rotate),
+        shear=(shear, shear),
+        orders=[order],
+        flipud_p=float(flip),
+    )
+    fused_image, fused_coords = fused(image, coords)
+
+    assert fused_image.shape == imgaug_image.shape
+    np.testing.assert_allclose(fused_coords, imgaug_keypoints.to_xy_array(), atol=1e-4)
+    # The warps differ by float rounding, which flips a few nearest neighbour ties.
+    difference = np.abs(fused_image - imgaug_image)
+    assert difference.mean() < 1e-3
+    assert difference.max() < 0.1
@@ -0,0 +1,132 @@
+import math
+
+import numpy as np
+import pytest
+import torch
+
+from transforms.generate_labels import UNetLabelGenerator, gaussian_gen, gaussian_gen_windowed, gen_patch_displacements
+
+
+def _scalar_patch_displacements(landmark, grid_size, maxpooling_factor, log_transform_displacements_bool, clamp_dist):
+    """The nested loop gen_patch_displacements_heatmap used before gen_patch_displacements (square grids)."""
+    patches = [grid_size[0] // 2**maxpooling_factor, grid_size[1] // 2**maxpooling_factor]
+    step_size = 2**maxpooling_factor
+
+    x_y_displacements = np.zeros((2, patches[0], patches[1]), dtype=np.float32)
+    for x_idx, x in enumerate(range(0, grid_size[0], step_size)):
+        for y_idx, y in enumerate(range(0, grid_size[0], step_size)):
+            center_xy = [x + (step_size // 2), y + (step_size // 2)]
+
+            distance_y = max(0.000001, abs(landmark[1] - center_xy[1]))
+            distance_x = max(0.000001, abs(landmark[0] - center_xy[0]))
+
+            if clamp_dist != None:
+                n = math.sqrt(distance_x**2 + distance_y**2)
+                if n != 0:
+                    f = min(n, clamp_dist) / n
+                else:
+                    f = 1
+                distance_x, distance_y = [f * distance_x, f * distance_y]
+
+            if log_transform_displacements_bool:
+                distance_x, distance_y = math.log(distance_x, 2), math.log(distance_y, 2)
+
+            if landmark[1] > center_xy[1]:
+                displace_y = distance_y
+            elif landmark[1] < center_xy[1]:
+                displace_y = -distance_y
+            else:
+                displace_y = 0
+
+            if landmark[0] > center_xy[0]:
+                displace_x = distance_x
+            elif landmark[0] < center_xy[0]:
+                displace_x = -distance_x
+            else:
+                displace_x = 0
+
+            x_y_displacements[:, x_idx, y_idx] = [displace_x, displace_y]
+
+    return x_y_displacements
+
+
+@pytest.mark.parametrize("log_transform_displacements_bool", [True, False])
+@pytest.mark.parametrize("clamp_dist", [None, 48, 16])
+@pytest.mark.parametrize("grid_size, maxpooling_factor", [(64, 2), (128, 3), (128, 4)])
+def test_patch_displacements_match_scalar_loop(log_transform_displacements_bool, clamp_dist, grid_size, maxpooling_factor):
+    rng = np.random.default_rng(0)
+    step_size = 2**maxpooling_factor
+    landmarks = np.concatenate([
+        rng.random((8, 2)) * grid_size,
+        rng.random((2, 2)) * 3 * grid_size - grid_size,  # off the grid
+        rng.integers(0, grid_size // step_size, (2, 2)) * step_size + step_size // 2,  # on sub-patch centres
+        rng.integers(0, grid_size, (2, 2)).astype(np.float64),
+    ])
+
+    displacements = gen_patch_displacements(
+        landmarks, [grid_size, grid_size], maxpooling_factor, log_transform_displacements_bool, clamp_dist
+    )
+
+    assert displacements.dtype == np.float32
+    for landmark, landmark_displacements in zip(landmarks, displacements):
+        expected = _scalar_patch_displacements(
+            landmark, [grid_size, grid_size], maxpooling_factor, log_transform_displacements_bool, clamp_dist
+        )
+        if log_transform_displacements_bool:
+            # np.log2 and math.log(x, 2) round differently.
+            np.testing.assert_allclose(landmark_displacements, expected, rtol=1e-6, atol=1e-6)
+        else:
+            np.testing.assert_array_equal(landmark_displacements, expected)
+
+
+@pytest.mark.parametrize("std", [0.25, 0.5, 1.0, 2.5, 4.0, 8.0, 20.0, 64.0])
+@pytest.mark.parametrize("resolution", [[64, 64], [96, 40], [512, 512], [8, 8]])
+def test_gaussian_gen_windowed_matches_gaussian_gen(std, resolution):
+    width, height = resolution
+    landmarks = [
+        [0, 0], [width - 1, height - 1], [0, height - 1], [width - 1, 0], [width // 2, height // 3], [1, height // 2],
+        [width + 3, height // 2],  # outside the heatmap
+        [width / 2 + 0.5, height / 3],  # not integer
+    ]
+    for landmark in landmarks:
+        landmark = np.array(landmark, dtype=np.float64)
+        expected = gaussian_gen(landmark, resolution, 1, std).astype(np.float32)
+        heatmap = gaussian_gen_windowed(np.full((height, width), np.nan, dtype=np.float32), landmark, std)
+
+        # Exactly the same -1 underflow region and zeros, values up to float64 rounding of the normalisation.
+        np.testing.assert_array_equal(heatmap == -1, expected == -1)
+        np.testing.assert_array_equal(heatmap == 0, expected == 0)
+        np.testing.assert_allclose(heatmap, expected, rtol=1e-6, atol=0)
+
+
+@pytest.mark.parametrize("input_size", [[64, 48], [128, 128], [75, 90]])
+def test_unet_labels_batch_matches_per_sample(input_size):
+    rng = np.random.default_rng(0)
+    batch_size, num_landmarks, num_res_supervisions = 4, 6, 4
+    landmarks = rng.uniform(-10, [input_size[0] + 10, input_size[1] + 10], (batch_size, num_landmarks, 2))
+    landmarks[0, 0] = [-5, 3]
+    landmarks[1, 1] = [input_size[0] + 2, 4]
+    landmarks[2, 2] = [0, 0]
+    landmarks[3, 3] = [input_size[0] - 1, input_size[1] - 1]
+    landmarks_in_indicator = ((landmarks >= 0) & (landmarks < input_size)).all(axis=-1).astype(int)
+    landmarks_in_indicator[0, 0] = 1  # a heatmap for a landmark outside the image
+    hm_sigmas = rng.uniform(0.5, 6, num_landmarks)
+
+    label_generator = UNetLabelGenerator()
+    per_sample = [
+        label_generator.generate_labels(
+            landmarks[b], None, landmarks_in_indicator[b], input_size, hm_sigmas, num_res_supervisions)["heatmaps"]
+        for b in range(batch_size)
+    ]
+    batch = label_generator.generate_labels_batch(
+        torch.from_numpy(landmarks), None, torch.from_numpy(landmarks_in_indicator), input_size,
+        torch.from_numpy(hm_sigmas), num_res_supervisions)["heatmaps"]
+
+    assert len(batch) == num_res_supervisions
+    for level, heatmaps in enumerate(batch):
+        expected = torch.stack([sample_heatmaps[level] for sample_heatmaps in per_sample])
+        assert heatmaps.shape == expected.shape and heatmaps.dtype == expected.dtype
+        assert torch.equal(heatmaps == -1, expected == -1)
+        assert not heatmaps[torch.from_numpy(landmarks_in_indicator) == 0].any()
+        # Float32 rounding of the outer product, one ulp at the peak (hm_lambda_scale 100).
+        torch.testing.assert_close(heatmaps, expected, rtol=1e-6, atol=1e-5)
@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+import torch
+from torchvision.transforms import InterpolationMode, Resize
+
+from utils.im_utils.heatmap_manipulation import (
+    bicubic_resize_matrix,
+    candidate_smoothing,
+    candidate_smoothing_batch,
+    get_coords,
+    get_coords_fit_gauss,
+    get_coords_fit_gauss_batch,
+    get_coords_resized_roi,
+)
+
+
+def _phdnet_output(batch_size, num_landmarks, grid, maxpool_factor, log_displacement_bool, seed=0):
+    """Random patch heatmaps and displacements voting around a target per landmark, some votes out of the image."""
+    rng = np.random.default_rng(seed)
+    step_size = 2**maxpool_factor
+    full_resolution = grid * step_size
+
+    heatmaps = rng.random((batch_size, num_landmarks, grid, grid)).astype(np.float32)
+    centers = np.arange(grid) * step_size + step_size // 2
+    targets = rng.random((batch_size, num_landmarks, 2, 1, 1)) * 1.2 * full_resolution - 0.1 * full_resolution
+    displacements = np.stack(np.broadcast_arrays(
+        targets[:, :, 0] - centers[:, None], targets[:, :, 1] - centers[None, :]), axis=2)
+    displacements += rng.normal(0, 2, displacements.shape)
+    if log_displacement_bool:
+        displacements = np.sign(displacements) * np.log2(np.maximum(np.abs(displacements), 1e-6))
+    return heatmaps, displacements.astype(np.float32), [full_resolution, full_resolution]
+
+
+@pytest.mark.parametrize("log_displacement_bool", [True, False])
+@pytest.mark.parametrize("grid, maxpool_factor", [(16, 2), (16, 3), (32, 3)])
+def test_candidate_smoothing_batch_matches_per_sample(log_displacement_bool, grid, maxpool_factor):
+    heatmaps, displacements, full_resolution = _phdnet_output(3, 4, grid, maxpool_factor, log_displacement_bool)
+
+    batch_maps = candidate_smoothing_batch(
+        [torch.from_numpy(heatmaps), torch.from_numpy(displacements)], full_resolution, maxpool_factor,
+        log_displacement_bool=log_displacement_bool,
+    )
+    sample_maps = torch.stack([
+        candidate_smoothing([sample_heatmaps, sample_displacements], full_resolution, maxpool_factor,
+                            log_displacement_bool=log_displacement_bool)
+        for sample_heatmaps, sample_displacements in zip(heatmaps, displacements)
+    ])
+
+    assert batch_maps.shape == sample_maps.shape
+    # Landmarks whose votes all fall out of the image have empty maps.
+    scale = sample_maps.abs().amax(dim=(2, 3), keepdim=True).clamp(min=1e-12)
+    assert ((batch_maps.double() - sample_maps.double()).abs() / scale).max() < 1e-5
+    assert torch.equal(get_coords(batch_maps)[0], get_coords(sample_maps.to(batch_maps.dtype))[0])
+
+
+def _gaussian_heatmaps(batch_size, num_landmarks, height, width, noise, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    y = torch.arange(height, dtype=torch.float32)[:, None]
+    x = torch.arange(width, dtype=torch.float32)[None, :]
+    centers = torch.rand(batch_size, num_landmarks, 2, 1, 1, generator=generator) * torch.tensor(
+        [width - 1, height - 1]).view(2, 1, 1)
+    sigmas = 1.5 + 4 * torch.rand(batch_size, num_landmarks, 1, 1, generator=generator)
+    heatmaps = torch.exp(-((x - centers[:, :, 0]) ** 2 + (y - centers[:, :, 1]) ** 2) / (2 * sigmas**2))
+    return heatmaps + noise * torch.randn(heatmaps.shape, generator=generator)
+
+
+@pytest.mark.parametrize("antialias", [True, False])
+@pytest.mark.parametrize("input_size, output_size, noise", [
+    ([64, 64], [387, 480], 0.0),
+    ([64, 64], [387, 480], 0.02),
+    ([64, 80], [700, 350], 0.02),
+    ([64, 64], [50, 45], 0.02),  # downsampling
+    ([32, 32], [32, 32], 0.0),
+])
+def test_resized_roi_coords_match_full_resize(monkeypatch, antialias, input_size, output_size, noise):
+    import utils.im_utils.heatmap_manipulation as heatmap_manipulation
+
+    def resize(size, interpolation):
+        return Resize(size, interpolation=interpolation, antialias=antialias)
+
+    # The ROI resize uses the same Resize as the full resize, with or without antialiasing.
+    monkeypatch.setattr(heatmap_manipulation, "Resize", resize)
+    heatmap_manipulation.bicubic_resize_matrix.cache_clear()
+    heatmaps = _gaussian_heatmaps(3, 5, input_size[0], input_size[1], noise)
+
+    expected_coords, expected_max = get_coords(resize(output_size, InterpolationMode.BICUBIC)(heatmaps))
+    coords, max_values = get_coords_resized_roi(heatmaps, output_size)
+    heatmap_manipulation.bicubic_resize_matrix.cache_clear()
+
+    assert torch.equal(coords, expected_coords)
+    torch.testing.assert_close(max_values, expected_max, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("input_size, output_size", [([64, 64], [387, 480]), ([64, 80], [50, 45])])
+def test_bicubic_resize_matrix_matches_resize(input_size, output_size):
+    heatmaps = _gaussian_heatmaps(2, 3, input_size[0], input_size[1], noise=0.02)
+    resize_height = bicubic_resize_matrix(input_size[0], output_size[0], heatmaps.device)
+    resize_width = bicubic_resize_matrix(input_size[1], output_size[1], heatmaps.device)
+
+    expected = Resize(output_size, interpolation=InterpolationMode.BICUBIC)(heatmaps)
+    torch.testing.assert_close(resize_height @ heatmaps @ resize_width.T, expected, rtol=1e-4, atol=1e-5)
+
+
+def _twod_gaussian_heatmap(size, x0, y0, sigma_x, sigma_y, theta, amplitude=60.0):
+    """Gaussian in the coordinates get_coords_fit_gauss fits on, np.linspace(0, size, size)."""
+    y, x = np.mgrid[:size, :size] * (size / (size - 1))
+    a = np.cos(theta) ** 2 / (2 * sigma_x**2) + np.sin(theta) ** 2 / (2 * sigma_y**2)
+    b = -np.sin(2 * theta) / (4 * sigma_x**2) + np.sin(2 * theta) / (4 * sigma_y**2)
+    c = np.sin(theta) ** 2 / (2 * sigma_x**2) + np.cos(theta) ** 2 / (2 * sigma_y**2)
+    return amplitude * np.exp(-(a * (x - x0) ** 2 + 2 * b * (x - x0) * (y - y0) + c * (y - y0) ** 2))
+
+
+def _fit_gauss_heatmaps(size=128, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "peaked": _twod_gaussian_heatmap(size, 50.3, 70.8, 4, 2.5, 0.4),
+        "peaked_noise": _twod_gaussian_heatmap(size, 80.2, 40.6, 3, 5, -0.7) + rng.normal(0, 2, (size, size)),
+        "border": _twod_gaussian_heatmap(size, 1.5, 60.2, 4, 3, 0.2),
+        "corner": _twod_gaussian_heatmap(size, size - 2, size - 1.5, 3, 3.5, 0),
+        # Fits the windowed fit cannot be trusted with, refitted over the whole heatmap.
+        "broad": _twod_gaussian_heatmap(size, 64, 60, 30, 25, 0.3),
+        "flat": np.full((size, size), 0.2),
+        "flat_noise": 0.2 + rng.normal(0, 0.01, (size, size)),
+    }
+
+
+@pytest.mark.parametrize("window_radius", [16, 32])
+def test_fit_gauss_batch_matches_full_fit(window_radius):
+    heatmaps = _fit_gauss_heatmaps()
+    images = torch.tensor(np.stack(list(heatmaps.values())))[None].float()
+    predicted_coords, _ = get_coords(images)
+
+    coords, _, fitted_dicts = get_coords_fit_gauss_batch(images, predicted_coords, window_radius=window_radius)
+
+    for hm_idx, name in enumerate(heatmaps):
+        expected_coords, _, expected_dicts = get_coords_fit_gauss(
+            images[:, hm_idx: hm_idx + 1], predicted_coords[:, hm_idx: hm_idx + 1])
+        covariance = np.array(fitted_dicts[0][hm_idx]["covariance"])
+        expected_covariance = np.array(expected_dicts[0][0]["covariance"])
+
+        if name == "peaked_noise":
+            # The noise outside the window is not fitted.
+            np.testing.assert_allclose(coords[0][hm_idx], expected_coords[0][0], atol=1e-2)
+            np.testing.assert_allclose(covariance, expected_covariance, rtol=0.05, atol=0.05)
+        else:
+            np.testing.assert_allclose(coords[0][hm_idx], expected_coords[0][0], atol=1e-3)
+            np.testing.assert_allclose(covariance, expected_covariance, rtol=1e-3, atol=1e-3)
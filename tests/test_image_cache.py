@@ -0,0 +1,81 @@
+import json
+
+import numpy as np
+import pytest
+
+from datasets.dataset_generic import DatasetGeneric
+from transforms.generate_labels import UNetLabelGenerator
+from utils.data.image_cache import PROCESS_IMAGE_STORE, ProcessImageStore
+
+NUM_LANDMARKS = 2
+
+
+@pytest.fixture
+def dataset_root(tmp_path):
+    rng = np.random.default_rng(0)
+    items = []
+    for i in range(4):
+        np.savez(tmp_path / f"im{i}.npz", rng.integers(0, 4000, size=(80, 96)).astype(np.uint16))
+        items.append({"id": f"u{i}", "image": f"im{i}.npz", "coordinates": rng.uniform(5, 70, (NUM_LANDMARKS, 2)).tolist()})
+    with open(tmp_path / "fold0.json", "w") as f:
+        json.dump({"training": items, "validation": items[:2], "testing": items[:2]}, f)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def process_image_store():
+    PROCESS_IMAGE_STORE.clear()
+    yield PROCESS_IMAGE_STORE
+    PROCESS_IMAGE_STORE.clear()
+
+
+def _dataset(root, split, image_loader="pil", cache_shared_memory=True):
+    dataset_args = {
+        "landmarks": list(range(NUM_LANDMARKS)), "annotation_path": root, "image_modality": "CMRI", "root_path": root,
+        "fold": 0, "dataset_split_size": -1, "standardize_landmarks": False, "image_store_dir": None,
+        "image_loader": image_loader, "cache_loading_workers": 0, "cache_loading_pool": "process",
+        "cache_shared_memory": cache_shared_memory, "lru_cache_budget_mb": 0, "share_cache_across_datasets": True,
+        "cache_compact": False, "stream_shards_dir": None,
+    }
+    patch_sampler_args = {
+        "generic": {"sample_patch_size": [32, 32], "sample_patch_from_resolution": [32, 32], "patches_per_load": 1},
+        "biased": {"sampling_bias": 0.66},
+        "centred": {"xlsx_path": None, "xlsx_sheet": None, "center_patch_jitter": 0.0, "deterministic": True,
+                    "safe_padding": 5},
+    }
+    data_aug_args = {"data_augmentation_strategy": None, "data_augmentation_package": "imgaug",
+                     "guarantee_lms_image": False}
+    return DatasetGeneric(
+        LabelGenerator=UNetLabelGenerator(), split=split, sample_mode="full", patch_sampler_args=patch_sampler_args,
+        dataset_args=dataset_args, data_aug_args=data_aug_args,
+        label_generator_args={"generate_heatmaps_here": True, "hm_lambda_scale": 100.0},
+        sigmas=[np.array(2.0)] * NUM_LANDMARKS, cache_data=True, num_res_supervisions=1, input_size=[32, 32],
+    )
+
+
+def test_process_image_store_keys_on_image_loader():
+    store = ProcessImageStore()
+    entry = (np.ones((1, 2)), np.ones((2, 1)), np.zeros((1, 4, 4)))
+    store.add("im0.npz", [4, 4], entry, image_loader="pil")
+
+    assert store.get("im0.npz", [4, 4], image_loader="pil") is entry
+    assert store.get("im0.npz", [4, 4], image_loader="array") is None
+
+
+def test_image_loaders_are_cached_separately(dataset_root, process_image_store):
+    _dataset(dataset_root, "training", image_loader="pil", cache_shared_memory=False)
+    _dataset(dataset_root, "training", image_loader="array", cache_shared_memory=False)
+    assert len(process_image_store) == 8
+
+
+def test_shared_memory_store_holds_views_of_the_shared_block(dataset_root, process_image_store):
+    training = _dataset(dataset_root, "training")
+    testing = _dataset(dataset_root, "testing")
+
+    assert len(process_image_store) == 4
+    for image_path, block in [("im0.npz", testing.images.block), ("im3.npz", training.images.block)]:
+        entry = process_image_store.get(f"{dataset_root}/{image_path}", [32, 32])
+        assert np.shares_memory(entry[2], block.numpy())
+
+    # The testing dataset copied its images from the store.
+    np.testing.assert_array_equal(testing.images.block.numpy(), training.images.block.numpy()[:2])
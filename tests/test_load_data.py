@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.data.load_data import load_and_resize_image, load_and_resize_image_array
+
+COORDS = np.array([[10.0, 20.0], [150.0, 40.0]])
+SIZES = [
+    ((1935, 2400), [512, 512]),  # downsampling, the common case
+    ((300, 200), [512, 512]),  # upsampling
+    ((512, 512), [256, 300]),  # anisotropic
+    ((64, 64), [512, 512]),
+]
+
+
+def _unsaturated_image(height, width, max_value, dtype, seed=0):
+    """Smooth image plus noise that stays away from the dtype's range, so PIL never clips the bicubic overshoot."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:height, :width]
+    image = (0.5 + 0.3 * np.sin(x / 17.0) * np.cos(y / 23.0)) * max_value
+    image += rng.normal(0, 0.02 * max_value, (height, width))
+    return np.round(np.clip(image, 0, max_value)).astype(dtype)
+
+
+def _pil_and_array(image, load_im_size):
+    pil = load_and_resize_image(None, COORDS, load_im_size, lambda path: Image.fromarray(image))
+    array = load_and_resize_image_array(image.astype(np.float32), COORDS, load_im_size)
+    return pil, array
+
+
+@pytest.mark.parametrize("image_size, load_im_size", SIZES)
+@pytest.mark.parametrize("dtype, max_value", [(np.uint16, 4095), (np.uint16, 65535), (np.uint8, 255)])
+def test_array_loader_within_one_grey_level_of_pil(image_size, load_im_size, dtype, max_value):
+    image = _unsaturated_image(*image_size, max_value, dtype)
+    pil, array = _pil_and_array(image, load_im_size)
+
+    for pil_output, array_output in zip([pil[0], pil[1], pil[3]], [array[0], array[1], array[3]]):
+        np.testing.assert_array_equal(pil_output, array_output)
+    assert array[2].dtype == np.float32 and array[2].shape == pil[2].shape
+
+    # PIL resizes integer images with fixed-point weights and rounds the result, so the images differ by about one
+    # grey level, i.e. 1 / std of the resized image once normalized.
+    raw_std = load_and_resize_image_array(image.astype(np.float32), COORDS, load_im_size, normalize=False)[2].std()
+    assert np.abs(pil[2] - array[2]).max() < 1.5 / raw_std
+
+
+@pytest.mark.parametrize("image_size, load_im_size", SIZES)
+def test_array_loader_matches_pil_on_float_images(image_size, load_im_size):
+    image = _unsaturated_image(*image_size, 1000.0, np.float32)
+    image += np.random.default_rng(1).random(image.shape, dtype=np.float32)
+    pil, array = _pil_and_array(image, load_im_size)
+
+    np.testing.assert_allclose(array[2], pil[2], rtol=0, atol=1e-5)
@@ -0,0 +1,61 @@
+import numpy as np
+from scipy import stats
+
+from utils.im_utils.patch_helpers import landmarks_in_patch, sample_landmark_patch_corner
+
+LOAD_IM_SIZE = [40, 36]
+SAMPLE_PATCH_SIZE = [16, 16]
+LANDMARKS = [[5.5, 30.0], [12.0, 14.25], [14.0, 17.0], [39.0, 2.0]]
+NUM_DRAWS = 20000
+
+
+def _rejection_patch_corner(landmarks, load_im_size, sample_patch_size, lm_safe_region=0):
+    """The rejection loop sample_patch_with_bias used before sample_landmark_patch_corner."""
+    landmarks_in_indicator = []
+    while 1 not in landmarks_in_indicator:
+        y_rand = np.random.randint(0, load_im_size[1] - sample_patch_size[1])
+        x_rand = np.random.randint(0, load_im_size[0] - sample_patch_size[0])
+        landmarks_in_indicator = landmarks_in_patch(landmarks, [x_rand, y_rand], sample_patch_size, lm_safe_region)
+    return [x_rand, y_rand]
+
+
+def _corner_counts(sampler, seed, lm_safe_region=0):
+    np.random.seed(seed)
+    grid_width = LOAD_IM_SIZE[0] - SAMPLE_PATCH_SIZE[0]
+    grid_height = LOAD_IM_SIZE[1] - SAMPLE_PATCH_SIZE[1]
+    counts = np.zeros((grid_width, grid_height), dtype=np.int64)
+    for _ in range(NUM_DRAWS):
+        x, y = sampler(LANDMARKS, LOAD_IM_SIZE, SAMPLE_PATCH_SIZE, lm_safe_region)
+        counts[x, y] += 1
+    return counts
+
+
+def _valid_corners(lm_safe_region=0):
+    grid_width = LOAD_IM_SIZE[0] - SAMPLE_PATCH_SIZE[0]
+    grid_height = LOAD_IM_SIZE[1] - SAMPLE_PATCH_SIZE[1]
+    return np.array([
+        [1 in landmarks_in_patch(LANDMARKS, [x, y], SAMPLE_PATCH_SIZE, lm_safe_region) for y in range(grid_height)]
+        for x in range(grid_width)
+    ])
+
+
+def test_patch_corner_distribution_matches_rejection_sampling():
+    for lm_safe_region in [0, 3]:
+        valid = _valid_corners(lm_safe_region)
+        new_counts = _corner_counts(sample_landmark_patch_corner, 0, lm_safe_region)
+        old_counts = _corner_counts(_rejection_patch_corner, 1, lm_safe_region)
+
+        # Same support: only corners whose patch contains a landmark.
+        assert not new_counts[~valid].any()
+        assert not old_counts[~valid].any()
+
+        # Both uniform over the valid corners, and not distinguishable from each other.
+        for counts in [new_counts, old_counts]:
+            assert stats.chisquare(counts[valid]).pvalue > 0.001
+        table = np.stack([new_counts[valid], old_counts[valid]])
+        assert stats.chi2_contingency(table).pvalue > 0.001
+
+
+def test_patch_corner_none_without_landmark_patches():
+    np.random.seed(0)
+    assert sample_landmark_patch_corner([[-100.0, -100.0]], LOAD_IM_SIZE, SAMPLE_PATCH_SIZE) is None
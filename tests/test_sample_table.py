@@ -0,0 +1,90 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from datasets.sample_table import SampleTable, StringColumn
+
+NUM_LANDMARKS = 3
+
+
+def _rows(uids, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "uids": uids,
+        "image_paths": ["images/%s/ïmage_%s.npz" % (i % 3, "x" * i) for i in range(len(uids))],
+        "annotation_available": [bool(i % 2) for i in range(len(uids))],
+        "target_coordinates": [rng.uniform(0, 512, (NUM_LANDMARKS, 2)) for _ in uids],
+        "full_res_coordinates": [rng.uniform(0, 2048, (NUM_LANDMARKS, 2)) for _ in uids],
+        "image_resizing_factors": [rng.uniform(1, 4, (1, 2)) for _ in uids],
+        "original_image_sizes": [rng.integers(512, 2048, (2, 1)) for _ in uids],
+    }
+
+
+def _table(rows):
+    return SampleTable(
+        rows["uids"],
+        rows["image_paths"],
+        rows["annotation_available"],
+        rows["target_coordinates"],
+        rows["full_res_coordinates"],
+        image_resizing_factors=rows["image_resizing_factors"],
+        original_image_sizes=rows["original_image_sizes"],
+    )
+
+
+def _assert_rows_equal(table, rows):
+    assert len(table) == len(rows["uids"])
+    for row, uid in enumerate(rows["uids"]):
+        assert table.get_uid(row) == uid and type(table.get_uid(row)) is type(uid)
+        assert table.row_of_uid(uid) == row
+        assert table.image_paths[row] == rows["image_paths"][row]
+        assert table.annotation_available[row] == rows["annotation_available"][row]
+        for column in ["target_coordinates", "full_res_coordinates", "image_resizing_factors", "original_image_sizes"]:
+            np.testing.assert_array_equal(getattr(table, column)[row], rows[column][row])
+
+
+@pytest.mark.parametrize("uids", [["u%s" % i for i in range(7)], list(range(100, 107)), ["", "ß", "a"]])
+def test_rows_round_trip(uids):
+    rows = _rows(uids)
+    _assert_rows_equal(_table(rows), rows)
+
+
+def test_rows_round_trip_through_pickle():
+    rows = _rows(["u%s" % i for i in range(7)])
+    table = pickle.loads(pickle.dumps(_table(rows)))
+    _assert_rows_equal(table, rows)
+    assert table.duplicate_uids() == []
+
+
+def test_images_not_loaded():
+    rows = _rows(["a", "b"])
+    table = SampleTable(rows["uids"], rows["image_paths"], rows["annotation_available"],
+                        rows["target_coordinates"], rows["full_res_coordinates"])
+    assert table.image_resizing_factors is None and table.original_image_sizes is None
+
+
+def test_string_column_indexing():
+    column = StringColumn(["a", "", "ccc"])
+    assert column.tolist() == ["a", "", "ccc"]
+    assert column[-1] == "ccc"
+    with pytest.raises(IndexError):
+        column[3]
+
+
+@pytest.mark.parametrize("uids, expected_duplicates", [
+    (["a", "b", "c", "d"], []),
+    (["a", "b", "a", "c", "a", "c"], [["a", 0], ["a", 2], ["c", 3], ["a", 4], ["c", 5]]),
+    ([1, 2, 1], [[1, 0], [1, 2]]),
+    (["1", "01", "1.0"], []),
+])
+def test_duplicate_uids(uids, expected_duplicates):
+    rows = _rows(uids)
+    expected = [[uid, rows["image_paths"][row]] for uid, row in expected_duplicates]
+    assert _table(rows).duplicate_uids() == expected
+
+
+@pytest.mark.parametrize("uids", [[1, "1"], ["a", 2.0], [True, 2]])
+def test_mixed_uid_types_rejected(uids):
+    with pytest.raises(ValueError):
+        _table(_rows(uids))
@@ -0,0 +1,49 @@
+import itertools
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from datasets.samplers import RepeatedIndexSampler, get_training_sampler
+
+
+def _dataset(num_samples=10):
+    return TensorDataset(torch.arange(num_samples))
+
+
+def test_infinite_sampler_chains_permutations():
+    dataset = _dataset()
+    indices = list(itertools.islice(iter(get_training_sampler(dataset)), 3 * len(dataset)))
+    for i in range(3):
+        assert sorted(indices[i * len(dataset): (i + 1) * len(dataset)]) == list(range(len(dataset)))
+
+
+def test_repeated_index_sampler_repeats():
+    sampler = get_training_sampler(_dataset(), patches_per_load=2, infinite=False)
+    assert isinstance(sampler, RepeatedIndexSampler)
+    indices = list(sampler)
+    assert len(indices) == 10
+    assert indices[0::2] == indices[1::2]
+
+
+def test_gp_epoch_finishes():
+    # The GP trainers batch the whole dataset (maybe_alter_batch_size) and iterate the loader until it is exhausted.
+    dataset = _dataset()
+    train_dataloader = DataLoader(
+        dataset, batch_size=len(dataset), sampler=get_training_sampler(dataset, infinite=False)
+    )
+    for _ in range(2):
+        generator = iter(train_dataloader)
+        batches = [data_dict for data_dict in iter(generator)]
+        assert len(batches) == 1
+        assert sorted(batches[0][0].tolist()) == list(range(len(dataset)))
+
+
+@pytest.mark.parametrize("module_name, class_name", [
+    ("trainer.model_trainer_GPFlow", "GPFlowTrainer"),
+    ("trainer.model_trainer_DKL", "DKLTrainer"),
+])
+def test_gp_trainers_use_finite_training_dataloader(module_name, class_name):
+    module = pytest.importorskip(module_name)
+    assert not getattr(module, class_name).infinite_training_dataloader
+
@@ -32,6 +32,9 @@ from models.UNet_Classic import UNet
 class DKLTrainer(UnetTrainer):
     """Class for the GPFLow trainer."""
 
+    # Each epoch iterates over one pass of the training dataloader.
+    infinite_training_dataloader = False
+
     def __init__(self, **kwargs):
 
         super(DKLTrainer, self).__init__(**kwargs)
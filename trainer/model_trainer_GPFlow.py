@@ -45,6 +45,9 @@ gpf.config.set_default_jitter(1e-3)
 class GPFlowTrainer(NetworkTrainer):
     """Class for the GPFLow trainer."""
 
+    # Each epoch iterates over one pass of the training dataloader.
+    infinite_training_dataloader = False
+
     def __init__(self, **kwargs):
 
         super(GPFlowTrainer, self).__init__(**kwargs)
@@ -1,6 +1,7 @@
 import copy
 import os
 import types
+from functools import partial
 from inference.ensemble_inference_helper import EnsembleUncertainties
 import torch
 import numpy as np
@@ -16,6 +17,9 @@ from evaluation.localization_evaluation import (
     generate_summary_df,
 )
 from torch.utils.data import DataLoader
+from datasets.dataset_stream import DatasetStream
+from datasets.samplers import get_training_sampler
+from transforms.dataloader_transforms import get_batch_transforms
 
 from abc import ABC, abstractmethod
 import imgaug
@@ -29,6 +33,10 @@ from utils.setup.download_models import download_model_from_google_drive
 class NetworkTrainer(ABC):
     """Super class for trainers. I extend this for trainers for U-Net and PHD-Net. They share some functions.y"""
 
+    # The training dataloader never runs out (see train). Trainers whose train loop iterates over the training
+    # dataloader until it is exhausted (e.g. the GP trainers) set this to False to get one pass per iterator.
+    infinite_training_dataloader = True
+
     @abstractmethod
     def __init__(
         self,
@@ -71,7 +79,8 @@ class NetworkTrainer(ABC):
         # Patch centering args
 
         patch_sampler_generic_args = {"sample_patch_size": self.trainer_config.SAMPLER.PATCH.SAMPLE_PATCH_SIZE,
-                                      "sample_patch_from_resolution": self.trainer_config.SAMPLER.PATCH.RESOLUTION_TO_SAMPLE_FROM}
+                                      "sample_patch_from_resolution": self.trainer_config.SAMPLER.PATCH.RESOLUTION_TO_SAMPLE_FROM,
+                                      "patches_per_load": self.trainer_config.SAMPLER.PATCH.PATCHES_PER_LOAD}
 
         patch_sampler_bias_args = {"sampling_bias": self.trainer_config.SAMPLER.PATCH.SAMPLER_BIAS}
 
@@ -102,7 +111,16 @@ class NetworkTrainer(ABC):
                                      "root_path": self.trainer_config.DATASET.ROOT,
                                      "fold": self.trainer_config.TRAINER.FOLD,
                                      "dataset_split_size": self.trainer_config.DATASET.TRAINSET_SIZE,
-                                     "standardize_landmarks": self.trainer_config.DATASET.STANDARDIZE_LANDMARKS}
+                                     "standardize_landmarks": self.trainer_config.DATASET.STANDARDIZE_LANDMARKS,
+                                     "image_loader": self.trainer_config.DATASET.IMAGE_LOADER,
+                                     "image_store_dir": self.trainer_config.TRAINER.IMAGE_STORE_DIR,
+                                     "cache_loading_workers": self.trainer_config.TRAINER.CACHE_LOADING_WORKERS,
+                                     "cache_loading_pool": self.trainer_config.TRAINER.CACHE_LOADING_POOL,
+                                     "cache_shared_memory": self.trainer_config.TRAINER.CACHE_SHARED_MEMORY,
+                                     "cache_compact": self.trainer_config.TRAINER.CACHE_COMPACT,
+                                     "lru_cache_budget_mb": self.trainer_config.TRAINER.LRU_CACHE_BUDGET_MB,
+                                     "share_cache_across_datasets": self.trainer_config.TRAINER.SHARE_CACHE_ACROSS_DATASETS,
+                                     "stream_shards_dir": self.trainer_config.DATASET.STREAM_SHARDS_DIR}
 
         self.data_aug_args_training = {"data_augmentation_strategy": self.trainer_config.SAMPLER.DATA_AUG,
                                        "data_augmentation_package": self.trainer_config.SAMPLER.DATA_AUG_PACKAGE,
@@ -113,6 +131,19 @@ class NetworkTrainer(ABC):
                                          "guarantee_lms_image": self.trainer_config.SAMPLER.DATA_AUG_GUARANTEE_LMS_IN_IMAGE
 
                                          }
+
+        # With the torch package, the workers only sample the training patches, keeping their safe padding, and the
+        # augmentation (warp then center crop) runs on the collated batches in the main process (see augment_batch).
+        self.batch_transform = None
+        if self.trainer_config.SAMPLER.DATA_AUG_PACKAGE == "torch" and self.trainer_config.SAMPLER.DATA_AUG is not None:
+            if self.sampler_mode in ["patch_bias", "patch_centred"]:
+                batch_input_size = self.trainer_config.SAMPLER.PATCH.SAMPLE_PATCH_SIZE
+            else:
+                batch_input_size = self.trainer_config.SAMPLER.INPUT_SIZE
+            self.batch_transform = get_batch_transforms(self.trainer_config.SAMPLER.DATA_AUG, batch_input_size)
+            self.data_aug_args_training = dict(self.data_aug_args_training,
+                                               data_augmentation_strategy="NoCrop",
+                                               data_augmentation_package="fused")
         self.label_generator_args = {
             "generate_heatmaps_here": not self.gen_hms_in_mainthread,
             "hm_lambda_scale": self.trainer_config.MODEL.HM_LAMBDA_SCALE
@@ -156,6 +187,7 @@ class NetworkTrainer(ABC):
         # Validation parameters
         self.use_full_res_coords = self.trainer_config.INFERRED_ARGS.USE_FULL_RES_COORDS
         self.resize_first = self.trainer_config.INFERRED_ARGS.RESIZE_FIRST
+        self.resize_roi = self.trainer_config.INFERRED_ARGS.RESIZE_ROI
 
         # Checkpointing params
         self.save_every = self.trainer_config.TRAINER.SAVE_EVERY
@@ -308,22 +340,23 @@ class NetworkTrainer(ABC):
             self.initialize(True)
 
         step = 0
+
+        # One iterator for the whole training, so the dataloader workers never drain at epoch boundaries.
+        train_generator = iter(self.train_dataloader)
         while self.epoch < self.max_num_epochs:
 
             self.epoch_start_time = time()
 
             self.network.train()
 
-            generator = iter(self.train_dataloader)
-
             # We will log the training and validation info here. The keys we set describe all the info we are logging.
             per_epoch_logs = self.dict_logger.get_epoch_logger()
 
             self.logger.info("training, %s", self.epoch)
             # Train for X number of batches per epoch e.g. 250
             for _ in range(self.num_batches_per_epoch):
-                l, generator = self.run_iteration(
-                    generator,
+                l, train_generator = self.run_iteration(
+                    train_generator,
                     self.train_dataloader,
                     backprop=True,
                     split="training",
@@ -427,6 +460,10 @@ class NetworkTrainer(ABC):
         else:
             data_dict = direct_data_dict
 
+        # Augment the collated training batch in torch, before generating its heatmaps.
+        if self.batch_transform is not None and split == "training":
+            data_dict = self.augment_batch(data_dict)
+
         data = (data_dict["image"]).to(self.device)
 
         # torch_to_onnx(self.network, data, self.output_folder+"/model.onnx")
@@ -1159,10 +1196,18 @@ class NetworkTrainer(ABC):
         train_batch_size = self.maybe_alter_batch_size(train_dataset, self.data_loader_batch_size_train)
         valid_batch_size = self.maybe_alter_batch_size(valid_dataset, self.data_loader_batch_size_eval)
 
+        # Sample PATCHES_PER_LOAD consecutive patches from each loaded training image. The training loader never runs
+        # out (unless infinite_training_dataloader is False): one iterator (see train) keeps prefetching across passes
+        # and epochs.
+        train_sampler = get_training_sampler(
+            train_dataset,
+            self.trainer_config.SAMPLER.PATCH.PATCHES_PER_LOAD,
+            infinite=self.infinite_training_dataloader,
+        )
         self.train_dataloader = DataLoader(
             train_dataset,
             batch_size=train_batch_size,
-            shuffle=True,
+            sampler=train_sampler,
             num_workers=self.num_workers_cfg,
             persistent_workers=self.persist_workers,
             worker_init_fn=NetworkTrainer.worker_init_fn,
@@ -1192,7 +1237,15 @@ class NetworkTrainer(ABC):
 
         # assert split in ["validation", "testing"]
         np_sigmas = [x.cpu().detach().numpy() for x in self.sigmas]
-        dataset = self.dataset_class(
+
+        # Stream the testing split from shards if given, keeping the sample attributes of the dataset class.
+        if split == "testing" and self.generic_dataset_args["stream_shards_dir"] is not None:
+            dataset_class = partial(
+                DatasetStream, additional_sample_attribute_keys=self.dataset_class.additional_sample_attribute_keys)
+        else:
+            dataset_class = self.dataset_class
+
+        dataset = dataset_class(
             LabelGenerator=self.eval_label_generator,
             split=split,
             sample_mode=self.trainer_config.SAMPLER.EVALUATION_SAMPLE_MODE,
@@ -1210,32 +1263,61 @@ class NetworkTrainer(ABC):
         )
         return dataset
 
+    def augment_batch(self, data_dict):
+        """Augment a collated batch with self.batch_transform, warping the images on the training device. The target
+        coordinates and landmarks_in_indicator are updated to the transformed batch, and the heatmap labels are
+        regenerated from them in generate_heatmaps_batch (SAMPLER.DATA_AUG_PACKAGE = "torch" generates the heatmaps in
+        the main thread).
+
+        Args:
+            data_dict (dict): collated batch of samples from the dataloader.
+
+        Returns:
+            dict: the augmented batch.
+        """
+        images, target_coords = self.batch_transform(data_dict["image"].to(self.device), data_dict["target_coords"])
+
+        # Recalculate indicators incase the transform pushed out/in coords, as in the dataset.
+        height, width = images.shape[-2:]
+        landmarks_in_indicator = ((target_coords[..., 0] >= 0) & (target_coords[..., 0] <= width)
+                                  & (target_coords[..., 1] >= 0) & (target_coords[..., 1] <= height)).long()
+
+        data_dict["image"] = images
+        data_dict["target_coords"] = target_coords
+        # Collated as one tensor of batch_size per landmark.
+        data_dict["landmarks_in_indicator"] = list(landmarks_in_indicator.T)
+        return data_dict
+
     def generate_heatmaps_batch(self, data_dict, dataloader):
-        """Generate heatmaps from the main thread. Used only when regressing sigmas, because we can't update the sigma values in the dataloader workers.
-            This is a workaround to allow us to update the sigmas in the main thread, and then generate the heatmaps in the main thread.
+        """Generate heatmaps from the main thread, for the whole batch at once on the training device (U-Net). Used when
+            regressing sigmas, because we can't update the sigma values in the dataloader workers, when augmenting batches
+            in the main thread (SAMPLER.DATA_AUG_PACKAGE = "torch"), and with SOLVER.GENERATE_HEATMAPS_ON_DEVICE, so the
+            dataloader workers only load coordinates.
 
         Args:
             data_dict (dict): List of dictionaries of samples to generate heatmap labels from.
             dataloader (Dataloader): Dataloader where the generate_labels function is defined.
 
         Returns:
-            batch_hms: The batch of heatmaps generated from the data_dict to use as target labels.
+            batch_hms: The batch of heatmaps generated from the data_dict to use as target labels, collated as by the dataloader.
         """
-        batch_hms = []
-        np_sigmas = [x.cpu().detach().numpy() for x in self.sigmas]
-        b_ = [
-            dataloader.dataset.generate_labels(x, np_sigmas)
-            for x in data_dict["target_coords"]
-        ]
-        for x in b_:
-            if batch_hms == []:
-                batch_hms = [[y] for y in x]
-            else:
-                for hm_idx, hm in enumerate(x):
-                    batch_hms[hm_idx].append(hm)
-        batch_hms = [torch.stack(x) for x in batch_hms]
-
-        return batch_hms
+        dataset = dataloader.dataset
+        landmarks = data_dict["target_coords"].to(self.device)
+        x_y_corners = torch.stack([torch.as_tensor(x) for x in data_dict["x_y_corner"]], dim=1)
+
+        # Recalculate indicators for the landmarks in the image, as in the dataset's generate_labels.
+        landmarks_in_indicator = ((landmarks[..., 0] >= 0) & (landmarks[..., 0] <= dataset.input_size[0])
+                                  & (landmarks[..., 1] >= 0) & (landmarks[..., 1] <= dataset.input_size[1])).long()
+
+        return dataset.LabelGenerator.generate_labels_batch(
+            landmarks,
+            x_y_corners,
+            landmarks_in_indicator,
+            dataset.input_size,
+            torch.stack(self.sigmas).detach(),
+            dataset.num_res_supervisions,
+            dataset.hm_lambda_scale,
+        )
 
     @ staticmethod
     def worker_init_fn(worker_id):
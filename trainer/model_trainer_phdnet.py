@@ -5,7 +5,7 @@ from losses.losses import MultiBranchPatchLoss
 from models.PHD_Net_Res import PHD_Net_Res as PHDNet
 import torch
 import numpy as np
-from utils.im_utils.heatmap_manipulation import get_coords, candidate_smoothing
+from utils.im_utils.heatmap_manipulation import get_coords, candidate_smoothing_batch
 import matplotlib.pyplot as plt
 
 # torch.multiprocessing.set_start_method('spawn')# good solution !!!!
@@ -135,31 +135,28 @@ class PHDNetTrainer(NetworkTrainer):
         extra_info = {"hm_max": None}
         original_image_size = original_image_size.cpu().detach().numpy()[:, ::-1, :]
 
-        model_output = [x.detach().cpu().numpy() for x in model_output]
-
-        smoothed_candidate_maps = []
-
-        for sample_idx in range(len(model_output[0])):
+        # Every sample's heatmaps are upscaled to the same resolution, so all original sizes must be the same.
+        sample_og_size = [
+            original_image_size[0][0][0],
+            original_image_size[0][1][0],
+        ]
+        assert np.all(original_image_size == original_image_size[0]), (
+            "PHD-Net candidate smoothing needs all the images of a batch to have the same original size, got %s."
+            % original_image_size[:, :, 0].tolist()
+        )
 
-            sample_og_size = [
-                original_image_size[sample_idx][0][0],
-                original_image_size[sample_idx][1][0],
-            ]
-            # self.trainer_config.INFERENCE.DEBUG
-            csm = candidate_smoothing(
-                [model_output[0][sample_idx], model_output[1][sample_idx]],
-                sample_og_size,
-                self.maxpool_factor,
-                log_displacement_bool=self.trainer_config.MODEL.PHDNET.LOG_TRANSFORM_DISPLACEMENTS,
+        # Candidate smoothing of the whole batch at once, on the model's device.
+        smoothed_candidate_maps = candidate_smoothing_batch(
+            [x.detach() for x in model_output],
+            sample_og_size,
+            self.maxpool_factor,
+            log_displacement_bool=self.trainer_config.MODEL.PHDNET.LOG_TRANSFORM_DISPLACEMENTS,
+        )
+        if self.resize_first:
+            smoothed_candidate_maps = Resize(sample_og_size, interpolation=InterpolationMode.BICUBIC)(
+                smoothed_candidate_maps
             )
-            if self.resize_first:
-                csm = Resize(sample_og_size, interpolation=InterpolationMode.BICUBIC)(
-                    csm
-                )
-
-            smoothed_candidate_maps.append(csm)
 
-        smoothed_candidate_maps = torch.stack(smoothed_candidate_maps).to(self.device)
         # Get only the full resolution heatmap
         # model_output = model_output[-1]
 
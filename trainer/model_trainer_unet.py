@@ -10,7 +10,12 @@ from models.UNet_Classic import UNet
 import torch
 import numpy as np
 
-from utils.im_utils.heatmap_manipulation import get_coords, get_coords_fit_gauss
+from utils.im_utils.heatmap_manipulation import (
+    get_coords,
+    get_coords_fit_gauss,
+    get_coords_fit_gauss_batch,
+    get_coords_resized_roi,
+)
 import matplotlib.pyplot as plt
 
 # torch.multiprocessing.set_start_method('spawn')# good solution !!!!
@@ -201,7 +206,22 @@ class UnetTrainer(NetworkTrainer):
         extra_info["pred_coords_input_size"] = input_size_coords
 
         # Depending on evaluation mode, we may need to resize the coords to the original image size
-        if self.resize_first:
+        if self.resize_roi:
+            # Only resize a window around each peak, so the final heatmaps stay at the model's output size.
+            if all_ims_same_size:
+                pred_coords, max_values = get_coords_resized_roi(
+                    final_heatmap, [original_image_size[0][0][0], original_image_size[0][1][0]]
+                )
+            else:
+                pred_coords = []
+                max_values = []
+                for im_idx, im_size in enumerate(original_image_size):
+                    pc, mv = get_coords_resized_roi(final_heatmap[im_idx: im_idx + 1], [im_size[0][0], im_size[1][0]])
+                    pred_coords.append(torch.squeeze(pc, 0))
+                    max_values.append(torch.squeeze(mv, 0))
+                pred_coords = torch.stack(pred_coords)
+                max_values = torch.stack(max_values)
+        elif self.resize_first:
 
             # If all original images are the same size, we can resize as a batch, otherwise do them one by one.
             if all_ims_same_size:
@@ -245,18 +265,18 @@ class UnetTrainer(NetworkTrainer):
             # IF we do resize first, we already have the coords from the resized heatmap,
             # it is too expensive to fit a gauss to the resized heatmap to get the coords from the full heatmap,
             # so just use the resized heatmap coords and remember that the fitted cov is for lower res.
-            if not self.resize_first:
-                pred_coords, _, fitted_dicts = get_coords_fit_gauss(
-                    model_output, input_size_coords, visualize=self.trainer_config.INFERENCE.DEBUG
-                )
-                pred_coords = torch.tensor(pred_coords).to(self.device)
-                extra_info["pred_coords_input_size"] = pred_coords.cpu().detach().numpy()
-
+            # With INFERENCE.DEBUG, fit each heatmap with curve_fit so every fit is plotted.
+            if self.trainer_config.INFERENCE.DEBUG:
+                fitted_coords, _, fitted_dicts = get_coords_fit_gauss(model_output, input_size_coords, visualize=True)
             else:
-                _, _, fitted_dicts = get_coords_fit_gauss(
-                    model_output, input_size_coords, visualize=self.trainer_config.INFERENCE.DEBUG
+                fitted_coords, _, fitted_dicts = get_coords_fit_gauss_batch(
+                    model_output, input_size_coords, window_radius=self.trainer_config.INFERENCE.FIT_GAUSS_WINDOW
                 )
 
+            if not self.resize_first:
+                pred_coords = torch.tensor(fitted_coords).to(self.device)
+                extra_info["pred_coords_input_size"] = pred_coords.cpu().detach().numpy()
+
             extra_info["fitted_gauss"] = np.empty((input_max_values.shape[0], input_max_values.shape[1], 2, 2))
             for si, sample in enumerate(fitted_dicts):
                 for li, lm in enumerate(sample):
@@ -1,8 +1,13 @@
+import argparse
+import time
+
 import imgaug.augmenters as iaa
 import imgaug
+import cv2
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
+from skimage import transform as sk_transform
 
 
 def custom_flatten(iaaa_return):
@@ -40,8 +45,10 @@ def get_aug_package_loader(aug_package):
 
     if aug_package == "imgaug":
         return get_imgaug_transforms
+    elif aug_package == "fused":
+        return get_fused_transforms
     else:
-        raise ValueError('aug package % s not supported. Try "imgaug" '
+        raise ValueError('aug package % s not supported. Try "imgaug" or "fused" '
                          % (aug_package)
                          )
 
@@ -59,30 +66,32 @@ def get_imgaug_transforms(data_augmentation, final_im_size):
         transform: sequence of transforms
     """
 
+    # The Flatten pipelines are built once here, not on every call of transform.
     if data_augmentation == "Flatten":
 
-        def transform(image, keypoints): return custom_flatten(
-            iaa.CenterCropToFixedSize(final_im_size[0], final_im_size[1])(image=image, keypoints=keypoints))
+        crop = iaa.CenterCropToFixedSize(final_im_size[0], final_im_size[1])
+
+        def transform(image, keypoints): return custom_flatten(crop(image=image, keypoints=keypoints))
 
     elif data_augmentation == "AffineComplexFlatten":
 
-        def transform(image, keypoints): return custom_flatten(
-            iaa.Sequential(
-                [
-                    iaa.Sometimes(
-                        0.5,
-                        iaa.Affine(
-                            scale={"x": (0.8, 1.2), "y": (0.8, 1.2)},
-                            translate_percent={"x": (-0.07, 0.07), "y": (-0.07, 0.07)},
-                            rotate=(-45, 45),
-                            shear=(-16, 16),
-                            order=[0, 1],
-                        ),
+        sequence = iaa.Sequential(
+            [
+                iaa.Sometimes(
+                    0.5,
+                    iaa.Affine(
+                        scale={"x": (0.8, 1.2), "y": (0.8, 1.2)},
+                        translate_percent={"x": (-0.07, 0.07), "y": (-0.07, 0.07)},
+                        rotate=(-45, 45),
+                        shear=(-16, 16),
+                        order=[0, 1],
                     ),
-                    iaa.flip.Flipud(p=0.5),
-                    iaa.CenterCropToFixedSize(final_im_size[0], final_im_size[1])
-                ])(image=image, keypoints=keypoints)
-        )
+                ),
+                iaa.flip.Flipud(p=0.5),
+                iaa.CenterCropToFixedSize(final_im_size[0], final_im_size[1])
+            ])
+
+        def transform(image, keypoints): return custom_flatten(sequence(image=image, keypoints=keypoints))
 
     elif data_augmentation == "AffineSimple":
 
@@ -271,3 +280,331 @@ def get_imgaug_transforms(data_augmentation, final_im_size):
         raise ValueError("transformations mode for dataaugmentation not recognised.")
 
     return transform
+
+
+# Data augmentation strategies supported by the fused package (see get_fused_transforms).
+FUSED_AUG_STRATEGIES = ["Flatten", "AffineComplexFlatten", "AffineSimple", "AffineComplex", "CenterCropOnly"]
+
+# Data augmentation strategies supported by the torch package (see get_batch_transforms).
+BATCH_AUG_STRATEGIES = ["AffineSimple", "AffineComplex", "CenterCropOnly"]
+
+# FusedAffineTransform arguments of the imgaug strategies made of affine, vertical flip and center crop.
+AFFINE_STRATEGY_ARGS = {
+    "Flatten": {"flatten": True},
+    "AffineSimple": {"affine_p": 0.75, "scale": (0.8, 1.2), "rotate": (-45, 45), "flipud_p": 0.5},
+    "AffineComplex": {
+        "affine_p": 0.5,
+        "scale": {"x": (0.8, 1.2), "y": (0.8, 1.2)},
+        "translate_percent": {"x": (-0.07, 0.07), "y": (-0.07, 0.07)},
+        "rotate": (-45, 45),
+        "shear": (-16, 16),
+        "orders": [0, 1],
+        "flipud_p": 0.5,
+    },
+    "CenterCropOnly": {},
+}
+AFFINE_STRATEGY_ARGS["AffineComplexFlatten"] = dict(AFFINE_STRATEGY_ARGS["AffineComplex"], flatten=True)
+
+# Fused strategy of the dataloader workers with the torch package: keeps the safe padding of sampled patches, which the
+# batch augmentation warps and then center crops, as the imgaug strategies do.
+AFFINE_STRATEGY_ARGS["NoCrop"] = {"center_crop": False}
+
+
+class FusedAffineTransform:
+    """Sampled affine, vertical flip and center crop fused into one 2x3 matrix, applied with a single warp straight to
+    the output size. The landmarks are transformed analytically with the same matrix.
+
+    Samples the same distributions as the equivalent imgaug Sequential of Sometimes(Affine), Flipud and
+    CenterCropToFixedSize, with the same geometry, interpolation and zero padding, but warps the image once instead of
+    once per augmenter and never builds Keypoint objects. Random numbers are drawn from imgaug's global RNG, so seeding
+    imgaug (e.g. in the DataLoader worker_init_fn) seeds this too.
+
+    Args:
+        final_im_size ([int, int]): [width, height] to center crop to.
+        affine_p (float, optional): probability of applying the affine. Defaults to 0 (no affine).
+        scale ((float, float) or dict, optional): scale range, shared by x and y, or {"x": range, "y": range} for
+            independent scales. Defaults to (1.0, 1.0).
+        translate_percent (dict, optional): {"x": range, "y": range} of translations as a fraction of the image size.
+            Defaults to None (no translation).
+        rotate ((float, float), optional): rotation range in degrees. Defaults to (0, 0).
+        shear ((float, float), optional): x shear range in degrees. Defaults to (0, 0).
+        orders ([int], optional): interpolation orders to choose from, 0 (nearest) or 1 (linear). Defaults to [1].
+        flipud_p (float, optional): probability of flipping vertically. Defaults to 0.
+        flatten (bool, optional): flatten the output image, as custom_flatten. Defaults to False.
+        center_crop (bool, optional): center crop to final_im_size. Defaults to True.
+    """
+
+    def __init__(self, final_im_size, affine_p=0.0, scale=(1.0, 1.0), translate_percent=None, rotate=(0, 0),
+                 shear=(0, 0), orders=[1], flipud_p=0.0, flatten=False, center_crop=True):
+        self.crop_width, self.crop_height = final_im_size[0], final_im_size[1]
+        self.affine_p = affine_p
+        self.scale = scale
+        self.translate_percent = translate_percent
+        self.rotate = rotate
+        self.shear = shear
+        self.orders = orders
+        self.flipud_p = flipud_p
+        self.flatten = flatten
+        self.center_crop = center_crop
+
+    def sample_affine_matrix(self, rng, height, width):
+        """Sample an affine and return its 3x3 matrix in pixel centre coordinates, as imgaug.augmenters.Affine does."""
+        if isinstance(self.scale, dict):
+            scale_x, scale_y = rng.uniform(*self.scale["x"]), rng.uniform(*self.scale["y"])
+        else:
+            scale_x = scale_y = rng.uniform(*self.scale)
+
+        if self.translate_percent is not None:
+            translate_x = rng.uniform(*self.translate_percent["x"]) * width
+            translate_y = rng.uniform(*self.translate_percent["y"]) * height
+        else:
+            translate_x = translate_y = 0.0
+
+        rotate = np.deg2rad(rng.uniform(*self.rotate))
+        shear = np.deg2rad(rng.uniform(*self.shear))
+
+        # Scale, shear, rotate and translate about the image centre.
+        to_topleft = np.array([[1, 0, -(width / 2.0 - 0.5)], [0, 1, -(height / 2.0 - 0.5)], [0, 0, 1]])
+        to_center = np.array([[1, 0, width / 2.0 - 0.5], [0, 1, height / 2.0 - 0.5], [0, 0, 1]])
+        transform = sk_transform.AffineTransform(
+            scale=(scale_x, scale_y), translation=(translate_x, translate_y), rotation=rotate, shear=shear
+        ).params
+        return to_center @ transform @ to_topleft
+
+    def sample_matrix(self, rng, height, width):
+        """Sample the affine, flip and center crop of one image and fuse them into one matrix.
+
+        Args:
+            rng (imgaug.random.RNG): random number generator.
+            height (int): image height.
+            width (int): image width.
+
+        Returns:
+            (np.array, int, (int, int)): 3x3 matrix mapping input to output pixel centres, the interpolation order
+             and the output (height, width).
+        """
+        matrix = np.eye(3)
+        order = 1
+        if rng.random(size=None) < self.affine_p:
+            matrix = self.sample_affine_matrix(rng, height, width)
+            order = self.orders[rng.integers(0, len(self.orders))]
+
+        if rng.random(size=None) < self.flipud_p:
+            matrix = np.array([[1, 0, 0], [0, -1, height - 1], [0, 0, 1]]) @ matrix
+
+        # Center crop, only along the axes larger than the crop size.
+        if self.center_crop:
+            out_height, out_width = min(height, self.crop_height), min(width, self.crop_width)
+        else:
+            out_height, out_width = height, width
+        crop_top, crop_left = int(0.5 * (height - out_height)), int(0.5 * (width - out_width))
+        matrix = np.array([[1, 0, -crop_left], [0, 1, -crop_top], [0, 0, 1]]) @ matrix
+
+        return matrix, order, (out_height, out_width)
+
+    def __call__(self, image, coords):
+        """Augment an image and its landmarks.
+
+        Args:
+            image (np.array): 2D image, (height, width).
+            coords (np.array): landmark coordinates, (num_landmarks, 2) as (x, y).
+
+        Returns:
+            (np.array, np.array): the augmented image, cropped to final_im_size (flattened if flatten), and the
+             augmented landmark coordinates.
+        """
+        rng = imgaug.random.get_global_rng()
+        matrix, order, (out_height, out_width) = self.sample_matrix(rng, *image.shape[:2])
+
+        transformed_image = cv2.warpAffine(
+            image, matrix[:2], dsize=(out_width, out_height), flags=order, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+        )
+
+        # The matrix maps pixel centres, landmarks are in pixel corner coordinates (pixel centre + 0.5).
+        coords = np.asarray(coords, dtype=np.float64)
+        transformed_coords = (coords - 0.5) @ matrix[:2, :2].T + matrix[:2, 2] + 0.5
+
+        if self.flatten:
+            transformed_image = transformed_image.flatten()
+
+        return transformed_image, transformed_coords
+
+
+class BatchAffineTransform(FusedAffineTransform):
+    """FusedAffineTransform applied to a whole collated batch in torch, on the device of the batch.
+
+    The matrix of each sample is sampled as in FusedAffineTransform, then all the images are warped at once with
+    affine_grid and grid_sample (zero padding) and renormalized per image as normalize_cmr, and the landmarks are
+    transformed with a batched matrix product.
+
+    Args:
+        Same as FusedAffineTransform, except flatten which is not supported.
+    """
+
+    def __init__(self, final_im_size, **kwargs):
+        super(BatchAffineTransform, self).__init__(final_im_size, **kwargs)
+        if self.flatten:
+            raise ValueError("BatchAffineTransform does not support flattening the images.")
+
+    def __call__(self, images, coords):
+        """Augment a batch of images and their landmarks.
+
+        Args:
+            images (torch.Tensor): images, (batch_size, channels, height, width).
+            coords (torch.Tensor): landmark coordinates, (batch_size, num_landmarks, 2) as (x, y).
+
+        Returns:
+            (torch.Tensor, torch.Tensor): the augmented images, cropped to final_im_size, and the augmented landmark
+             coordinates, on the devices of images and coords.
+        """
+        rng = imgaug.random.get_global_rng()
+        batch_size, channels, height, width = images.shape
+
+        samples = [self.sample_matrix(rng, height, width) for _ in range(batch_size)]
+        matrices = np.stack([matrix for matrix, _, _ in samples])
+        orders = np.array([order for _, order, _ in samples])
+        out_height, out_width = samples[0][2]
+
+        # grid_sample maps output to input locations, in [-1, 1] coordinates (align_corners=False).
+        to_normalized_in = np.array([[2 / width, 0, 1 / width - 1], [0, 2 / height, 1 / height - 1], [0, 0, 1]])
+        from_normalized_out = np.linalg.inv(
+            np.array([[2 / out_width, 0, 1 / out_width - 1], [0, 2 / out_height, 1 / out_height - 1], [0, 0, 1]])
+        )
+        theta = to_normalized_in @ np.linalg.inv(matrices) @ from_normalized_out
+        theta = torch.from_numpy(theta[:, :2]).to(device=images.device, dtype=images.dtype)
+        grid = torch.nn.functional.affine_grid(
+            theta, (batch_size, channels, out_height, out_width), align_corners=False)
+
+        transformed_images = torch.nn.functional.grid_sample(
+            images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+        nearest = torch.from_numpy(orders == 0).to(images.device)
+        if nearest.any():
+            transformed_images[nearest] = torch.nn.functional.grid_sample(
+                images[nearest], grid[nearest], mode="nearest", padding_mode="zeros", align_corners=False)
+
+        # Renormalize each image as normalize_cmr, a constant image normalizes to zeros.
+        mean = transformed_images.mean(dim=(1, 2, 3), keepdim=True)
+        std = transformed_images.std(dim=(1, 2, 3), unbiased=False, keepdim=True)
+        transformed_images = torch.where(std > 0, (transformed_images - mean) / std, torch.zeros_like(transformed_images))
+
+        # The matrices map pixel centres, landmarks are in pixel corner coordinates (pixel centre + 0.5).
+        matrices = torch.from_numpy(matrices).to(coords.device)
+        transformed_coords = (coords.double() - 0.5) @ matrices[:, :2, :2].transpose(1, 2) + matrices[:, None, :2, 2] + 0.5
+
+        return transformed_images, transformed_coords.to(coords.dtype)
+
+
+def get_fused_transforms(data_augmentation, final_im_size):
+    """Returns a fused data augmentation transform (see FusedAffineTransform), sampling the same augmentations as the
+    imgaug strategy of the same name. Only the strategies made of affine, vertical flip and center crop are supported,
+    see FUSED_AUG_STRATEGIES.
+
+    Args:
+        data_augmentation (str): name of the data augmentation strategy
+
+    Raises:
+        ValueError: error if data_augmentation is not supported by the fused package
+
+    Returns:
+        FusedAffineTransform: transform taking (image, coords) and returning the transformed (image, coords).
+    """
+
+    if data_augmentation in FUSED_AUG_STRATEGIES or data_augmentation == "NoCrop":
+        transform = FusedAffineTransform(final_im_size, **AFFINE_STRATEGY_ARGS[data_augmentation])
+    else:
+        raise ValueError(
+            "transformations mode %s not supported by the fused data augmentation package. Choose from %s or use the "
+            "imgaug package." % (data_augmentation, FUSED_AUG_STRATEGIES)
+        )
+
+    return transform
+
+
+def get_batch_transforms(data_augmentation, final_im_size):
+    """Returns a data augmentation transform for collated batches (see BatchAffineTransform), sampling the same
+    augmentations as the imgaug strategy of the same name. See BATCH_AUG_STRATEGIES for the supported strategies.
+
+    Args:
+        data_augmentation (str): name of the data augmentation strategy
+
+    Raises:
+        ValueError: error if data_augmentation is not supported by the torch package
+
+    Returns:
+        BatchAffineTransform: transform taking a batch of (images, coords) and returning the transformed batch.
+    """
+
+    if data_augmentation in BATCH_AUG_STRATEGIES:
+        transform = BatchAffineTransform(final_im_size, **AFFINE_STRATEGY_ARGS[data_augmentation])
+    else:
+        raise ValueError(
+            "transformations mode %s not supported by the torch data augmentation package. Choose from %s or use the "
+            "imgaug package." % (data_augmentation, BATCH_AUG_STRATEGIES)
+        )
+
+    return transform
+
+
+BENCHMARK_STRATEGIES = ["Flatten", "AffineComplexFlatten", "CenterCropOnly", "AffineSimple", "AffineComplex",
+                        "AffineComplexElastic", "AffineComplexElasticLight", "AffineComplexElasticBlur",
+                        "AffineComplexElasticBlurSharp", "payer19", "thaler21"]
+
+
+def benchmark_transforms(packages=["imgaug", "fused"], strategies=BENCHMARK_STRATEGIES, image_size=[512, 512],
+                         final_im_size=[256, 256], num_landmarks=19, repeats=200):
+    """Measure the per-sample latency of every data augmentation strategy of each package, including building the
+    keypoints for imgaug as the dataset does.
+
+    Args:
+        packages ([str], optional): packages to benchmark. Defaults to ["imgaug", "fused"].
+        strategies ([str], optional): strategies to benchmark, skipped for packages not supporting them. Defaults to
+            BENCHMARK_STRATEGIES, all the strategies.
+        image_size ([int, int], optional): size of the image to augment. Defaults to [512, 512].
+        final_im_size ([int, int], optional): size to center crop to. Defaults to [256, 256].
+        num_landmarks (int, optional): number of landmarks. Defaults to 19.
+        repeats (int, optional): number of samples to time per strategy. Defaults to 200.
+
+    Returns:
+        dict: mean per-sample latency in ms, keyed by (package, strategy).
+    """
+    from imgaug.augmentables import Keypoint, KeypointsOnImage
+
+    image = np.random.rand(image_size[1], image_size[0]).astype(np.float32)
+    coords = np.random.rand(num_landmarks, 2) * image_size
+
+    latencies = {}
+    for package in packages:
+        for strategy in strategies:
+            try:
+                transform = get_aug_package_loader(package)(strategy, final_im_size)
+            except ValueError:
+                continue
+
+            if package == "imgaug":
+                def augment(): return transform(image=image, keypoints=KeypointsOnImage(
+                    [Keypoint(x=coo[0], y=coo[1]) for coo in coords], shape=image.shape))
+            else:
+                def augment(): return transform(image, coords)
+
+            augment()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                augment()
+            latencies[(package, strategy)] = (time.perf_counter() - start) / repeats * 1000
+
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the per-sample latency of the data augmentation strategies.")
+    parser.add_argument("--packages", type=str, nargs="+", default=["imgaug", "fused"], help="Packages to benchmark.")
+    parser.add_argument("--strategies", type=str, nargs="+", default=BENCHMARK_STRATEGIES, help="Strategies to benchmark.")
+    parser.add_argument("--image_size", type=int, nargs=2, default=[512, 512], help="Size of the image to augment.")
+    parser.add_argument("--final_im_size", type=int, nargs=2, default=[256, 256], help="Size to center crop to.")
+    parser.add_argument("--repeats", type=int, default=200, help="Number of samples to time per strategy.")
+    args = parser.parse_args()
+
+    imgaug.seed(0)
+    for (package, strategy), latency in benchmark_transforms(
+            args.packages, args.strategies, args.image_size, args.final_im_size, repeats=args.repeats).items():
+        print("%-8s %-30s %8.3f ms/sample" % (package, strategy, latency))
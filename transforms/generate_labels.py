@@ -1,7 +1,10 @@
+import argparse
 import copy
 import logging
+import time
 import numpy as np
 import math
+from functools import lru_cache
 import matplotlib.pyplot as plt
 from utils.im_utils.heatmap_manipulation import get_coords
 from utils.im_utils.visualisation import (
@@ -14,6 +17,7 @@ from abc import ABC, abstractmethod
 import matplotlib.pyplot as plt
 import matplotlib.patches as patchesplt
 import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
 import cv2
 from scipy.stats import multivariate_normal
 
@@ -62,6 +66,39 @@ class LabelGenerator(ABC):
 
         """
 
+    def generate_labels_batch(
+        self,
+        landmarks,
+        x_y_corners,
+        landmarks_in_indicator,
+        input_size,
+        hm_sigmas,
+        num_res_supervisions,
+        hm_lambda_scale,
+    ):
+        """Generates the labels of a whole batch, collated as by the dataloader. Calls generate_labels for each sample
+            on the CPU, override it to generate the batch at once.
+
+        Args:
+            landmarks (torch.Tensor): (B, L, 2) [x,y] coordinates of the landmarks of each sample.
+            x_y_corners (torch.Tensor): (B, 2) coordinates of the top left of each sample's patch.
+            landmarks_in_indicator (torch.Tensor): (B, L) 1 if the landmark is in the sample's input image, 0 if not.
+            input_size ([int, int]): Size of the heatmap to produce.
+            hm_sigmas (torch.Tensor): (L,) gaussian sigmas of the heatmaps, 1 for each landmark.
+            num_res_supervisions (int): number of heatmaps to generate, each half resolution of previous.
+            hm_lambda_scale (float): value to scale heatmaps by.
+
+        Returns:
+            dict: the labels of the batch.
+        """
+        np_sigmas = list(hm_sigmas.detach().cpu().numpy())
+        return default_collate([
+            self.generate_labels(coords, x_y_corner, indicator.tolist(), input_size, np_sigmas, num_res_supervisions,
+                                 hm_lambda_scale)
+            for coords, x_y_corner, indicator in zip(landmarks.cpu().numpy(), x_y_corners.cpu().numpy(),
+                                                     landmarks_in_indicator.cpu())
+        ])
+
     @abstractmethod
     def debug_sample(self, sample_dict, image, coordinates):
         """Visually debug a sample. Provide logging and visualisation of the sample.
@@ -544,26 +581,21 @@ class UNetLabelGenerator(LabelGenerator):
 
         # Generates a heatmap for multiple resolutions based on # down steps in encoder (1x, 0.5x, 0.25x etc)
         for size_f in resizing_factors:
-            intermediate_heatmaps = []
+            downsample_size = [input_size[0] / size_f[0], input_size[1] / size_f[1]]
+            # One buffer for the heatmaps of all landmarks, blank for landmarks not present in the image.
+            intermediate_heatmaps = np.zeros(
+                (len(landmarks), math.ceil(downsample_size[1]), math.ceil(downsample_size[0])), dtype=dtype
+            )
             # Generate a heatmap for each landmark
             for idx, lm in enumerate(landmarks):
 
                 lm = np.round(lm / size_f)
-                downsample_size = [input_size[0] / size_f[0], input_size[1] / size_f[1]]
                 down_sigma = hm_sigmas[idx] / size_f[0]
 
-                # If the landmark is present in image, generate a heatmap, otherwise generate a blank heatmap.
+                # If the landmark is present in image, generate a heatmap, otherwise leave the heatmap blank.
                 if landmarks_in_indicator[idx] == 1:
-                    intermediate_heatmaps.append(
-                        gaussian_gen(
-                            lm, downsample_size, 1, down_sigma, dtype, hm_lambda_scale
-                        )
-                    )
-                else:
-                    intermediate_heatmaps.append(
-                        np.zeros((int(downsample_size[0]), int(downsample_size[1])))
-                    )
-            heatmap_list.append(np.array(intermediate_heatmaps))
+                    gaussian_gen_windowed(intermediate_heatmaps[idx], lm, down_sigma, hm_lambda_scale)
+            heatmap_list.append(intermediate_heatmaps)
 
         hm_list = heatmap_list[::-1]
 
@@ -577,6 +609,36 @@ class UNetLabelGenerator(LabelGenerator):
         return_dict["heatmaps"] = hm_list
         return return_dict
 
+    def generate_labels_batch(
+        self,
+        landmarks,
+        x_y_corners,
+        landmarks_in_indicator,
+        input_size,
+        hm_sigmas,
+        num_res_supervisions,
+        hm_lambda_scale=100,
+    ):
+        """Generates the Gaussian heatmaps of a whole batch at every resolution in one vectorized pass with torch, on
+        the device of landmarks. Same heatmaps as generate_labels for each sample, collated (see gaussian_gen_batch)."""
+
+        device = landmarks.device
+        landmarks = landmarks.double()
+        hm_sigmas = hm_sigmas.detach().to(device=device, dtype=torch.float64)
+        in_image = landmarks_in_indicator.to(device) == 1
+
+        heatmap_list = []
+        # Generates a heatmap for multiple resolutions based on # down steps in encoder (1x, 0.5x, 0.25x etc)
+        for size_f in [2**x for x in range(num_res_supervisions)]:
+            downsample_size = [math.ceil(input_size[0] / size_f), math.ceil(input_size[1] / size_f)]
+            heatmaps = gaussian_gen_batch(
+                torch.round(landmarks / size_f), downsample_size, hm_sigmas / size_f, hm_lambda_scale
+            )
+            # Blank heatmaps for landmarks not present in the image.
+            heatmap_list.append(heatmaps.masked_fill_(~in_image[..., None, None], 0))
+
+        return {"heatmaps": heatmap_list[::-1]}
+
     def stitch_heatmap(self, patch_predictions, stitching_info):
         """
         Use model outputs from a patchified image to stitch together a full resolution heatmap
@@ -859,6 +921,15 @@ class PHDNetLabelGenerator(LabelGenerator):
             "displacement_weights": [],
         }
 
+        # Displacements of all landmarks at once.
+        all_displacements = gen_patch_displacements(
+            landmarks,
+            self.sample_grid_size,
+            self.maxpool_factor,
+            log_transform_displacements_bool=self.log_transform_displacements_bool,
+            clamp_dist=self.clamp_dist,
+        )
+
         for idx, lm in enumerate(landmarks):
             sigma = hm_sigmas[idx]
 
@@ -874,6 +945,7 @@ class PHDNetLabelGenerator(LabelGenerator):
                 log_transform_displacements_bool=self.log_transform_displacements_bool,
                 clamp_dist=self.clamp_dist,
                 debug=False,
+                x_y_displacements=all_displacements[idx],
             )
 
             return_dict["patch_heatmap"].append(sub_class)
@@ -1396,6 +1468,174 @@ def gaussian_gen(
     return g
 
 
+# The caches are keyed on the (downsampled) sigma, so they hold an entry per landmark and resolution level when the
+# sigmas are per landmark (e.g. 19 landmarks x 5 levels), per image axis for the kernels.
+@lru_cache(maxsize=512)
+def gaussian_kernel_1d(std, size):
+    """Cached 1-D Gaussian exponents (x - mx)^2 / (2 std^2) and kernel exp(-exponent) for the integer offsets
+    x - mx in [-(size - 1), size - 1], i.e. every offset of a landmark inside an image of that size.
+
+    Args:
+        std (float): standard deviation of the Gaussian.
+        size (int): size of the image axis.
+
+    Returns:
+        (np.array, np.array): read-only float64 exponents and kernel, indexed by offset + size - 1.
+    """
+    offsets = np.arange(-(size - 1), size, dtype=np.float64)
+    exponents = offsets**2.0 / (2.0 * std**2.0)
+    kernel = np.exp(-exponents)
+    exponents.flags.writeable = False
+    kernel.flags.writeable = False
+    return exponents, kernel
+
+
+@lru_cache(maxsize=256)
+def gaussian_underflow_exponent(std):
+    """Smallest exponent q at which gaussian_gen's unnormalised Gaussian 1 / (2 pi std^2) * exp(-q) underflows to 0
+    (float64), i.e. where gaussian_gen sets the heatmap to -1.
+
+    Args:
+        std (float): standard deviation of the Gaussian.
+
+    Returns:
+        float: the exponent.
+    """
+    peak = (1) / (2.0 * np.pi * std * std)
+    low, high = 0.0, 1e4
+    # Bisect over the float64 values, the Gaussian is non-increasing in q.
+    while np.nextafter(low, high) < high:
+        mid = low + (high - low) / 2
+        if mid in (low, high):
+            mid = np.nextafter(low, high)
+        if peak * np.exp(-mid) > 0:
+            low = mid
+        else:
+            high = mid
+    return high
+
+
+def gaussian_underflow_distances(exponents_x, exponents_y, underflow_exponent):
+    """For each row, the smallest |x - mx| at which exponents_x + exponents_y of the row reaches underflow_exponent,
+    i.e. where gaussian_gen's Gaussian underflows to 0 (float64) and gaussian_gen sets the heatmap to -1.
+
+    The float64 sum is non-decreasing in |x - mx|, so the distance is found with a binary search per row, then
+    corrected by a step where rounding the subtraction moved it off the exact sum.
+
+    Args:
+        exponents_x (np.array): exponents of the offsets 0, 1, ..., width - 1 (see gaussian_kernel_1d).
+        exponents_y (np.array): exponents of the rows.
+        underflow_exponent (float): see gaussian_underflow_exponent.
+
+    Returns:
+        np.array: int distances of the rows, len(exponents_x) where no cell of the row underflows.
+    """
+    distances = np.searchsorted(exponents_x, underflow_exponent - exponents_y)
+    padded = np.append(exponents_x, np.inf)
+    for _ in range(2):
+        distances += padded[distances] + exponents_y < underflow_exponent
+        previous = np.maximum(distances - 1, 0)
+        distances -= (distances > 0) & (padded[previous] + exponents_y >= underflow_exponent)
+    return distances
+
+
+def gaussian_gen_windowed(heatmap, landmark, std, lambda_scale=100):
+    """Write gaussian_gen(landmark, resolution, 1, std, lambda_scale=lambda_scale) into a preallocated heatmap buffer,
+    as the outer product of two cached 1-D kernels, only within the window where it is non-zero in float32.
+
+    Outside the window the heatmap is 0, or -1 where gaussian_gen's Gaussian underflows to 0 (float64), found per row
+    from the 1-D exponents (see gaussian_underflow_distances). Values are the same as gaussian_gen's cast to float32, up
+    to float64 rounding. Landmarks that are not integer or not in the heatmap fall back to gaussian_gen.
+
+    Args:
+        heatmap (np.array): (height, width) float32 buffer to write to, i.e. resolution = [width, height].
+        landmark (np.array): [x, y] coordinates of the landmark.
+        std (float): standard deviation of the Gaussian.
+        lambda_scale (int, optional): value of the heatmap's peak. Defaults to 100.
+
+    Returns:
+        np.array: the heatmap buffer.
+    """
+    height, width = heatmap.shape
+    mx, my = landmark[0], landmark[1]
+    std = float(std)
+
+    if not (mx == int(mx) and my == int(my) and 0 <= mx < width and 0 <= my < height):
+        heatmap[:] = gaussian_gen(landmark, [width, height], 1, std, lambda_scale=lambda_scale)
+        return heatmap
+
+    mx, my = int(mx), int(my)
+    x_offsets = slice(width - 1 - mx, 2 * width - 1 - mx)
+    y_offsets = slice(height - 1 - my, 2 * height - 1 - my)
+    exponents_x, all_kernel_x = gaussian_kernel_1d(std, width)
+    exponents_y, all_kernel_y = gaussian_kernel_1d(std, height)
+    kernel_x = all_kernel_x[x_offsets]
+    kernel_y = all_kernel_y[y_offsets]
+
+    heatmap[:] = 0
+    underflow_exponent = gaussian_underflow_exponent(std)
+    # The largest |x - mx| in the heatmap, only rows reaching the underflow there have -1 cells.
+    max_distance = max(mx, width - 1 - mx)
+    if exponents_x[width - 1 + max_distance] + exponents_y[y_offsets].max() >= underflow_exponent:
+        distances = gaussian_underflow_distances(
+            exponents_x[width - 1:], exponents_y[y_offsets], underflow_exponent)
+        rows = np.flatnonzero(distances <= max_distance)
+        distances_x = np.abs(np.arange(width) - mx)
+        heatmap[rows] = np.where(distances_x >= distances[rows, None], np.float32(-1), np.float32(0))
+
+    # The peak is at the landmark (kernel 1), beyond the window the heatmap rounds to 0 in float32.
+    float32_zero = float(np.nextafter(np.float32(0), np.float32(1))) / 2
+    window_x = np.flatnonzero(kernel_x * lambda_scale > float32_zero)
+    window_y = np.flatnonzero(kernel_y * lambda_scale > float32_zero)
+    x_0, x_1 = window_x[0], window_x[-1] + 1
+    y_0, y_1 = window_y[0], window_y[-1] + 1
+
+    heatmap[y_0:y_1, x_0:x_1] = np.multiply.outer(kernel_y[y_0:y_1], kernel_x[x_0:x_1] * lambda_scale)
+    return heatmap
+
+
+def gaussian_gen_batch(landmarks, resolution, std, lambda_scale=100):
+    """Batched torch version of gaussian_gen (step size 1), on the device of landmarks: the heatmap of every landmark
+    of every sample, as the outer product of two 1-D Gaussians.
+
+    Values are gaussian_gen's in float32, to float32 rounding. Where gaussian_gen's Gaussian underflows to 0 (float64)
+    the heatmap is -1, as in gaussian_gen, with the underflow threshold computed analytically, so cells right on the
+    threshold may differ.
+
+    Args:
+        landmarks (torch.Tensor): (B, L, 2) float64 [x, y] coordinates of the landmarks.
+        resolution ([int, int]): [width, height] of the heatmaps.
+        std (torch.Tensor): (L,) float64 standard deviations of the Gaussians, 1 for each landmark.
+        lambda_scale (int, optional): value of the heatmaps' maximum. Defaults to 100.
+
+    Returns:
+        torch.Tensor: (B, L, height, width) float32 heatmaps.
+    """
+    device = landmarks.device
+    two_variance = 2.0 * std[:, None] ** 2.0
+
+    x = torch.arange(resolution[0], dtype=torch.float64, device=device)
+    y = torch.arange(resolution[1], dtype=torch.float64, device=device)
+    exponents_x = (x - landmarks[..., 0:1]) ** 2.0 / two_variance
+    exponents_y = (y - landmarks[..., 1:2]) ** 2.0 / two_variance
+    kernel_x = torch.exp(-exponents_x)
+    kernel_y = torch.exp(-exponents_y)
+
+    # normalise the maximum in the heatmap to lambda_scale
+    scale = lambda_scale / (kernel_x.amax(dim=-1, keepdim=True) * kernel_y.amax(dim=-1, keepdim=True))
+    heatmaps = (kernel_y * scale).float()[..., :, None] * kernel_x.float()[..., None, :]
+
+    # peak * exp(-q) underflows to 0 (float64) when exp(-q), rounded to k times the smallest subnormal 2^-1074, has
+    # peak * k <= 1/2, i.e. when exp(-q) < (min_k - 1/2) 2^-1074 with min_k the smallest k with peak * k > 1/2.
+    peak = 1 / (2.0 * np.pi * std * std)
+    underflow_exponent = 1074 * math.log(2) - torch.log(torch.floor(0.5 / peak) + 0.5)
+    threshold_y = underflow_exponent[:, None] - exponents_y
+    if (exponents_x.amax(dim=-1, keepdim=True) >= threshold_y).any():
+        heatmaps.masked_fill_(exponents_x[..., None, :] >= threshold_y[..., :, None], -1)
+
+    return heatmaps
+
+
 def gaussian_gen_fast(predictions, resolution, sigma):
     sx = sigma
     sy = sigma
@@ -1492,6 +1732,68 @@ def gaussian_gen_alternate(predictions, resolution, sigma):
     # g =  np.expand_dims(zeros, axis=0)
 
 
+def gen_patch_displacements(
+    landmarks,
+    grid_size,
+    maxpooling_factor,
+    log_transform_displacements_bool=True,
+    clamp_dist=48,
+):
+    """Displacements from the center of every sub-patch of the grid to each landmark, vectorized over the grid and the
+    landmarks. The log transform uses np.log2, so its values can differ from the scalar math.log(x, 2) by float32
+    rounding.
+
+    Args:
+        landmarks (np.array): (L, 2) [x, y] coordinates of the landmarks in the grid.
+        grid_size ([int, int]): size of the grid (the patch) in pixels.
+        maxpooling_factor (int): sub-patches are 2**maxpooling_factor pixels wide.
+        log_transform_displacements_bool (bool, optional): whether to log2 transform the displacement magnitudes.
+            Defaults to True.
+        clamp_dist (float, optional): clamp the displacement vectors to this magnitude, None to not clamp.
+            Defaults to 48.
+
+    Returns:
+        np.array: (L, 2, grid_size[0] // step, grid_size[1] // step) float32 x, y displacements, indexed [x, y].
+    """
+
+    # need to find sub image grid e.g. grid size 128x128, patch size of 8x8 = 16x16 patches.
+    # I need this grid so i can find center of each patch, displacment to lanmdark
+    # and heatmap values centered around the landmark.
+    # We use log displacements to dampen distance parts, shifting function to right to avoid asymptope.
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    step_size = 2**maxpooling_factor
+    patches = [
+        grid_size[0] // 2**maxpooling_factor,
+        grid_size[1] // 2**maxpooling_factor,
+    ]
+
+    # (L, x, 1) and (L, 1, y) landmarks and sub-patch centers.
+    landmarks_x = landmarks[:, 0, None, None]
+    landmarks_y = landmarks[:, 1, None, None]
+    centers_x = (np.arange(patches[0]) * step_size + (step_size // 2))[None, :, None]
+    centers_y = (np.arange(patches[1]) * step_size + (step_size // 2))[None, None, :]
+
+    # Prevent log(0)
+    distance_x = np.maximum(0.000001, np.abs(landmarks_x - centers_x))
+    distance_y = np.maximum(0.000001, np.abs(landmarks_y - centers_y))
+    distance_x, distance_y = np.broadcast_arrays(distance_x, distance_y)
+
+    # clamp to magnitude of clamp_dist
+    if clamp_dist != None:
+        n = np.sqrt(distance_x**2 + distance_y**2)
+        f = np.minimum(n, clamp_dist) / n
+        distance_x, distance_y = [f * distance_x, f * distance_y]
+
+    if log_transform_displacements_bool:
+        distance_x, distance_y = np.log2(distance_x), np.log2(distance_y)
+
+    # Displacements point from the sub-patch center to the landmark.
+    displace_x = np.where(landmarks_x > centers_x, distance_x, np.where(landmarks_x < centers_x, -distance_x, 0))
+    displace_y = np.where(landmarks_y > centers_y, distance_y, np.where(landmarks_y < centers_y, -distance_y, 0))
+
+    return np.stack([displace_x, displace_y], axis=1).astype(np.float32)
+
+
 def gen_patch_displacements_heatmap(
     landmark,
     xy_patch_corner,
@@ -1504,6 +1806,7 @@ def gen_patch_displacements_heatmap(
     log_transform_displacements_bool=True,
     debug=False,
     clamp_dist=48,
+    x_y_displacements=None,
 ):
     """Function to generate sub-patch displacements and patch-wise heatmap values.
 
@@ -1517,6 +1820,8 @@ def gen_patch_displacements_heatmap(
         sigma (_type_): _description_
         lambda_scale (int, optional): _description_. Defaults to 100.
         debug (bool, optional): _description_. Defaults to False.
+        x_y_displacements (np.array, optional): the landmark's displacements if already generated by
+            gen_patch_displacements (e.g. for all landmarks at once). Defaults to None, to generate them here.
 
     Raises:
         NotImplementedError: _description_
@@ -1525,75 +1830,15 @@ def gen_patch_displacements_heatmap(
         _type_: _description_
     """
 
-    # need to find sub image grid e.g. grid size 128x128, patch size of 8x8 = 16x16 patches.
-    # I need this grid so i can find center of each patch, displacment to lanmdark
-    # and heatmap values centered around the landmark.
-    # We use log displacements to dampen distance parts, shifting function to right to avoid asymptope.
-    patches = [
-        grid_size[0] // 2**maxpooling_factor,
-        grid_size[1] // 2**maxpooling_factor,
-    ]
     step_size = 2**maxpooling_factor
-
-    x_y_displacements = np.zeros((2, patches[0], patches[1]), dtype=np.float32)
-    for x_idx, x in enumerate(range(0, grid_size[0], step_size)):
-        for y_idx, y in enumerate(range(0, grid_size[0], step_size)):
-
-            center_xy = [x + (step_size // 2), y + (step_size // 2)]
-
-            # find log of displacements accounting for orientation
-            # distance_y = min(abs(landmark[1] - center_xy[1]) , clamp_dist)
-            # distance_x = min(abs(landmark[0] - center_xy[0]), clamp_dist)
-
-            # Prevent log(0)
-            distance_y = max(0.000001, abs(landmark[1] - center_xy[1]))
-            distance_x = max(0.000001, abs(landmark[0] - center_xy[0]))
-            # v = [distance_x, distance_y]
-            # distance_x, distance_y = ()
-
-            # clamp to magnitude of clamp_dist
-            if clamp_dist != None:
-                n = math.sqrt(distance_x**2 + distance_y**2)
-                if n != 0:
-                    f = min(n, clamp_dist) / n
-                else:
-                    f = 1
-                distance_x, distance_y = [f * distance_x, f * distance_y]
-
-            if log_transform_displacements_bool:
-                # shift log function by 1 so now the asymtope is at -1 instead of 0.
-                if landmark[1] > center_xy[1]:
-                    displace_y = math.log(distance_y, 2)
-                elif landmark[1] < center_xy[1]:
-                    displace_y = -math.log(distance_y, 2)
-                else:
-                    displace_y = 0
-
-                # shift log function by 1 so now the asymtope is at -1 instead of 0.
-                if landmark[0] > center_xy[0]:
-                    displace_x = math.log(distance_x, 2)
-                elif landmark[0] < center_xy[0]:
-                    displace_x = -math.log(distance_x, 2)
-                else:
-                    displace_x = 0
-
-            else:
-                if landmark[1] > center_xy[1]:
-                    displace_y = distance_y
-                elif landmark[1] < center_xy[1]:
-                    displace_y = -distance_y
-                else:
-                    displace_y = 0
-
-                # shift log function by 1 so now the asymtope is at -1 instead of 0.
-                if landmark[0] > center_xy[0]:
-                    displace_x = distance_x
-                elif landmark[0] < center_xy[0]:
-                    displace_x = -distance_x
-                else:
-                    displace_x = 0
-
-            x_y_displacements[:, x_idx, y_idx] = [displace_x, displace_y]
+    if x_y_displacements is None:
+        x_y_displacements = gen_patch_displacements(
+            np.asarray(landmark)[None],
+            grid_size,
+            maxpooling_factor,
+            log_transform_displacements_bool=log_transform_displacements_bool,
+            clamp_dist=clamp_dist,
+        )[0]
 
     ###########Gaussian weights #############
     # Generate guassian heatmap for classificaiton and displacement weights!
@@ -1726,3 +1971,61 @@ def gen_patch_displacements_heatmap(
     # # ############################# end of DEBUGGING VISUALISATION #################
 
     return x_y_displacements, sub_class, displacement_weights
+
+
+def benchmark_phdnet_labels(grid_size=[128, 128], maxpool_factors=[2, 3, 4], num_landmarks=19,
+                            log_transform_displacements_bool=True, clamp_dist=48, repeats=200):
+    """Measure the per-sample latency of the PHD-Net displacement labels (gen_patch_displacements for all the landmarks)
+    and of the whole PHD-Net labels (PHDNetLabelGenerator.generate_labels), for each maxpool factor.
+
+    Args:
+        grid_size ([int, int], optional): size of the patch. Defaults to [128, 128].
+        maxpool_factors ([int], optional): maxpool factors to benchmark. Defaults to [2, 3, 4].
+        num_landmarks (int, optional): number of landmarks. Defaults to 19.
+        log_transform_displacements_bool (bool, optional): log transform the displacements. Defaults to True.
+        clamp_dist (float, optional): clamp the displacements to this magnitude, None to not clamp. Defaults to 48.
+        repeats (int, optional): number of samples to time per maxpool factor. Defaults to 200.
+
+    Returns:
+        dict: mean per-sample latency in ms, keyed by (maxpool factor, "displacements" or "generate_labels").
+    """
+    landmarks = np.random.rand(num_landmarks, 2) * grid_size
+
+    latencies = {}
+    for maxpool_factor in maxpool_factors:
+        label_generator = PHDNetLabelGenerator(
+            maxpool_factor, grid_size, "gaussian", grid_size, log_transform_displacements_bool, clamp_dist
+        )
+        functions = {
+            "displacements": lambda: gen_patch_displacements(
+                landmarks, grid_size, maxpool_factor, log_transform_displacements_bool, clamp_dist
+            ),
+            "generate_labels": lambda: label_generator.generate_labels(
+                landmarks, [0, 0], [1] * num_landmarks, grid_size, [np.array(3.0)] * num_landmarks, 1
+            ),
+        }
+        for name, function in functions.items():
+            function()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                function()
+            latencies[(maxpool_factor, name)] = (time.perf_counter() - start) / repeats * 1000
+
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the per-sample latency of the PHD-Net labels.")
+    parser.add_argument("--grid_size", type=int, nargs=2, default=[128, 128], help="Size of the patch.")
+    parser.add_argument("--maxpool_factors", type=int, nargs="+", default=[2, 3, 4], help="Maxpool factors.")
+    parser.add_argument("--num_landmarks", type=int, default=19, help="Number of landmarks.")
+    parser.add_argument("--no_log_transform", action="store_true", help="Do not log transform the displacements.")
+    parser.add_argument("--clamp_dist", type=float, default=48, help="Clamp distance, negative to not clamp.")
+    parser.add_argument("--repeats", type=int, default=200, help="Number of samples to time per maxpool factor.")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    for (maxpool_factor, name), latency in benchmark_phdnet_labels(
+            args.grid_size, args.maxpool_factors, args.num_landmarks, not args.no_log_transform,
+            args.clamp_dist if args.clamp_dist >= 0 else None, args.repeats).items():
+        print("maxpool %-3s %-16s %8.3f ms/sample" % (maxpool_factor, name, latency))
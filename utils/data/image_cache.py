@@ -0,0 +1,291 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from utils.data.load_data import CompactImage, get_datatype_name, load_and_resize_image, resize_coordinates
+
+
+class MemmapImageStore:
+    """Persistent on-disk store of images that have already been loaded, resized and normalized.
+
+    Each image is saved as a float32 .npy file (shape (1, H, W)) with a small JSON file holding its resizing
+    factor and original size. Entries are keyed by the image path, the load resolution and the loader, so the same
+    directory can be shared by different input sizes and datasets. Images are read back with np.load(mmap_mode="c"),
+    so reads are served from the page cache without a copy.
+
+    The store is not invalidated when a source image changes on disk, delete the store directory if that happens.
+    """
+
+    def __init__(self, store_dir, image_loader="pil"):
+        """
+        Args:
+            store_dir (str): directory of the store.
+            image_loader (str, optional): image loader of get_datatype_load ("pil" or "array"), part of the entry key
+             since the two loaders resize slightly differently. Defaults to "pil".
+        """
+        self.store_dir = store_dir
+        self.image_loader = image_loader
+        self.logger = logging.getLogger()
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._meta = {}
+
+    def entry_key(self, image_path, load_im_size):
+        """Unique key of an image entry, a hash of the image path, load resolution and loader type.
+
+        Args:
+            image_path (str): path to the source image.
+            load_im_size ([int, int]): resolution the image is resized to.
+
+        Returns:
+            str: hex digest naming the entry's files.
+        """
+        key_str = "%s|%s|%s" % (os.path.abspath(image_path), list(load_im_size), get_datatype_name(image_path))
+        if self.image_loader != "pil":
+            key_str += "|" + self.image_loader
+        return hashlib.sha1(key_str.encode("utf-8")).hexdigest()
+
+    def _entry_paths(self, key):
+        return os.path.join(self.store_dir, key + ".npy"), os.path.join(self.store_dir, key + ".json")
+
+    def _write_entry(self, key, image, resized_factor, original_size):
+        """Write an entry atomically so concurrent DataLoader workers never read a partially written file."""
+        image_file, meta_file = self._entry_paths(key)
+
+        with tempfile.NamedTemporaryFile(dir=self.store_dir, suffix=".tmp", delete=False) as tmp_f:
+            np.save(tmp_f, np.ascontiguousarray(image, dtype=np.float32))
+        os.replace(tmp_f.name, image_file)
+
+        meta = {"resized_factor": resized_factor.tolist(), "original_size": original_size.tolist()}
+        with tempfile.NamedTemporaryFile("w", dir=self.store_dir, suffix=".tmp", delete=False) as tmp_f:
+            json.dump(meta, tmp_f)
+        os.replace(tmp_f.name, meta_file)
+
+    def _read_meta(self, key, meta_file):
+        if key not in self._meta:
+            with open(meta_file) as json_file:
+                meta = json.load(json_file)
+            self._meta[key] = (np.array(meta["resized_factor"]), np.array(meta["original_size"]))
+        return self._meta[key]
+
+    def load_and_resize_image(self, image_path, coords, load_im_size, data_type_load, round=True, standardized=False):
+        """Drop-in replacement for utils.data.load_data.load_and_resize_image that reads from the store,
+        loading and adding the image on a miss.
+
+        Args:
+            image_path (str): path to the source image.
+            coords (np.array): coordinates at the original image resolution.
+            load_im_size ([int, int]): resolution to resize the image to.
+            data_type_load (function): function that loads the image from image_path.
+            round (bool, optional): Whether to round the resized coordinates. Defaults to True.
+
+        Returns:
+            resized_factor, original_size, image (memory-mapped, float32), coords: same as load_and_resize_image.
+        """
+        key = self.entry_key(image_path, load_im_size)
+        image_file, meta_file = self._entry_paths(key)
+
+        if os.path.exists(meta_file):
+            resized_factor, original_size = self._read_meta(key, meta_file)
+            coords = resize_coordinates(coords, resized_factor[0], round)
+            image = np.load(image_file, mmap_mode="c")
+        else:
+            resized_factor, original_size, image, coords = load_and_resize_image(
+                image_path, coords, load_im_size, data_type_load, round=round, standardized=standardized)
+            self._write_entry(key, image, resized_factor, original_size)
+            image = image.astype(np.float32)
+
+        return resized_factor, original_size, image, coords
+
+
+class SharedImageCache:
+    """Cached images packed into one contiguous block of shared memory, shape (num_images, *image_shape).
+
+    Image i lives at a fixed offset (i * image size) in the block, so there is one allocation rather than one Python
+    object per image. DataLoader workers attach to the same pages: forked workers inherit the shared mapping without
+    copy-on-write, and spawned workers receive a handle to it through torch's multiprocessing reductions. Worker memory
+    therefore stays flat no matter how many workers there are.
+
+    Images are filled in order with append(), so it can be used in place of the list of cached images.
+    """
+
+    def __init__(self, num_images, image_shape, dtype=torch.float64):
+        self.block = torch.empty((num_images, *image_shape), dtype=dtype).share_memory_()
+        self._length = 0
+
+    def append(self, image):
+        """Copy the next image into the block.
+
+        Args:
+            image (np.array): image with shape image_shape.
+        """
+        if self._length == self.block.shape[0]:
+            raise IndexError("SharedImageCache is full, it was allocated for %s images." % self.block.shape[0])
+        self.block[self._length] = torch.from_numpy(np.asarray(image))
+        self._length += 1
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index >= self._length:
+            raise IndexError("Image index %s out of range for %s cached images." % (index, self._length))
+        return self.block[index].numpy()
+
+    def nbytes(self):
+        return self.block.element_size() * self.block.nelement()
+
+
+class SharedCompactImageCache(SharedImageCache):
+    """SharedImageCache of CompactImages (see utils.data.load_data.compact_image).
+
+    The block holds the 16-bit pixels of every image (uint16 and float16 images are both stored by their bit pattern),
+    next to shared arrays of the per-image mean, std and 16-bit type. Indexing returns a CompactImage.
+    """
+
+    def __init__(self, num_images, image_shape):
+        super().__init__(num_images, image_shape, dtype=torch.int16)
+        self.means = torch.zeros(num_images, dtype=torch.float64).share_memory_()
+        self.stds = torch.zeros(num_images, dtype=torch.float64).share_memory_()
+        self.is_float16 = torch.zeros(num_images, dtype=torch.bool).share_memory_()
+
+    def append(self, image):
+        """Copy the next image into the block.
+
+        Args:
+            image (CompactImage): image with data of shape image_shape and dtype uint16 or float16.
+        """
+        if image.data.dtype not in [np.uint16, np.float16]:
+            raise ValueError("SharedCompactImageCache only stores uint16 and float16 images, not %s." % image.data.dtype)
+
+        self.means[self._length] = image.mean
+        self.stds[self._length] = image.std
+        self.is_float16[self._length] = image.data.dtype == np.float16
+        super().append(np.ascontiguousarray(image.data).view(np.int16))
+
+    def __getitem__(self, index):
+        data = super().__getitem__(index)
+        data = data.view(np.float16) if self.is_float16[index] else data.view(np.uint16)
+        return CompactImage(data, float(self.means[index]), float(self.stds[index]))
+
+
+class LRUImageCache:
+    """Bounded cache of loaded and resized images, filled lazily and evicting the least recently used images once the
+    cached pixels exceed a byte budget.
+
+    Each DataLoader worker process holds its own cache, so the budget applies per process. Hit, miss and eviction
+    counters are reported to the logger every log_every lookups.
+    """
+
+    def __init__(self, budget_bytes, load_function=load_and_resize_image, log_every=1000):
+        """
+        Args:
+            budget_bytes (int): maximum number of bytes of image data to keep in the cache.
+            load_function (function, optional): function with the signature of load_and_resize_image, used on a miss.
+             Defaults to load_and_resize_image.
+            log_every (int, optional): log the cache counters every log_every lookups. Defaults to 1000.
+        """
+        self.budget_bytes = budget_bytes
+        self.load_function = load_function
+        self.log_every = log_every
+        self.logger = logging.getLogger()
+
+        self.entries = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load_and_resize_image(self, image_path, coords, load_im_size, data_type_load, round=True, standardized=False):
+        """Drop-in replacement for utils.data.load_data.load_and_resize_image that serves images from the cache.
+
+        Returns:
+            resized_factor, original_size, image, coords: same as load_and_resize_image.
+        """
+        key = (image_path, tuple(load_im_size))
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            resized_factor, original_size, image = self.entries[key]
+            coords = resize_coordinates(coords, resized_factor[0], round)
+        else:
+            self.misses += 1
+            resized_factor, original_size, image, coords = self.load_function(
+                image_path, coords, load_im_size, data_type_load, round=round, standardized=standardized)
+            self._insert(key, (resized_factor, original_size, image), image.nbytes)
+
+        if (self.hits + self.misses) % self.log_every == 0:
+            self.log_stats()
+
+        return resized_factor, original_size, image, coords
+
+    def _insert(self, key, entry, nbytes):
+        if nbytes > self.budget_bytes:
+            return
+
+        while self.cached_bytes + nbytes > self.budget_bytes:
+            _, (_, _, evicted_image) = self.entries.popitem(last=False)
+            self.cached_bytes -= evicted_image.nbytes
+            self.evictions += 1
+
+        self.entries[key] = entry
+        self.cached_bytes += nbytes
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        self.logger.info(
+            "LRU image cache (pid %s): %s hits, %s misses (hit rate %.2f), %s evictions, %s images using %.1f/%.1f MB.",
+            os.getpid(), self.hits, self.misses, self.hits / max(lookups, 1), self.evictions, len(self.entries),
+            self.cached_bytes / 1e6, self.budget_bytes / 1e6,
+        )
+
+
+class ProcessImageStore:
+    """Process-wide store of loaded and resized images, shared by every dataset built in this process.
+
+    The training, validation and testing datasets, and the testing dataset rebuilt for each checkpoint in run_inference,
+    all reference the same decoded pixels, so each image is loaded and resized once per process.
+    Entries are keyed by (image path, load_im_size, standardization, compact, image loader), where compact marks
+    CompactImages. The image loader is part of the key because "pil" and "array" resize differently.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    @staticmethod
+    def entry_key(image_path, load_im_size, standardized=False, compact=False, image_loader="pil"):
+        return (os.path.abspath(image_path), tuple(load_im_size), standardized, compact, image_loader)
+
+    def get(self, image_path, load_im_size, standardized=False, compact=False, image_loader="pil"):
+        """Get a stored image.
+
+        Returns:
+            (resized_factor, original_size, image) if stored, else None.
+        """
+        return self.entries.get(self.entry_key(image_path, load_im_size, standardized, compact, image_loader))
+
+    def add(self, image_path, load_im_size, entry, standardized=False, compact=False, image_loader="pil"):
+        """Store an image, replacing any stored entry with the same key.
+
+        Args:
+            entry (tuple): (resized_factor, original_size, image), as returned by load_and_resize_image.
+        """
+        self.entries[self.entry_key(image_path, load_im_size, standardized, compact, image_loader)] = entry
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries = {}
+
+
+PROCESS_IMAGE_STORE = ProcessImageStore()
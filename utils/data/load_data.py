@@ -1,7 +1,12 @@
+import gzip
 import logging
 import os
 import json
+import tempfile
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 from typing import Optional
 import nibabel as nib
 from PIL import Image
@@ -15,17 +20,72 @@ import pandas as pd
 import ast
 
 
-def get_datatype_load(im_path):
+def get_datatype_name(im_path):
+    """Names the image loader used for an image path, based on the suffix of the image path.
+
+    Args:
+        im_path (str): The path to an image
+
+    Returns:
+        str: one of "npy", "nifti", "dicom", "npz" or "pil".
+    """
+    if im_path.endswith(".npy"):
+        return "npy"
+    elif "nii.gz" in im_path:
+        return "nifti"
+    elif "dcm" in im_path:
+        return "dicom"
+    elif "npz" in im_path:
+        return "npz"
+    else:
+        return "pil"
+
+
+def _load_npy(pth):
+    """np.load of a raw .npy image, memory-mapped (copy-on-write) when given a path, so only the pixels that are read
+    are paged in and no zip extraction or full copy is needed."""
+    if isinstance(pth, (str, os.PathLike)):
+        return np.load(pth, mmap_mode="c")
+    return np.load(pth)
+
+
+def _load_nifti(pth):
+    """nib.load that also accepts a file object of a .nii.gz file (e.g. an image read from a shard, see utils.data.shards)."""
+    if isinstance(pth, (str, os.PathLike)):
+        return nib.load(pth)
+    return nib.Nifti1Image.from_bytes(gzip.decompress(pth.read()))
+
+
+def get_datatype_load(im_path, image_loader="pil"):
     """Decides the image load function based on the suffix of the image path.
 
     Args:
         im_path (str): The path to an image
+        image_loader (str, optional): "pil" to load the image as a PIL Image (legacy) or "array" to decode it
+         straight to a float32 NumPy array. Defaults to "pil".
 
     Returns:
-        lambda function: lambda function that loads the image depending on the suffix of the image path.
+        lambda function: lambda function that loads the image depending on the suffix of the image path. It takes the
+         image path or a file object of the image.
     """
-    if "nii.gz" in im_path:
-        return lambda pth: Image.fromarray(nib.load(pth).get_fdata())
+    if image_loader == "array":
+        if im_path.endswith(".npy"):
+            return lambda pth: np.asarray(_load_npy(pth), dtype=np.float32)
+        elif "nii.gz" in im_path:
+            return lambda pth: _load_nifti(pth).get_fdata(dtype=np.float32)
+        elif "dcm" in im_path:
+            return lambda pth: dicom.dcmread(pth).pixel_array.astype(np.float32)
+        elif "npz" in im_path:
+            return lambda pth: np.load(pth)["arr_0"].astype(np.float32)
+        else:
+            return lambda pth: np.asarray(Image.open(pth), dtype=np.float32)
+    elif image_loader != "pil":
+        raise ValueError("Image loader %s not recognised. Choose from ['pil', 'array']" % image_loader)
+
+    if im_path.endswith(".npy"):
+        return lambda pth: Image.fromarray(_load_npy(pth))
+    elif "nii.gz" in im_path:
+        return lambda pth: Image.fromarray(_load_nifti(pth).get_fdata())
     elif "dcm" in im_path:
         return lambda pth: Image.fromarray(dicom.dcmread(pth).pixel_array)
     elif "npz" in im_path:
@@ -117,12 +177,77 @@ def resize_coordinates(coords, resizing_factor, round=True):
         return coords * [1 / resizing_factor[0], 1 / resizing_factor[1]]
 
 
-def load_and_resize_image(image_path, coords, load_im_size, data_type_load, round=True, standardized=False):
+def _bicubic_filter(x, a=-0.5):
+    """The bicubic convolution kernel used by PIL."""
+    x = np.abs(x)
+    return np.where(
+        x < 1.0,
+        ((a + 2.0) * x - (a + 3.0)) * x * x + 1,
+        np.where(x < 2.0, (((x - 5.0) * x + 8.0) * x - 4.0) * a, 0.0),
+    )
+
+
+@lru_cache(maxsize=32)
+def _resample_taps(in_size, out_size):
+    """Source indices and weights of a 1D antialiased bicubic resampling, following PIL's resampling coefficients.
+
+    Args:
+        in_size (int): input length.
+        out_size (int): output length.
+
+    Returns:
+        (np.array, np.array): indices and float32 weights, both of shape (out_size, num_taps).
+    """
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = 2.0 * filter_scale
+    centers = (np.arange(out_size) + 0.5) * scale
+
+    num_taps = int(np.ceil(support)) * 2 + 1
+    first_tap = np.clip((centers - support + 0.5).astype(int), 0, None)
+    taps = first_tap[:, None] + np.arange(num_taps)[None, :]
+
+    weights = _bicubic_filter((taps - centers[:, None] + 0.5) / filter_scale)
+    weights[taps >= in_size] = 0.0
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    return np.minimum(taps, in_size - 1), weights.astype(np.float32)
+
+
+def resize_image_array(image, load_im_size):
+    """Resize a 2D (or 2D + channels) image array with separable, antialiased bicubic resampling, done as two
+     vectorized gather-and-sum passes.
+
+    Args:
+        image (np.array): float32 image of shape (H, W) or (H, W, C).
+        load_im_size ([int, int]): size to resize to, as [W, H] (the PIL convention).
+
+    Returns:
+        np.array: resized float32 image of shape (load_im_size[1], load_im_size[0]) (+ channels).
+    """
+    if [image.shape[1], image.shape[0]] == list(load_im_size):
+        return image
+
+    row_taps, row_weights = _resample_taps(image.shape[0], load_im_size[1])
+    col_taps, col_weights = _resample_taps(image.shape[1], load_im_size[0])
+
+    extra_dims = (None,) * (image.ndim - 2)
+    image = np.einsum("ok...,ok->o...", image[row_taps], row_weights, optimize=True)
+    image = np.einsum("hok...,ok->ho...", image[:, col_taps], col_weights, optimize=True)
+    return image
+
+
+def load_and_resize_image(image_path, coords, load_im_size, data_type_load, round=True, standardized=False, normalize=True):
     """Load image and resize it to the specified size. Also resize the coordinates to match the new image size.
 
+    If data_type_load returns a NumPy array (get_datatype_load(..., image_loader="array")) the image is resized and
+    normalized in float32 without going through PIL, see load_and_resize_image_array.
+
     Args:
         image_path (str): _description_
         coords ([ints]): _description_
+        normalize (bool, optional): If False, return the resized image of shape (1, H, W) without normalizing it.
+         Defaults to True.
 
     Returns:
         _type_: _description_
@@ -135,6 +260,9 @@ def load_and_resize_image(image_path, coords, load_im_size, data_type_load, roun
     # logger.info("time im load: %s", time.time()-s)
     s = time.time()
 
+    if isinstance(original_image, np.ndarray):
+        return load_and_resize_image_array(original_image, coords, load_im_size, round=round, normalize=normalize)
+
     original_size = np.expand_dims(np.array(list(original_image.size)), 1)
     if list(original_image.size) != load_im_size:
         resizing_factor = [
@@ -148,13 +276,213 @@ def load_and_resize_image(image_path, coords, load_im_size, data_type_load, roun
 
     # potentially resize the coords
     coords = resize_coordinates(coords, resizing_factor, round)
-    image = normalize_cmr(original_image.resize(load_im_size))
+    if normalize:
+        image = normalize_cmr(original_image.resize(load_im_size))
+    else:
+        image = np.expand_dims(np.asarray(original_image.resize(load_im_size)), axis=0)
 
     # logger.info("time im resize: %s", time.time()-s)
 
     return resized_factor, original_size, image, coords
 
 
+def load_and_resize_image_array(original_image, coords, load_im_size, round=True, normalize=True):
+    """Array version of load_and_resize_image: resizes a decoded float32 image with resize_image_array and normalizes
+    it in place, never leaving float32.
+
+    Args:
+        original_image (np.array): float32 image of shape (H, W), decoded by get_datatype_load(..., "array").
+        coords ([ints]): coordinates at the original resolution.
+        load_im_size ([int, int]): size to resize to, as [W, H].
+        round (bool, optional): Whether to round the resized coordinates. Defaults to True.
+        normalize (bool, optional): If False, return the resized image without normalizing it. Defaults to True.
+
+    Returns:
+        resized_factor, original_size, image, coords: same as load_and_resize_image, image is float32.
+    """
+    original_size = np.array([[original_image.shape[1]], [original_image.shape[0]]])
+    resizing_factor = [original_size[0, 0] / load_im_size[0], original_size[1, 0] / load_im_size[1]]
+    resized_factor = np.expand_dims(np.array(resizing_factor), axis=0)
+
+    coords = resize_coordinates(coords, resizing_factor, round)
+    image = np.array(resize_image_array(original_image, load_im_size), dtype=np.float32)
+    if not normalize:
+        return resized_factor, original_size, np.expand_dims(image, axis=0), coords
+
+    # Same as normalize_cmr. The std is summed in float64, and the 1e-100 epsilon (which would underflow in float32)
+    # only matters for a constant image, which normalizes to zeros.
+    image -= image.mean(dtype=np.float64)
+    std = image.std(dtype=np.float64)
+    if std > 0:
+        image /= std
+    else:
+        image[:] = 0
+
+    return resized_factor, original_size, np.expand_dims(image, axis=0), coords
+
+
+CompactImage = namedtuple("CompactImage", ["data", "mean", "std"])
+
+
+def compact_image(image):
+    """Compact a resized (not normalized) image for caching, keeping its mean and std for normalization later.
+
+    Images with integer pixels in the uint16 range (e.g. 12-16 bit DICOM) are stored as their raw uint16 pixels.
+    Other images are normalized and stored as float16 (with mean 0 and std 1).
+
+    Args:
+        image (np.array): resized image, from load_and_resize_image(..., normalize=False).
+
+    Returns:
+        CompactImage: (data (uint16 or float16 array), mean, std).
+    """
+    mean = float(np.mean(image, dtype=np.float64))
+    std = float(np.std(image, dtype=np.float64))
+
+    if np.all(np.mod(image, 1) == 0) and image.min() >= 0 and image.max() <= np.iinfo(np.uint16).max:
+        return CompactImage(image.astype(np.uint16), mean, std)
+
+    data = np.zeros(image.shape, dtype=np.float16) if std == 0 else ((image - mean) / std).astype(np.float16)
+    return CompactImage(data, 0.0, 1.0)
+
+
+def expand_compact_image(image):
+    """Normalize a CompactImage into a float32 image, equivalent to normalize_cmr of the resized image.
+
+    Args:
+        image (CompactImage): image from compact_image.
+
+    Returns:
+        np.array: normalized float32 image.
+    """
+    expanded = image.data.astype(np.float32)
+    expanded -= image.mean
+    if image.std > 0:
+        expanded /= image.std
+    else:
+        expanded[:] = 0
+    return expanded
+
+
+def _load_and_resize_image_only(image_path, load_im_size, round=True, image_loader="pil", compact=False):
+    """Load and resize an image without any coordinates. Module level so it can be sent to a process pool."""
+    resized_factor, original_size, image, _ = load_and_resize_image(
+        image_path, np.zeros((0, 2)), load_im_size, get_datatype_load(image_path, image_loader), round=round,
+        normalize=not compact,
+    )
+    if compact:
+        image = compact_image(image)
+    return resized_factor, original_size, image
+
+
+def load_and_resize_images(
+    image_paths, load_im_size, num_workers, pool="process", round=True, image_loader="pil", compact=False
+):
+    """Load and resize a list of images in parallel. Results are yielded in the order of image_paths as they become
+     available, so the caller can fill its lists deterministically while showing progress.
+
+    Args:
+        image_paths ([str]): paths to the images to load.
+        load_im_size ([int, int]): size to resize the images to.
+        num_workers (int): number of parallel workers.
+        pool (str, optional): "process" for a process pool (CPU-bound decoding, e.g. compressed DICOM/NPZ) or "thread"
+         for a thread pool (I/O-bound formats, e.g. on network storage). Defaults to "process".
+        round (bool, optional): Passed to load_and_resize_image. Defaults to True.
+        image_loader (str, optional): Passed to get_datatype_load. Defaults to "pil".
+        compact (bool, optional): If True, yield the images as CompactImages (see compact_image). Defaults to False.
+
+    Raises:
+        ValueError: if pool is not "process" or "thread".
+
+    Yields:
+        (resized_factor, original_size, image): same as the first three returns of load_and_resize_image.
+    """
+    if pool == "process":
+        executor_class = ProcessPoolExecutor
+    elif pool == "thread":
+        executor_class = ThreadPoolExecutor
+    else:
+        raise ValueError("Image loading pool %s not recognised. Choose from ['process', 'thread']" % pool)
+
+    # Send work to processes in chunks so the per-task pickling overhead is small compared to the decoding.
+    chunksize = max(1, len(image_paths) // (num_workers * 4))
+    with executor_class(max_workers=num_workers) as executor:
+        yield from executor.map(
+            partial(
+                _load_and_resize_image_only,
+                load_im_size=load_im_size,
+                round=round,
+                image_loader=image_loader,
+                compact=compact,
+            ),
+            image_paths,
+            chunksize=chunksize,
+        )
+
+
+# Process-wide cache of the parsed xlsx coordinates, keyed by (path, sheet, mtime, size) of the workbook.
+_XLSX_COORDINATES_CACHE = {}
+
+
+def _parse_xlsx_coordinates(datapath, sheet_name):
+    """Parse the uids and predicted coordinates of every row of a results workbook.
+
+    Returns:
+        (np.array, np.array): uids (str) and predicted coordinates (num_rows, num_landmarks, 2).
+    """
+    datafame = pd.read_excel(datapath, sheet_name=sheet_name, converters={'uid': str})
+
+    # Parse the string to remove newlines and convert to numpy array.
+    coordinates = np.array(
+        [
+            ast.literal_eval(x.replace(".", ",").replace("\n", ","))
+            for x in datafame.predicted_coords.tolist()
+        ]
+    )
+    return np.array(datafame.uid.tolist(), dtype=str), coordinates
+
+
+def load_xlsx_coordinates(datapath, sheet_name=0):
+    """Load the uids and predicted coordinates of every row of a results workbook, parsing the workbook only once.
+
+    The parsed arrays are saved to a binary sidecar next to the workbook ("<workbook>.sheet_<sheet>.coords.npz"),
+    stamped with the workbook's mtime and size. Later calls (from this or any other process) load the sidecar in
+    milliseconds, and the workbook is parsed again only if it changed. Within a process the arrays are also kept in memory,
+    so the training, validation and testing datasets share one copy.
+
+    Args:
+        datapath (str): Path to the xlsx file.
+        sheet_name (str or int, optional): Sheet to read. Defaults to 0.
+
+    Returns:
+        (np.array, np.array): uids (str) and predicted coordinates (num_rows, num_landmarks, 2).
+    """
+    stat = os.stat(datapath)
+    cache_key = (os.path.abspath(datapath), str(sheet_name), stat.st_mtime_ns, stat.st_size)
+    if cache_key in _XLSX_COORDINATES_CACHE:
+        return _XLSX_COORDINATES_CACHE[cache_key]
+
+    sidecar_path = "%s.sheet_%s.coords.npz" % (datapath, sheet_name)
+    parsed = None
+    if os.path.exists(sidecar_path):
+        with np.load(sidecar_path) as sidecar:
+            if sidecar["mtime_ns"] == stat.st_mtime_ns and sidecar["size"] == stat.st_size:
+                parsed = (sidecar["uids"], sidecar["coordinates"])
+
+    if parsed is None:
+        parsed = _parse_xlsx_coordinates(datapath, sheet_name)
+        try:
+            # Write atomically, other processes may be reading the sidecar.
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(datapath)), suffix=".tmp", delete=False) as tmp_f:
+                np.savez(tmp_f, uids=parsed[0], coordinates=parsed[1], mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            os.replace(tmp_f.name, sidecar_path)
+        except OSError as e:
+            logging.getLogger().warning("Could not write coordinate sidecar %s: %s", sidecar_path, e)
+
+    _XLSX_COORDINATES_CACHE[cache_key] = parsed
+    return parsed
+
+
 def maybe_get_coordinates_from_xlsx(datapath, uids, landmarks_to_return, sheet_name=None):
     """
         Read csv file of data, returns samples whesplitre the value of the "split" column
@@ -176,33 +504,19 @@ def maybe_get_coordinates_from_xlsx(datapath, uids, landmarks_to_return, sheet_n
     if sheet_name is None:
         sheet_name = 0
 
-    datafame = pd.read_excel(datapath, sheet_name=sheet_name, converters={'uid': str})
-    # datafame["uid"] = datafame["uid"].astype(str)
-    # if isinstance(landmarks_to_return, int):
-    #     cols_to_return = ["L"+str(landmarks_to_return)]
-    # elif isinstance(landmarks_to_return, (list, pd.core.series.Series, np.ndarray)):
-    #     cols_to_return = ["L"+str(i) for i in landmarks_to_return]
-    # else:
-    #     return ValueError("landmarks_to_return must be int or list of ints")
-
-    filtered_df = datafame[datafame["uid"].isin(uids)]
-    assert filtered_df.shape[0] == len(uids), "Not all uids found in csv file: "
+    all_uids, all_coordinates = load_xlsx_coordinates(datapath, sheet_name)
 
-    return_data = filtered_df.loc[:, ["uid", "predicted_coords"]]
+    wanted_uids = set(uids)
+    rows = [row for row, uid in enumerate(all_uids.tolist()) if uid in wanted_uids]
+    assert len(rows) == len(uids), "Not all uids found in csv file: "
 
-    # Parse the string to remove newlines and convert to numpy array. Only return columns requested. Create dict:
+    # Only return columns requested. Create dict:
     # {'uid1': [landmark1, landmark2, ...], 'uid2': [landmark1, landmark2, ...]}
     return_dict = dict(
         zip(
-            return_data.uid,
-            np.array(
-                [
-                    ast.literal_eval(x.replace(".", ",").replace("\n", ","))
-                    for x in return_data.predicted_coords.tolist()
-                ]
-            )[:, landmarks_to_return],
+            all_uids[rows].tolist(),
+            all_coordinates[rows][:, landmarks_to_return],
         )
     )
-    #
 
     return return_dict
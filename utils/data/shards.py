@@ -0,0 +1,142 @@
+"""Sharded sample archives, for streaming large datasets with sequential reads (see datasets.dataset_stream).
+
+A shards directory holds one subdirectory per datalist split (e.g. "testing"). Each split is a sequence of tar files
+(shard-000000.tar, shard-000001.tar, ...) and an index file, shards.json, listing the shards and their sample counts.
+Each sample is two consecutive tar members: "<sample number>.json", the sample's datalist entry, followed by
+"<sample number>.image", the raw bytes of its image file. Images are stored as they are on disk, so they are decoded
+by the same loaders (get_datatype_load) as images read from their paths.
+
+To convert a JSON datalist to shards:
+    python -m utils.data.shards --datalist /path/to/fold0.json --output_dir /path/to/shards
+"""
+
+import argparse
+import io
+import json
+import os
+import tarfile
+import tempfile
+
+from utils.data.load_data import load_aspire_datalist
+
+SHARD_INDEX_FILE = "shards.json"
+
+
+def _add_tar_member(tar_f, name, payload):
+    member = tarfile.TarInfo(name)
+    member.size = len(payload)
+    tar_f.addfile(member, io.BytesIO(payload))
+
+
+def _write_shard(shard_path, samples):
+    """Write one shard atomically, so a reader never opens a partially written shard."""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(shard_path), suffix=".tmp", delete=False) as tmp_f:
+        with tarfile.open(fileobj=tmp_f, mode="w") as tar_f:
+            for sample_number, data in samples:
+                with open(data["image"], "rb") as image_f:
+                    image_bytes = image_f.read()
+                _add_tar_member(tar_f, "%09d.json" % sample_number, json.dumps(data).encode("utf-8"))
+                _add_tar_member(tar_f, "%09d.image" % sample_number, image_bytes)
+    os.replace(tmp_f.name, shard_path)
+
+
+def write_split_shards(datalist, output_dir, samples_per_shard=1000):
+    """Write a datalist (as returned by load_aspire_datalist) to shards in output_dir, with a shards.json index.
+
+    Args:
+        datalist ([dict]): samples, with "image" the path to the image file.
+        output_dir (str): directory to write the shards of this split to.
+        samples_per_shard (int, optional): number of samples in each shard. Defaults to 1000.
+
+    Returns:
+        dict: the shard index, {"num_samples": int, "shards": [{"path": str, "num_samples": int}]}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    shard_index = {"num_samples": len(datalist), "shards": []}
+    for shard_number, start in enumerate(range(0, len(datalist), samples_per_shard)):
+        samples = list(enumerate(datalist[start: start + samples_per_shard], start=start))
+        shard_name = "shard-%06d.tar" % shard_number
+        _write_shard(os.path.join(output_dir, shard_name), samples)
+        shard_index["shards"].append({"path": shard_name, "num_samples": len(samples)})
+
+    with open(os.path.join(output_dir, SHARD_INDEX_FILE), "w") as index_f:
+        json.dump(shard_index, index_f, indent=1)
+
+    return shard_index
+
+
+def write_shards(data_list_file_path, output_dir, base_dir=None, data_list_keys=None, samples_per_shard=1000):
+    """Convert a JSON datalist to shards, one subdirectory of output_dir per split.
+
+    Args:
+        data_list_file_path (str): path to the JSON datalist.
+        output_dir (str): shards directory.
+        base_dir (str, optional): root path of the images, as in load_aspire_datalist. Defaults to None.
+        data_list_keys ([str], optional): splits to convert. Defaults to None, i.e. every split in the datalist.
+        samples_per_shard (int, optional): number of samples in each shard. Defaults to 1000.
+
+    Returns:
+        dict: the shard index of each split.
+    """
+    if data_list_keys is None:
+        with open(data_list_file_path) as json_file:
+            data_list_keys = list(json.load(json_file).keys())
+
+    shard_indices = {}
+    for data_list_key in data_list_keys:
+        datalist = load_aspire_datalist(data_list_file_path, data_list_key=data_list_key, base_dir=base_dir)
+        shard_indices[data_list_key] = write_split_shards(
+            datalist, os.path.join(output_dir, data_list_key), samples_per_shard=samples_per_shard)
+
+    return shard_indices
+
+
+def load_shard_index(split_dir):
+    """Load the shard index of a split and resolve the shard paths.
+
+    Args:
+        split_dir (str): directory of the shards of a split.
+
+    Returns:
+        dict: the shard index, with absolute shard paths.
+    """
+    with open(os.path.join(split_dir, SHARD_INDEX_FILE)) as index_f:
+        shard_index = json.load(index_f)
+
+    for shard in shard_index["shards"]:
+        shard["path"] = os.path.join(split_dir, shard["path"])
+    return shard_index
+
+
+def read_shard(shard_path):
+    """Iterate over the samples of a shard, reading the tar file sequentially.
+
+    Args:
+        shard_path (str): path to the shard.
+
+    Yields:
+        (dict, bytes): the sample's datalist entry and the raw bytes of its image file.
+    """
+    with tarfile.open(shard_path, mode="r|") as tar_f:
+        data = None
+        for member in tar_f:
+            payload = tar_f.extractfile(member).read()
+            if member.name.endswith(".json"):
+                data = json.loads(payload)
+            else:
+                yield data, payload
+                data = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a JSON datalist to sample shards for streaming.")
+    parser.add_argument("--datalist", type=str, required=True, help="Path to the JSON datalist.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Shards directory to write.")
+    parser.add_argument("--root", type=str, default=None, help="Root path of the images (DATASET.ROOT).")
+    parser.add_argument("--splits", type=str, nargs="+", default=None, help="Splits to convert. Default: all.")
+    parser.add_argument("--samples_per_shard", type=int, default=1000, help="Number of samples in each shard.")
+    args = parser.parse_args()
+
+    write_shards(args.datalist, args.output_dir, base_dir=args.root, data_list_keys=args.splits,
+                 samples_per_shard=args.samples_per_shard)
@@ -1,5 +1,9 @@
 import logging
+import math
+from functools import lru_cache
 import torch
+import torch.nn.functional as F
+from torchvision.transforms import Resize, InterpolationMode
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patchesplt
@@ -234,6 +238,212 @@ def get_coords_fit_gauss(images, predicted_coords_all, visualize=False):
     return all_final_coords, all_hm_maxes, all_fitted_dicts
 
 
+def get_coords_fit_gauss_batch(images, predicted_coords_all, window_radius=32, iterations=10):
+    """Batched torch version of get_coords_fit_gauss, on the device of the heatmaps. Fits the same 2D Gaussian (with
+    offset) to all heatmaps at once, only in a window around each heatmap's predicted coordinates (e.g. the argmax).
+
+    The fit starts from the window's moments (mean and covariance, above the window's minimum) and is refined with
+    vectorized Levenberg-Marquardt (damped Gauss-Newton) steps. The Gaussian is fitted on the same coordinates as
+    get_coords_fit_gauss, np.linspace(0, size, size).
+
+    A windowed fit is not trusted if it is not a Gaussian peak (e.g. a flat heatmap), if it has not converged or if its
+    2 sigma ellipse reaches the edge of the window (a heatmap broader than the window). These heatmaps are refitted over
+    the whole heatmap with get_coords_fit_gauss, and get a NaN covariance if that fit fails too.
+
+    Args:
+        images (torch.Tensor): (B, L, H, W) heatmaps.
+        predicted_coords_all (torch.Tensor): (B, L, 2) [x, y] pixel coordinates to center the windows on.
+        window_radius (int, optional): the window is 2 * window_radius + 1 pixels wide. Defaults to 32.
+        iterations (int, optional): number of Levenberg-Marquardt steps. Defaults to 10.
+
+    Returns:
+        ([[[float, float]]], [[float]], [[dict]]): for each sample and landmark, the fitted mean coordinates, the fitted
+         amplitude and the fitted_dicts, as get_coords_fit_gauss.
+    """
+    heatmaps = images.detach().double()
+    batch_size, num_landmarks, height, width = heatmaps.shape
+    device = heatmaps.device
+
+    # Pixels of the windows, masking the ones outside the heatmap.
+    offsets = torch.arange(-window_radius, window_radius + 1, device=device)
+    centers = torch.round(predicted_coords_all.detach().to(device)).long()
+    cols = centers[..., 0, None] + offsets
+    rows = centers[..., 1, None] + offsets
+    mask = ((rows >= 0) & (rows < height))[..., :, None] & ((cols >= 0) & (cols < width))[..., None, :]
+    cols = cols.clamp(0, width - 1)
+    rows = rows.clamp(0, height - 1)
+    values = torch.gather(heatmaps.flatten(2), 2, (rows[..., :, None] * width + cols[..., None, :]).flatten(2))
+    mask = mask.flatten(2).double()
+
+    window_size = offsets.shape[0]
+    x = (cols * (width / (width - 1)))[..., None, :].expand(-1, -1, window_size, -1).flatten(2).double()
+    y = (rows * (height / (height - 1)))[..., :, None].expand(-1, -1, -1, window_size).flatten(2).double()
+
+    # Initial guess from the moments of the window above half maximum, over the window's median as background.
+    background = torch.where(mask > 0, values, torch.full_like(values, np.nan)).nanmedian(dim=-1, keepdim=True)[0]
+    window_max = torch.where(mask > 0, values, torch.full_like(values, -np.inf)).amax(dim=-1, keepdim=True)
+    half_max = (window_max + background) / 2
+    weights = (values - half_max).clamp(min=0) * mask
+    total = weights.sum(dim=-1, keepdim=True).clamp(min=1e-12)
+    mean_x = (weights * x).sum(dim=-1, keepdim=True) / total
+    mean_y = (weights * y).sum(dim=-1, keepdim=True) / total
+    # Above half maximum, these moments are a fixed fraction of the Gaussian's covariance. Plus the variance of a
+    # pixel, so a single-pixel peak still has an invertible covariance.
+    half_max_fraction = (1 - (1 + np.log(2)) / 2 - np.log(2) ** 2 / 4) / (1 / 2 - np.log(2) / 2)
+    cov_xx = (weights * (x - mean_x) ** 2).sum(dim=-1, keepdim=True) / total / half_max_fraction + 1 / 12
+    cov_xy = (weights * (x - mean_x) * (y - mean_y)).sum(dim=-1, keepdim=True) / total / half_max_fraction
+    cov_yy = (weights * (y - mean_y) ** 2).sum(dim=-1, keepdim=True) / total / half_max_fraction + 1 / 12
+    det = cov_xx * cov_yy - cov_xy**2
+
+    # Parameters amplitude, x0, y0, the quadratic form [[a, b], [b, c]] (= inverse covariance / 2) and offset.
+    params = torch.cat(
+        [window_max - background, mean_x, mean_y, 0.5 * cov_yy / det, -0.5 * cov_xy / det, 0.5 * cov_xx / det,
+         background],
+        dim=-1,
+    )
+
+    def residuals_and_jacobian(params):
+        amplitude, x0, y0, a, b, c, offset = params[..., None, :].unbind(-1)
+        dx = x - x0
+        dy = y - y0
+        exponential = torch.exp(-(a * dx**2 + 2 * b * dx * dy + c * dy**2))
+        residuals = (offset + amplitude * exponential - values) * mask
+        weighted = amplitude * exponential
+        jacobian = torch.stack(
+            [
+                exponential,
+                weighted * 2 * (a * dx + b * dy),
+                weighted * 2 * (b * dx + c * dy),
+                -weighted * dx**2,
+                -weighted * 2 * dx * dy,
+                -weighted * dy**2,
+                torch.ones_like(exponential),
+            ],
+            dim=-1,
+        ) * mask[..., None]
+        return residuals, jacobian
+
+    residuals, jacobian = residuals_and_jacobian(params)
+    cost = (residuals**2).sum(dim=-1)
+    damping = torch.full_like(cost, 1e-3)
+    identity = torch.eye(params.shape[-1], dtype=params.dtype, device=device)
+    for _ in range(iterations):
+        jtj = jacobian.transpose(-1, -2) @ jacobian
+        gradient = (jacobian.transpose(-1, -2) @ residuals[..., None])[..., 0]
+        damped = jtj + (damping[..., None, None] * torch.diagonal(jtj, dim1=-2, dim2=-1)[..., None, :] + 1e-12) * identity
+        step = torch.linalg.solve(damped, -gradient)
+
+        new_params = params + step
+        new_residuals, new_jacobian = residuals_and_jacobian(new_params)
+        new_cost = (new_residuals**2).sum(dim=-1)
+
+        # Only keep steps that reduce the cost, otherwise damp more.
+        accept = new_cost < cost
+        params = torch.where(accept[..., None], new_params, params)
+        residuals = torch.where(accept[..., None], new_residuals, residuals)
+        jacobian = torch.where(accept[..., None, None], new_jacobian, jacobian)
+        cost = torch.where(accept, new_cost, cost)
+        damping = torch.where(accept, damping / 10, damping * 10)
+
+    # Covariance and its sigmas and rotation, as parameterized in twoD_Gaussian.
+    amplitude, x0, y0, a, b, c, offset = params.unbind(-1)
+    det = a * c - b**2
+    cov_xx, cov_xy, cov_yy = 0.5 * c / det, -0.5 * b / det, 0.5 * a / det
+
+    # Converged if a full Gauss-Newton step would barely move the mean and the quadratic form.
+    jtj = jacobian.transpose(-1, -2) @ jacobian
+    gradient = (jacobian.transpose(-1, -2) @ residuals[..., None])[..., 0]
+    step = torch.linalg.solve(jtj + 1e-12 * identity, -gradient)
+    converged = (step[..., 1:3].abs().amax(dim=-1) < 1e-2) & (
+        step[..., 3:6].abs().amax(dim=-1) < 1e-2 * torch.sqrt((a * c).abs()))
+
+    # The 2 sigma ellipse of the fit must stay inside the window, around the window's center.
+    max_variance = (cov_xx + cov_yy) / 2 + torch.sqrt(((cov_xx - cov_yy) / 2) ** 2 + cov_xy**2)
+    spread = 2 * torch.sqrt(max_variance)
+    in_window = (
+        ((x0 - centers[..., 0] * (width / (width - 1))).abs() + spread <= window_radius)
+        & ((y0 - centers[..., 1] * (height / (height - 1))).abs() + spread <= window_radius)
+    )
+    is_peak = torch.isfinite(params).all(dim=-1) & (amplitude > 0) & (a > 0) & (c > 0) & (det > 0)
+    trusted = (is_peak & converged & in_window).cpu().numpy()
+    angle = 0.5 * torch.atan2(2 * cov_xy, cov_xx - cov_yy)
+    variance_x = cov_xx * torch.cos(angle) ** 2 + 2 * cov_xy * torch.sin(angle) * torch.cos(angle) + cov_yy * torch.sin(angle) ** 2
+    variance_y = cov_xx + cov_yy - variance_x
+    sigma_x = torch.sqrt(variance_x.clamp(min=0))
+    sigma_y = torch.sqrt(variance_y.clamp(min=0))
+    theta = -angle
+
+    fitted = torch.stack([amplitude, x0, y0, sigma_x, sigma_y, theta, offset, cov_xx, cov_xy, cov_yy], dim=-1)
+    fitted = fitted.cpu().numpy()
+
+    all_fitted_dicts = []
+    all_hm_maxes = []
+    all_final_coords = []
+    for sample_idx, sample_fitted in enumerate(fitted):
+        fitted_dicts = []
+        hm_maxes = []
+        final_coords = []
+        for hm_idx, (amplitude, x0, y0, sigma_x, sigma_y, theta, offset, cov_xx, cov_xy, cov_yy) in enumerate(
+            sample_fitted
+        ):
+            if not trusted[sample_idx, hm_idx]:
+                coords, hm_max, fitted_dict = _refit_gauss_full_heatmap(
+                    images[sample_idx: sample_idx + 1, hm_idx: hm_idx + 1],
+                    predicted_coords_all[sample_idx: sample_idx + 1, hm_idx: hm_idx + 1],
+                )
+                final_coords.append(coords)
+                hm_maxes.append(hm_max)
+                fitted_dicts.append(fitted_dict)
+                continue
+
+            final_coords.append([x0, y0])
+            hm_maxes.append(amplitude)
+            fitted_dicts.append(
+                {
+                    "amplitude": amplitude,
+                    "mean": [x0, y0],
+                    "sigma": [sigma_x, sigma_y],
+                    "theta": np.degrees(theta),
+                    "offset": offset,
+                    "covariance": [[cov_xx, cov_xy], [cov_xy, cov_yy]],
+                    "sigma_prod": sigma_x * sigma_y,
+                    "sigma_ratio": max(sigma_x, sigma_y) / min(sigma_x, sigma_y),
+                }
+            )
+        all_fitted_dicts.append(fitted_dicts)
+        all_final_coords.append(final_coords)
+        all_hm_maxes.append(hm_maxes)
+    return all_final_coords, all_hm_maxes, all_fitted_dicts
+
+
+def _refit_gauss_full_heatmap(image, predicted_coords):
+    """get_coords_fit_gauss of one heatmap, for the fits get_coords_fit_gauss_batch does not trust. If curve_fit fails
+    too, the predicted coordinates are kept with a NaN covariance.
+
+    Args:
+        image (torch.Tensor): (1, 1, H, W) heatmap.
+        predicted_coords (torch.Tensor): (1, 1, 2) [x, y] predicted coordinates.
+
+    Returns:
+        ([float, float], float, dict): fitted mean coordinates, fitted amplitude and fitted_dict.
+    """
+    try:
+        final_coords, hm_maxes, fitted_dicts = get_coords_fit_gauss(image, predicted_coords)
+        return final_coords[0][0], hm_maxes[0][0], fitted_dicts[0][0]
+    except (RuntimeError, ValueError, opt.OptimizeWarning):
+        x0, y0 = predicted_coords[0, 0].detach().cpu().double().numpy()
+        return [x0, y0], np.nan, {
+            "amplitude": np.nan,
+            "mean": [x0, y0],
+            "sigma": [np.nan, np.nan],
+            "theta": np.nan,
+            "offset": np.nan,
+            "covariance": [[np.nan, np.nan], [np.nan, np.nan]],
+            "sigma_prod": np.nan,
+            "sigma_ratio": np.nan,
+        }
+
+
 def get_coords(images):
     """get predictions from score maps in torch Tensor
     return type: torch.LongTensor
@@ -271,6 +481,101 @@ def get_coords(images):
     return preds, maxval
 
 
+@lru_cache(16)
+def bicubic_resize_matrix(input_length, output_length, device):
+    """The (output_length, input_length) matrix of torchvision's bicubic Resize along one axis, so resizing an image to
+    [h, w] is resize_matrix_h @ image @ resize_matrix_w.T. Built by resizing the identity with Resize itself, so it uses
+    the same kernel and border handling (e.g. antialiasing) as Resize in this torchvision version.
+    """
+    # Resized along the width: antialiased bicubic resizing of (N, 1) images along the height is wrong in some torch
+    # versions.
+    identity = torch.eye(input_length, device=device)[:, None, :]
+    resized = Resize([1, output_length], interpolation=InterpolationMode.BICUBIC)(identity)
+    return resized[:, 0, :].T.contiguous()
+
+
+def _roi_resize_weights(peaks, input_length, output_length, roi_radius):
+    """Along one axis, the output pixels of the windows around the peaks, and the input pixels and resize weights
+    they are interpolated from.
+
+    Args:
+        peaks (torch.Tensor): (B, L) input pixel of each peak.
+        input_length (int): input size along the axis.
+        output_length (int): resized size along the axis.
+        roi_radius (int): the windows cover roi_radius input pixels either side of the peaks.
+
+    Returns:
+        torch.Tensor, torch.Tensor, torch.Tensor: (B, L, K) output pixels, (B, L, T) input pixels (clamped to the
+         input) and (B, L, K, T) weights, 0 for input pixels outside the input.
+    """
+    resize_matrix = bicubic_resize_matrix(input_length, output_length, peaks.device)
+    scale = output_length / input_length
+
+    # Output pixels whose centres map to within roi_radius input pixels of the peak, shifted inside the output.
+    window = min(output_length, math.ceil(2 * roi_radius * scale) + 1)
+    start = torch.round((peaks + 0.5) * scale - 0.5).long() - window // 2
+    start = start.clamp(0, output_length - window)
+    output_pixels = start[..., None] + torch.arange(window, device=peaks.device)
+
+    # Input pixels the window is interpolated from: the bicubic kernel reaches 2 pixels, 2 / scale when downsampling.
+    support = math.ceil(2 / min(scale, 1)) + 1
+    input_start = torch.floor((start + 0.5) / scale - 0.5).long() - support
+    input_pixels = input_start[..., None] + torch.arange(
+        math.ceil(window / scale) + 2 * support + 2, device=peaks.device
+    )
+    inside = (input_pixels >= 0) & (input_pixels < input_length)
+    input_pixels = input_pixels.clamp(0, input_length - 1)
+
+    weights = resize_matrix[output_pixels[..., :, None], input_pixels[..., None, :]] * inside[..., None, :]
+    return output_pixels, input_pixels, weights
+
+
+def get_coords_resized_roi(images, output_size, roi_radius=2):
+    """Coordinates and values of the maxima of the heatmaps bicubically resized to output_size, as
+    get_coords(Resize(output_size)(images)) but without resizing the whole heatmaps. Only a window of roi_radius input
+    pixels either side of each heatmap's argmax is resized, at output pixel spacing, and the maximum is taken there.
+
+    Matches the full resize unless the resized maximum is outside the window, i.e. another peak of the heatmap is
+    about as high as its argmax.
+
+    Args:
+        images (torch.Tensor): (B, L, H, W) heatmaps.
+        output_size ([int, int]): [h, w] size to resize to, as Resize.
+        roi_radius (int, optional): radius of the windows in input pixels. Defaults to 2.
+
+    Returns:
+        torch.Tensor, torch.Tensor: (B, L, 2) [x, y] coordinates at output_size and (B, L, 1) maximum values, as
+         get_coords.
+    """
+    batch_size, num_landmarks, height, width = images.shape
+    peaks = torch.argmax(images.flatten(2), dim=2)
+
+    output_rows, input_rows, row_weights = _roi_resize_weights(
+        torch.div(peaks, width, rounding_mode="floor"), height, int(output_size[0]), roi_radius
+    )
+    output_cols, input_cols, col_weights = _roi_resize_weights(peaks % width, width, int(output_size[1]), roi_radius)
+
+    crops = torch.gather(
+        images.flatten(2), 2, (input_rows[..., :, None] * width + input_cols[..., None, :]).flatten(2)
+    ).view(batch_size, num_landmarks, input_rows.shape[-1], input_cols.shape[-1])
+    resized_windows = row_weights.to(images.dtype) @ crops @ col_weights.to(images.dtype).transpose(-1, -2)
+
+    maxval, idx = torch.max(resized_windows.flatten(2), dim=2)
+    window_width = output_cols.shape[-1]
+    preds = torch.stack(
+        [
+            torch.gather(output_cols, 2, (idx % window_width)[..., None])[..., 0],
+            torch.gather(output_rows, 2, torch.div(idx, window_width, rounding_mode="floor")[..., None])[..., 0],
+        ],
+        dim=2,
+    ).float()
+
+    # As get_coords, heatmaps without a positive maximum give (0, 0).
+    maxval = maxval[..., None]
+    preds *= maxval.gt(0).float()
+    return preds, maxval
+
+
 def candidate_smoothing(
     output,
     full_resolution,
@@ -420,3 +725,60 @@ def candidate_smoothing(
             plt.show()
 
     return torch.stack(smoothed_heatmaps)
+
+
+def candidate_smoothing_batch(output, full_resolution, maxpool_factor, log_displacement_bool=True):
+    """Batched torch version of candidate_smoothing, on the device of the model output. All the displacement votes are
+    computed at once and scatter-added into vote maps, which are blurred with a separable convolution by the same
+    Gaussian blob (sigma 1, 10x10) as gaussian_gen_fast and multiplied by the upsampled heatmaps.
+
+    Args:
+        output ([torch.Tensor, torch.Tensor]): the model's (B, L, H, W) patch heatmaps and (B, L, 2, H, W) x, y
+            displacements.
+        full_resolution ([int, int]): resolution of the candidate smoothed maps, the heatmap size times
+            2**maxpool_factor, as in candidate_smoothing.
+        maxpool_factor (int): patches are 2**maxpool_factor pixels wide.
+        log_displacement_bool (bool, optional): whether the displacements are log2 transformed. Defaults to True.
+
+    Returns:
+        torch.Tensor: (B, L, full_resolution[0], full_resolution[1]) candidate smoothed maps.
+    """
+    predicted_heatmap, predicted_disps = output
+    batch_size, num_landmarks = predicted_heatmap.shape[:2]
+    device = predicted_heatmap.device
+    step_size = 2**maxpool_factor
+    height, width = int(full_resolution[0]), int(full_resolution[1])
+
+    upscaled_hm = predicted_heatmap.repeat_interleave(step_size, dim=2).repeat_interleave(step_size, dim=3)
+
+    # Votes of each patch center, [x, y] displacements indexed [x_idx, y_idx]. Log displacements are exponentiated in
+    # float64, as in candidate_smoothing.
+    if log_displacement_bool:
+        disps = torch.sign(predicted_disps) * (2 ** torch.abs(predicted_disps.double()))
+    else:
+        disps = predicted_disps
+    centers_x = torch.arange(predicted_disps.shape[3], device=device) * step_size + (step_size // 2)
+    centers_y = torch.arange(predicted_disps.shape[4], device=device) * step_size + (step_size // 2)
+    locs_x = (centers_x[:, None] + disps[:, :, 0]).flatten(2)
+    locs_y = (centers_y[None, :] + disps[:, :, 1]).flatten(2)
+
+    # Votes in the image, rounded to the nearest pixel as in gaussian_gen_fast.
+    in_image = (locs_x >= 0) & (locs_x <= full_resolution[0]) & (locs_y >= 0) & (locs_y <= full_resolution[1])
+    pixels_x = torch.round(locs_x).long()
+    pixels_y = torch.round(locs_y).long()
+    in_image &= (pixels_x < width) & (pixels_y < height)
+
+    vote_heatmap = torch.zeros((batch_size * num_landmarks, height * width), dtype=upscaled_hm.dtype, device=device)
+    vote_heatmap.scatter_add_(
+        1,
+        torch.where(in_image, pixels_y * width + pixels_x, 0).view(batch_size * num_landmarks, -1),
+        in_image.to(upscaled_hm.dtype).view(batch_size * num_landmarks, -1),
+    )
+
+    # The blob covers offsets -5 to 4 from the vote, as a cross-correlation kernel offsets 4 to -5.
+    blob = torch.exp(-(torch.arange(4, -6, -1, dtype=upscaled_hm.dtype, device=device) ** 2.0) / 2.0)
+    vote_heatmap = F.pad(vote_heatmap.view(-1, 1, height, width), (4, 5, 4, 5))
+    vote_heatmap = F.conv2d(vote_heatmap, blob.view(1, 1, -1, 1))
+    vote_heatmap = F.conv2d(vote_heatmap, blob.view(1, 1, 1, -1))
+
+    return vote_heatmap.view(batch_size, num_landmarks, height, width) * upscaled_hm
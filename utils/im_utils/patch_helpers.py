@@ -5,10 +5,121 @@ from utils.im_utils.visualisation import visualize_centre_patch, visualize_patch
 import logging
 
 
+def landmarks_in_patch(landmarks, x_y_corner, sample_patch_size, lm_safe_region=0):
+    """Binary indicator of which landmarks are in the patch with top left corner x_y_corner.
+
+    Args:
+        landmarks ([[float, float]]): list of landmarks.
+        x_y_corner ([int, int]): top left corner of the patch.
+        sample_patch_size ([int, int]): size of the patch.
+        lm_safe_region (int, optional): # pixels away from the edge the landmark must be to count as "in" the patch. Defaults to 0.
+
+    Returns:
+        [int]: 1 if the landmark is in the patch, else 0.
+    """
+    landmarks_in_indicator = []
+    for lm in landmarks:
+        landmark_in = 0
+
+        # Safe region means landmark is not right on the edge
+        if (
+            x_y_corner[1] + lm_safe_region
+            <= lm[1]
+            <= (x_y_corner[1] + sample_patch_size[1]) - lm_safe_region
+        ):
+            if (
+                x_y_corner[0] + lm_safe_region
+                <= lm[0]
+                <= (x_y_corner[0] + sample_patch_size[0]) - lm_safe_region
+            ):
+                landmark_in = 1
+
+        landmarks_in_indicator.append(landmark_in)
+    return landmarks_in_indicator
+
+
+def sample_landmark_patch_corner(landmarks, load_im_size, sample_patch_size, lm_safe_region=0):
+    """Samples a patch corner uniformly from all the corners whose patch contains at least one landmark, in bounded time.
+        This is the same distribution as drawing corners uniformly until a landmark is in the patch, without the
+        rejection loop.
+
+        The corners putting each landmark in the patch form a rectangle. The union of the rectangles is split into the
+        cells of the grid on the rectangle edges, each cell inside or outside the union, so a cell is drawn with
+        probability proportional to its area in the union, and then a corner uniformly within the cell.
+
+    Args:
+        landmarks ([[float, float]]): list of landmarks.
+        load_im_size ([int, int]): size of the image.
+        sample_patch_size ([int, int]): size of the patch.
+        lm_safe_region (int, optional): # pixels away from the edge the landmark must be to count as "in" the patch. Defaults to 0.
+
+    Returns:
+        [int, int] or None: x, y corner of the patch, or None if no patch can contain a landmark.
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float64).reshape(-1, 2)
+    patch_size = np.asarray(sample_patch_size[:2])
+
+    # Corners are drawn from [0, load_im_size - sample_patch_size), as np.random.randint.
+    max_corner = np.asarray(load_im_size[:2]) - patch_size - 1
+
+    # Half open [low, high) corner ranges putting each landmark in the patch.
+    low = np.maximum(np.ceil(landmarks - patch_size + lm_safe_region), 0)
+    high = np.minimum(np.floor(landmarks - lm_safe_region), max_corner) + 1
+    has_corners = np.all(low < high, axis=1)
+    low, high = low[has_corners].astype(np.int64), high[has_corners].astype(np.int64)
+    if len(low) == 0:
+        return None
+
+    x_edges = np.unique(np.concatenate([low[:, 0], high[:, 0]]))
+    y_edges = np.unique(np.concatenate([low[:, 1], high[:, 1]]))
+
+    # A cell is in the union if it is in any rectangle, shape (# x cells, # y cells).
+    cell_x, cell_y = x_edges[:-1], y_edges[:-1]
+    cell_in_union = np.any(
+        (low[:, 0, None, None] <= cell_x[None, :, None])
+        & (cell_x[None, :, None] < high[:, 0, None, None])
+        & (low[:, 1, None, None] <= cell_y[None, None, :])
+        & (cell_y[None, None, :] < high[:, 1, None, None]),
+        axis=0,
+    )
+    cell_areas = (np.diff(x_edges)[:, None] * np.diff(y_edges)[None, :]) * cell_in_union
+
+    cell = np.random.choice(cell_areas.size, p=(cell_areas / cell_areas.sum()).ravel())
+    x_cell, y_cell = np.unravel_index(cell, cell_areas.shape)
+
+    return [
+        int(np.random.randint(x_edges[x_cell], x_edges[x_cell + 1])),
+        int(np.random.randint(y_edges[y_cell], y_edges[y_cell + 1])),
+    ]
+
+
+def crop_zero_padded(image, x_y_corner, patch_size):
+    """Crops image[0] from x_y_corner with size patch_size, as if the image was padded with zeros on every side.
+        Only the patch is allocated, rather than a padded copy of the whole image.
+
+    Args:
+        image (np.array): image, (channels, height, width).
+        x_y_corner ([int, int]): top left corner of the crop, can be negative or past the image edges.
+        patch_size ([int, int]): size of the crop.
+
+    Returns:
+        np.array: the crop, (1, patch_size[1], patch_size[0]).
+    """
+    x_min, y_min = x_y_corner
+    height, width = image.shape[-2:]
+    crop = np.zeros((1, patch_size[1], patch_size[0]), dtype=image.dtype)
+
+    y_start, y_end = max(y_min, 0), min(y_min + patch_size[1], height)
+    x_start, x_end = max(x_min, 0), min(x_min + patch_size[0], width)
+    if y_start < y_end and x_start < x_end:
+        crop[0, y_start - y_min: y_end - y_min, x_start - x_min: x_end - x_min] = image[0, y_start:y_end, x_start:x_end]
+    return crop
+
+
 def sample_patch_with_bias(image, landmarks, sample_patch_bias, load_im_size,  sample_patch_size, logger, debug, lm_safe_region=0, safe_padding=128):
     """Samples a patch from the image. It ensures a landmark is in a patch with a self.sample_patch_bias% chance.
         The patch image is larger than the patch-size by safe_padding on every side for safer data augmentation.
-        Therefore, the image is first padded with zeros on each side to stop out of bounds when sampling from the edges.
+        Therefore, the patch is padded with zeros where it is past the image edges.
 
     Args:
         image (_type_): image to sample
@@ -33,87 +144,32 @@ def sample_patch_with_bias(image, landmarks, sample_patch_bias, load_im_size,  s
         x_rand = 0
         y_rand = 0
     else:
+        x_y_corner = None
         if z_rand >= (1 - sample_patch_bias):
+            # Sample directly from the corners with a landmark in the patch.
+            x_y_corner = sample_landmark_patch_corner(landmarks, load_im_size, sample_patch_size, lm_safe_region)
+            if x_y_corner is None:
+                logger.warning("No patch can contain a landmark of %s, sampling the patch uniformly.", landmarks)
+
+        if x_y_corner is None:
+            x_y_corner = [
+                np.random.randint(0, load_im_size[0] - sample_patch_size[0]),
+                np.random.randint(0, load_im_size[1] - sample_patch_size[1]),
+            ]
 
-            # Keep sampling until landmark is in patch
-            while 1 not in landmarks_in_indicator:
-                landmarks_in_indicator = []
-
-                #
-                y_rand = np.random.randint(
-                    0, load_im_size[1] - sample_patch_size[1]
-                )
-                x_rand = np.random.randint(
-                    0, load_im_size[0] - sample_patch_size[0]
-                )
-
-                for lm in landmarks:
-                    landmark_in = 0
-
-                    # Safe region means landmark is not right on the edge
-                    if (
-                        y_rand + lm_safe_region
-                        <= lm[1]
-                        <= (y_rand + sample_patch_size[1]) - lm_safe_region
-                    ):
-                        if (
-                            x_rand + lm_safe_region
-                            <= lm[0]
-                            <= (x_rand + sample_patch_size[0]) - lm_safe_region
-                        ):
-                            landmark_in = 1
-
-                    landmarks_in_indicator.append(landmark_in)
-
-                # Tested with the extremes, its all ok.
-                # y_rand = self.load_im_size[1]-self.sample_patch_size[1]
-                # x_rand = self.load_im_size[0]-self.sample_patch_size[0]
-                # y_rand = 0
-                # x_rand = 0
-                # y_rand = safe_padding
-                # x_rand = self.load_im_size[0]-self.sample_patch_size[0]
-
-        else:
-            y_rand = np.random.randint(
-                0, load_im_size[1] - sample_patch_size[1]
-            )
-            x_rand = np.random.randint(
-                0, load_im_size[0] - sample_patch_size[0]
-            )
-
-            for lm in landmarks:
-                landmark_in = 0
-                if (
-                    y_rand + lm_safe_region
-                    <= lm[1]
-                    <= y_rand + sample_patch_size[1] - lm_safe_region
-                ):
-                    if (
-                        x_rand + lm_safe_region
-                        <= lm[0]
-                        <= (x_rand + sample_patch_size[0]) - lm_safe_region
-                    ):
-                        landmark_in = 1
-                landmarks_in_indicator.append(landmark_in)
+        x_rand, y_rand = x_y_corner
+        landmarks_in_indicator = landmarks_in_patch(landmarks, x_y_corner, sample_patch_size, lm_safe_region)
 
     # Add the safe padding size
     y_rand_safe = y_rand + safe_padding
     x_rand_safe = x_rand + safe_padding
 
-    # First pad image
-    padded_image = np.expand_dims(
-        np.pad(image[0], (safe_padding, safe_padding)), axis=0
-    )
     padded_patch_size = [x + (2 * safe_padding) for x in sample_patch_size]
 
-    # We pad before and after the slice.
-    y_rand_pad = y_rand_safe - safe_padding
-    x_rand_pad = x_rand_safe - safe_padding
-    cropped_padded_sample = padded_image[
-        :,
-        y_rand_pad: y_rand_pad + padded_patch_size[1],
-        x_rand_pad: x_rand_pad + padded_patch_size[0],
-    ]
+    # The padded patch starts safe_padding before the patch corner, zero padded past the image edges.
+    cropped_padded_sample = crop_zero_padded(
+        image, [x_rand - safe_padding, y_rand - safe_padding], padded_patch_size
+    )
 
     # Calculate the new origin: 2*safe_padding bc we padded image & then added pad to the patch.
     normalized_landmarks = [
@@ -125,6 +181,9 @@ def sample_patch_with_bias(image, landmarks, sample_patch_bias, load_im_size,  s
     ]
 
     if debug:
+        padded_image = np.expand_dims(
+            np.pad(image[0], (safe_padding, safe_padding)), axis=0
+        )
         padded_lm = [
             [lm[0] + safe_padding, lm[1] + safe_padding] for lm in landmarks
         ]
@@ -133,8 +192,8 @@ def sample_patch_with_bias(image, landmarks, sample_patch_bias, load_im_size,  s
             "\n \n \n the min xy is [%s,%s]. padded is [%s, %s] normal landmark is %s, padded lm is %s \
             and the normalized landmark is %s : ",                    y_rand_safe,
             x_rand_safe,
-            x_rand_pad,
-            y_rand_pad,
+            x_rand,
+            y_rand,
             landmarks,
             padded_lm,
             normalized_landmarks,
@@ -147,7 +206,7 @@ def sample_patch_with_bias(image, landmarks, sample_patch_bias, load_im_size,  s
             padded_lm[0],
             cropped_padded_sample[0],
             normalized_landmarks[0],
-            [x_rand_pad, y_rand_pad],
+            [x_rand, y_rand],
         )
     return (
         cropped_padded_sample,
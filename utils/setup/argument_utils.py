@@ -5,6 +5,7 @@ from pathlib import Path
 from datetime import datetime
 import argparse
 from config import get_cfg_defaults  # pylint: disable=import-error
+from transforms.dataloader_transforms import BATCH_AUG_STRATEGIES, FUSED_AUG_STRATEGIES
 from yacs.config import CfgNode as CN
 
 
@@ -20,10 +21,11 @@ def get_evaluation_mode(eval_mode):
         ValueError: if eval_mode is not supported
 
     Returns:
-        bool, bool: settings for the evaluation modes.
+        bool, bool, bool: settings for the evaluation modes.
     """
 
     # Evaluate on input size to network, using coordinates resized to the input size
+    resize_roi = False
     if eval_mode == "use_input_size":
         use_full_res_coords = False
         resize_first = False
@@ -35,11 +37,16 @@ def get_evaluation_mode(eval_mode):
     elif eval_mode == "scale_pred_coords":
         use_full_res_coords = True
         resize_first = False
+    # As scale_heatmap_first, but only scale a window around each heatmap peak up to full resolution.
+    elif eval_mode == "scale_heatmap_roi":
+        use_full_res_coords = True
+        resize_first = True
+        resize_roi = True
     else:
         raise ValueError(
-            "value for cg.INFERENCE.EVALUATION_MODE not recognised. Choose from: scale_heatmap_first, scale_pred_coords, use_input_size"
+            "value for cg.INFERENCE.EVALUATION_MODE not recognised. Choose from: scale_heatmap_first, scale_heatmap_roi, scale_pred_coords, use_input_size"
         )
-    return use_full_res_coords, resize_first
+    return use_full_res_coords, resize_first, resize_roi
 
 
 def infer_additional_arguments(yaml_args):
@@ -64,12 +71,21 @@ def infer_additional_arguments(yaml_args):
     if yaml_args.SAMPLER.NUM_WORKERS != 0 and yaml_args.SOLVER.REGRESS_SIGMA:
         yaml_args.INFERRED_ARGS.GEN_HM_IN_MAINTHREAD = True
 
-    use_full_res_coords, resize_first = get_evaluation_mode(
+    # Heatmap labels of whole batches generated on the training device, so the workers only load coordinates.
+    if yaml_args.SOLVER.GENERATE_HEATMAPS_ON_DEVICE:
+        yaml_args.INFERRED_ARGS.GEN_HM_IN_MAINTHREAD = True
+
+    # Batches augmented in the main thread need their heatmap labels generated after the augmentation.
+    if yaml_args.SAMPLER.DATA_AUG_PACKAGE == "torch" and yaml_args.SAMPLER.DATA_AUG != None:
+        yaml_args.INFERRED_ARGS.GEN_HM_IN_MAINTHREAD = True
+
+    use_full_res_coords, resize_first, resize_roi = get_evaluation_mode(
         yaml_args.INFERENCE.EVALUATION_MODE
     )
 
     yaml_args.INFERRED_ARGS.USE_FULL_RES_COORDS = use_full_res_coords
     yaml_args.INFERRED_ARGS.RESIZE_FIRST = resize_first
+    yaml_args.INFERRED_ARGS.RESIZE_ROI = resize_roi
 
     if yaml_args.SAMPLER.PATCH.RESOLUTION_TO_SAMPLE_FROM == "input_size":
         yaml_args.SAMPLER.PATCH.RESOLUTION_TO_SAMPLE_FROM = yaml_args.SAMPLER.INPUT_SIZE
@@ -254,6 +270,28 @@ def argument_checking(yaml_args):
         except ValueError as e:
             all_errors.append(e)
 
+    try:
+        if yaml_args.SAMPLER.PATCH.PATCHES_PER_LOAD < 1:
+            raise ValueError(
+                "SAMPLER.PATCH.PATCHES_PER_LOAD must be at least 1, you chose %s."
+                % yaml_args.SAMPLER.PATCH.PATCHES_PER_LOAD
+            )
+        if yaml_args.SAMPLER.PATCH.PATCHES_PER_LOAD > 1 and yaml_args.SAMPLER.SAMPLE_MODE not in ["patch_bias", "patch_centred"]:
+            raise ValueError(
+                "SAMPLER.PATCH.PATCHES_PER_LOAD > 1 (%s) samples several patches from each loaded image, but SAMPLER.SAMPLE_MODE is %s. Use 'patch_bias' or 'patch_centred', or set PATCHES_PER_LOAD to 1."
+                % (yaml_args.SAMPLER.PATCH.PATCHES_PER_LOAD, yaml_args.SAMPLER.SAMPLE_MODE)
+            )
+    except ValueError as e:
+        all_errors.append(e)
+
+    try:
+        if yaml_args.INFERENCE.FIT_GAUSS_WINDOW < 1:
+            raise ValueError(
+                "INFERENCE.FIT_GAUSS_WINDOW must be at least 1, you chose %s." % yaml_args.INFERENCE.FIT_GAUSS_WINDOW
+            )
+    except ValueError as e:
+        all_errors.append(e)
+
     # deep supervision cases to cover:
     try:
         if (
@@ -283,15 +321,71 @@ def argument_checking(yaml_args):
     try:
         if (
             yaml_args.SAMPLER.DATA_AUG != None
-            and yaml_args.SAMPLER.DATA_AUG_PACKAGE != "imgaug"
+            and yaml_args.SAMPLER.DATA_AUG_PACKAGE not in ["imgaug", "fused", "torch"]
         ):
             raise ValueError(
-                "Only the imgaug data augmentation package (SAMPLER.DATA_AUG_PACKAGE) is supported, you chose %s. Try 'imgaug' or set SAMPLER.DATA_AUG to None for no data augmentation."
+                "Only the imgaug, fused and torch data augmentation packages (SAMPLER.DATA_AUG_PACKAGE) are supported, you chose %s. Try 'imgaug' or set SAMPLER.DATA_AUG to None for no data augmentation."
                 % yaml_args.SAMPLER.DATA_AUG_PACKAGE
             )
     except ValueError as e:
         all_errors.append(e)
 
+    try:
+        if (
+            yaml_args.SAMPLER.DATA_AUG != None
+            and yaml_args.SAMPLER.DATA_AUG_PACKAGE == "fused"
+            and yaml_args.SAMPLER.DATA_AUG not in FUSED_AUG_STRATEGIES
+        ):
+            raise ValueError(
+                "SAMPLER.DATA_AUG %s is not supported by the fused data augmentation package. Choose from %s or set SAMPLER.DATA_AUG_PACKAGE to 'imgaug'."
+                % (yaml_args.SAMPLER.DATA_AUG, FUSED_AUG_STRATEGIES)
+            )
+    except ValueError as e:
+        all_errors.append(e)
+
+    try:
+        if yaml_args.SAMPLER.DATA_AUG != None and yaml_args.SAMPLER.DATA_AUG_PACKAGE == "torch":
+            if yaml_args.SAMPLER.DATA_AUG not in BATCH_AUG_STRATEGIES:
+                raise ValueError(
+                    "SAMPLER.DATA_AUG %s is not supported by the torch data augmentation package. Choose from %s or set SAMPLER.DATA_AUG_PACKAGE to 'imgaug'."
+                    % (yaml_args.SAMPLER.DATA_AUG, BATCH_AUG_STRATEGIES)
+                )
+            if yaml_args.DATASET.STANDARDIZE_LANDMARKS:
+                raise ValueError(
+                    "The torch data augmentation package (SAMPLER.DATA_AUG_PACKAGE) does not support standardized landmarks (DATASET.STANDARDIZE_LANDMARKS). Use the 'imgaug' or 'fused' package."
+                )
+    except ValueError as e:
+        all_errors.append(e)
+
+    try:
+        if yaml_args.DATASET.IMAGE_LOADER not in ["pil", "array"]:
+            raise ValueError(
+                "DATASET.IMAGE_LOADER %s not recognised. Choose from ['pil', 'array']"
+                % yaml_args.DATASET.IMAGE_LOADER
+            )
+    except ValueError as e:
+        all_errors.append(e)
+
+    try:
+        if yaml_args.TRAINER.CACHE_LOADING_POOL not in ["process", "thread"]:
+            raise ValueError(
+                "TRAINER.CACHE_LOADING_POOL %s not recognised. Choose from ['process', 'thread']"
+                % yaml_args.TRAINER.CACHE_LOADING_POOL
+            )
+    except ValueError as e:
+        all_errors.append(e)
+
+    try:
+        if yaml_args.DATASET.STREAM_SHARDS_DIR is not None and not os.path.isdir(
+            os.path.join(yaml_args.DATASET.STREAM_SHARDS_DIR, yaml_args.INFERENCE.SPLIT)
+        ):
+            raise ValueError(
+                "DATASET.STREAM_SHARDS_DIR %s has no shards for the inference split %s. Write them with utils/data/shards.py."
+                % (yaml_args.DATASET.STREAM_SHARDS_DIR, yaml_args.INFERENCE.SPLIT)
+            )
+    except ValueError as e:
+        all_errors.append(e)
+
     # Warnings
     if (
         yaml_args.SOLVER.REGRESS_SIGMA
@@ -310,6 +404,23 @@ def argument_checking(yaml_args):
             stacklevel=2,
         )
 
+    if (
+        yaml_args.SAMPLER.PATCH.PATCHES_PER_LOAD > 1
+        and yaml_args.SOLVER.DATA_LOADER_BATCH_SIZE_TRAIN % yaml_args.SAMPLER.PATCH.PATCHES_PER_LOAD != 0
+    ):
+        warnings.warn(
+            "SOLVER.DATA_LOADER_BATCH_SIZE_TRAIN (%s) is not a multiple of SAMPLER.PATCH.PATCHES_PER_LOAD (%s), so the patches of some images are split between batches and those images are loaded more than once."
+            % (yaml_args.SOLVER.DATA_LOADER_BATCH_SIZE_TRAIN, yaml_args.SAMPLER.PATCH.PATCHES_PER_LOAD),
+            stacklevel=2,
+        )
+
+    if yaml_args.SOLVER.GENERATE_HEATMAPS_ON_DEVICE and yaml_args.MODEL.ARCHITECTURE != "U-Net":
+        warnings.warn(
+            "SOLVER.GENERATE_HEATMAPS_ON_DEVICE is True but MODEL.ARCHITECTURE is %s. Only U-Net generates the heatmaps of whole batches on the device, the heatmaps of each sample will be generated in turn in the main process."
+            % yaml_args.MODEL.ARCHITECTURE,
+            stacklevel=2,
+        )
+
     # Some GP checking
 
     if yaml_args.MODEL.ARCHITECTURE == "GP":